@@ -0,0 +1,151 @@
+import base64
+import gzip
+import json
+
+from sketches import HISTOGRAM_BUCKETS_PER_DOUBLING, HISTOGRAM_MIN_VALUE, HyperLogLog, LogHistogram, TDigest
+
+
+AGGREGATE_FILE_FORMAT = 'log-analyzer-aggregate'
+AGGREGATE_FILE_VERSION = 2  # увеличивается при изменении формата (2 - оценка кол-ва клиентов url)
+
+
+def to_histogram(samples):
+    """
+    Значения времени url (все значения, t-digest или гистограмма) в виде LogHistogram
+    """
+    if isinstance(samples, LogHistogram):
+        return samples
+
+    histogram = LogHistogram()
+
+    if isinstance(samples, TDigest):
+        samples.compress()
+
+        for mean, weight in zip(samples.means, samples.weights):
+            histogram.add_count(mean, weight)
+    else:
+        histogram.merge(samples)
+
+    return histogram
+
+
+def pack_histogram(histogram):
+    """
+    Непустые корзины гистограммы одним списком: [номер корзины, кол-во, номер корзины, кол-во, ...]
+    """
+    return [value for index in sorted(histogram.buckets) for value in (index, histogram.buckets[index])]
+
+
+def unpack_histogram(buckets, time_sum, time_max):
+    histogram = LogHistogram()
+    histogram.buckets = dict(zip(buckets[::2], buckets[1::2]))
+    histogram.count = sum(buckets[1::2])
+    histogram.sum = time_sum
+    histogram.max = time_max
+
+    return histogram
+
+
+def pack_clients(clients):
+    """
+    HyperLogLog клиентов url: [точность, непустые регистры списком [номер, значение, ...]] или, если регистры
+    хранятся массивом, [точность, регистры в base64]
+    """
+    if clients.registers is None:
+        return [clients.precision, [value for index, rank in sorted(clients.sparse.items()) for value in (index, rank)]]
+    return [clients.precision, base64.b64encode(bytes(clients.registers)).decode('ascii')]
+
+
+def unpack_clients(packed):
+    precision, registers = packed
+    clients = HyperLogLog(precision)
+
+    if isinstance(registers, str):
+        clients.registers = bytearray(base64.b64decode(registers))
+    else:
+        clients.sparse = dict(zip(registers[::2], registers[1::2]))
+
+    return clients
+
+
+def write_aggregate_file(file_path, aggregated, meta):
+    """
+    Сохраняем показатели файла логов одного сервера для последующего объединения (команда merge): gzip-файл
+    JSON-строк - заголовок (формат, версия, параметры гистограмм, meta: сервер, файл логов, дата, общие показатели),
+    затем по строке на url ["u", url, кол-во, сумма, максимум, корзины гистограммы(, HyperLogLog клиентов)]
+    и на интервал временного ряда ["t", начало интервала, кол-во, сумма, максимум, корзины]. Файл не содержит
+    исполняемых данных (в отличие от pickle) и не зависит от версии Python, поэтому его можно передавать
+    между машинами
+    """
+    header = dict(
+        meta,
+        format=AGGREGATE_FILE_FORMAT,
+        version=AGGREGATE_FILE_VERSION,
+        histogram={'min_value': HISTOGRAM_MIN_VALUE, 'buckets_per_doubling': HISTOGRAM_BUCKETS_PER_DOUBLING},
+        total_count=aggregated['total_count'],
+        total_time=aggregated['total_time'],
+        invalid_count=aggregated['invalid_count']
+    )
+
+    with gzip.open(file_path, 'wt', encoding='utf-8') as aggregate_file:
+        aggregate_file.write(json.dumps(header, ensure_ascii=False) + '\n')
+
+        for url, url_stats in aggregated['urls'].items():
+            row = ['u', url, url_stats['count'], url_stats['time_sum'], url_stats['time_max'],
+                   pack_histogram(to_histogram(url_stats['samples']))]
+
+            if 'clients' in url_stats:
+                row.append(pack_clients(url_stats['clients']))
+
+            aggregate_file.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+        for bucket, histogram in sorted(aggregated.get('timeseries', {}).items()):
+            row = ['t', bucket, histogram.count, histogram.sum, histogram.max, pack_histogram(histogram)]
+            aggregate_file.write(json.dumps(row, separators=(',', ':')) + '\n')
+
+
+def read_aggregate_file(file_path):
+    """
+    Читаем файл write_aggregate_file: (заголовок, показатели в том же виде, что у aggregate_records, время ответа
+    url - в LogHistogram). Файл другого формата, более новой версии или с другими корзинами гистограмм - ValueError
+    """
+    with gzip.open(file_path, 'rt', encoding='utf-8') as aggregate_file:
+        header = json.loads(aggregate_file.readline() or '{}')
+
+        if header.get('format') != AGGREGATE_FILE_FORMAT:
+            raise ValueError(f'{file_path}: не файл показателей log_analyzer')
+
+        if header.get('version', 0) > AGGREGATE_FILE_VERSION:
+            raise ValueError(f"{file_path}: версия формата {header.get('version')} не поддерживается "
+                             f"(поддерживается до {AGGREGATE_FILE_VERSION})")
+
+        if header['histogram'] != {'min_value': HISTOGRAM_MIN_VALUE,
+                                   'buckets_per_doubling': HISTOGRAM_BUCKETS_PER_DOUBLING}:
+            raise ValueError(f'{file_path}: гистограммы с другими корзинами не складываются')
+
+        aggregated = {
+            'urls': {},
+            'total_count': header['total_count'],
+            'total_time': header['total_time'],
+            'invalid_count': header['invalid_count']
+        }
+
+        for line in aggregate_file:
+            row = json.loads(line)
+
+            if row[0] == 'u':
+                _, url, count, time_sum, time_max, buckets = row[:6]
+                aggregated['urls'][url] = {
+                    'count': count,
+                    'time_sum': time_sum,
+                    'time_max': time_max,
+                    'samples': unpack_histogram(buckets, time_sum, time_max)
+                }
+
+                if len(row) > 6:
+                    aggregated['urls'][url]['clients'] = unpack_clients(row[6])
+            elif row[0] == 't':
+                _, bucket, _, time_sum, time_max, buckets = row
+                aggregated.setdefault('timeseries', {})[bucket] = unpack_histogram(buckets, time_sum, time_max)
+
+    return header, aggregated
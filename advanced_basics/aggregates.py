@@ -0,0 +1,192 @@
+import os
+import pickle
+import sqlite3
+
+
+AGGREGATES_DB_NAME = 'aggregates.db'
+# Сколько секунд ждать, пока запись показателей другого процесса (--backfill --workers) освободит базу
+LOCK_TIMEOUT = 600
+
+URL_STATS_COLUMNS = ('count', 'time_sum', 'time_max')
+
+
+class AggregateStore:
+    """
+    Хранилище показателей по url для каждого обработанного файла логов (sqlite-файл в директории отчетов).
+    Для каждого файла запоминаем, до какого байта он обработан - при повторном запуске дочитываются только новые строки.
+    Базу могут одновременно использовать несколько процессов: журнал WAL (чтение не ждет записи), а запись ждет
+    освобождения базы до LOCK_TIMEOUT секунд
+    """
+
+    def __init__(self, dir_name, db_name=AGGREGATES_DB_NAME):
+        os.makedirs(dir_name, exist_ok=True)
+
+        self.db_name = os.path.join(dir_name, db_name)
+        self.initialize_db()
+
+    def get_con(self):
+        return sqlite3.connect(self.db_name, timeout=LOCK_TIMEOUT)
+
+    def initialize_db(self):
+        conn = self.get_con()
+        conn.execute("PRAGMA journal_mode=WAL")  # режим сохраняется в файле базы
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS logs
+            ([log_name] TEXT PRIMARY KEY, [log_date] INTEGER, [inode] INTEGER, [offset] INTEGER,
+            [total_count] INTEGER, [total_time] REAL, [invalid_count] INTEGER, [quantiles] TEXT,
+            [timeseries_bucket] INTEGER DEFAULT 0)
+            """
+        )
+        logs_columns = [row[1] for row in cursor.execute("PRAGMA table_info(logs)")]
+        if 'timeseries_bucket' not in logs_columns:  # база создана до появления временного ряда
+            try:
+                cursor.execute("ALTER TABLE logs ADD COLUMN [timeseries_bucket] INTEGER DEFAULT 0")
+            except sqlite3.OperationalError:  # колонку только что добавил другой процесс
+                pass
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS urls
+            ([log_name] TEXT, [position] INTEGER, [url] TEXT, [count] INTEGER, [time_sum] REAL, [time_max] REAL,
+            [state] BLOB, PRIMARY KEY ([log_name], [url]))
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS timeseries
+            ([log_name] TEXT, [bucket] INTEGER, [state] BLOB, PRIMARY KEY ([log_name], [bucket]))
+            """
+        )
+        conn.commit()
+        conn.close()
+
+    def get_log_info(self, log_name):
+        """
+        Сведения об обработанном файле (дата, inode, обработанный байт, итоговые показатели) или None
+        """
+        conn = self.get_con()
+        cursor = conn.execute(
+            "SELECT log_name, log_date, inode, offset, total_count, total_time, invalid_count, quantiles, "
+            "timeseries_bucket "
+            "FROM logs WHERE log_name = ?", (log_name,)
+        )
+        row = cursor.fetchone()
+        conn.close()
+
+        if row is None:
+            return None
+
+        fields = [column[0] for column in cursor.description]
+        return {key: value for key, value in zip(fields, row)}
+
+    def get_logs_info(self, date_from, date_to):
+        """
+        Сведения обо всех обработанных файлах с датой в периоде [date_from, date_to], по возрастанию даты
+        """
+        conn = self.get_con()
+        cursor = conn.execute(
+            "SELECT log_name, log_date, inode, offset, total_count, total_time, invalid_count, quantiles, "
+            "timeseries_bucket "
+            "FROM logs WHERE log_date BETWEEN ? AND ? ORDER BY log_date, log_name", (date_from, date_to)
+        )
+        fields = [column[0] for column in cursor.description]
+        logs_info = [{key: value for key, value in zip(fields, row)} for row in cursor.fetchall()]
+        conn.close()
+
+        return logs_info
+
+    def load(self, log_name):
+        """
+        Загружаем сохраненные показатели файла в том же виде, в котором их собирает aggregate_lines
+        (url - в порядке первого появления в файле)
+        """
+        info = self.get_log_info(log_name)
+
+        if info is None:
+            return None
+
+        conn = self.get_con()
+        rows = conn.execute(
+            "SELECT url, count, time_sum, time_max, state FROM urls WHERE log_name = ? ORDER BY position",
+            (log_name,)
+        )
+
+        urls_stats = {}
+
+        for url, count, time_sum, time_max, state in rows:
+            url_stats = {'count': count, 'time_sum': time_sum, 'time_max': time_max}
+            url_stats.update(pickle.loads(state))
+            urls_stats[url] = url_stats
+
+        aggregated = {
+            'urls': urls_stats,
+            'total_count': info['total_count'],
+            'total_time': info['total_time'],
+            'invalid_count': info['invalid_count']
+        }
+
+        if info['timeseries_bucket']:
+            rows = conn.execute(
+                "SELECT bucket, state FROM timeseries WHERE log_name = ? ORDER BY bucket", (log_name,)
+            )
+            aggregated['timeseries'] = {bucket: pickle.loads(state) for bucket, state in rows}
+
+        conn.close()
+
+        return aggregated, info
+
+    def save(self, log_name, log_date, aggregated, inode, offset, quantiles, urls=None, timeseries_bucket=0):
+        """
+        Сохраняем показатели файла. Если передан список urls - обновляем только эти url (затронутые новыми строками).
+        Новые url должны идти в начале списка: они добавляются в конец таблицы, сохраняя порядок первого появления,
+        у уже сохраненных url позиция не меняется. Временной ряд (интервалы по timeseries_bucket секунд)
+        сохраняется целиком
+        """
+        urls_stats = aggregated['urls']
+
+        conn = self.get_con()
+        cursor = conn.cursor()
+
+        if urls is None:
+            urls = urls_stats.keys()
+            cursor.execute("DELETE FROM urls WHERE log_name = ?", (log_name,))
+            next_position = 0
+        else:
+            next_position = cursor.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM urls WHERE log_name = ?", (log_name,)
+            ).fetchone()[0]
+
+        rows = []
+
+        for position, url in enumerate(urls, start=next_position):
+            url_stats = urls_stats[url]
+            state = {key: value for key, value in url_stats.items() if key not in URL_STATS_COLUMNS}
+            rows.append((
+                log_name, position, url, url_stats['count'], url_stats['time_sum'], url_stats['time_max'],
+                pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+            ))
+
+        cursor.executemany(
+            """
+            INSERT INTO urls VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (log_name, url) DO UPDATE SET
+            count = excluded.count, time_sum = excluded.time_sum, time_max = excluded.time_max, state = excluded.state
+            """,
+            rows
+        )
+        cursor.execute("DELETE FROM timeseries WHERE log_name = ?", (log_name,))
+        cursor.executemany(
+            "INSERT INTO timeseries VALUES (?, ?, ?)",
+            [
+                (log_name, bucket, pickle.dumps(histogram, protocol=pickle.HIGHEST_PROTOCOL))
+                for bucket, histogram in aggregated.get('timeseries', {}).items()
+            ]
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (log_name, log_date, inode, offset, aggregated['total_count'], aggregated['total_time'],
+             aggregated['invalid_count'], quantiles, timeseries_bucket if 'timeseries' in aggregated else 0)
+        )
+        conn.commit()
+        conn.close()
@@ -0,0 +1,341 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+from statistics import median
+
+from log_analyzer import (
+    validate_log,
+    parse_ui_short,
+    process_logs,
+    aggregate_lines,
+    aggregate_log_file,
+    aggregate_records,
+    make_aggregate_options,
+    new_url_stats,
+    build_urls_data,
+    get_url_time,
+    process_lines,
+    create_report_file,
+)
+import vectorized
+from profiling import get_peak_rss
+from log_formats import compile_log_format, UI_SHORT_FORMAT
+
+
+BENCH_RESULTS_FILE = 'bench_results.jsonl'
+BENCH_SIZES = (10000, 1000000, 10000000)
+
+UI_SHORT_LINE = (
+    '{ip} -  - [{time_local}] "GET {url} HTTP/1.1" 200 {size} "-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" '
+    '"{request_id}" "-" {request_time}\n'
+)
+UI_SHORT_INVALID_LINE = '{ip} -  - [{time_local}] "0" 400 166 "-" "-" "-" "-" "-" {request_time}\n'
+
+
+def parse_with_split(line):
+    """
+    Прежний способ разбора строки: split() по пробелам + validate_log + позиционные индексы
+    """
+    log_list = line.split()
+
+    if not validate_log(log_list):
+        return None
+
+    return log_list[6], float(log_list[-1])
+
+
+def measure(func, lines, repeat):
+    """
+    Лучшее время (из repeat запусков) разбора всех строк функцией func
+    """
+    best = None
+
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for line in lines:
+            func(line)
+        elapsed = time.perf_counter() - t
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def bench_parser(file_path, repeat=5):
+    """
+    Микробенчмарк разбора строк: split() + validate_log против parse_ui_short и разбора по строке log_format
+    ui_short (файл заранее читается в память, чтобы не учитывать время чтения с диска)
+    """
+    with open(file_path, 'r') as log:
+        lines = log.readlines()
+
+    results = {
+        'split + validate_log': measure(parse_with_split, lines, repeat),
+        'parse_ui_short': measure(parse_ui_short, lines, repeat),
+        'LogFormat(ui_short)': measure(compile_log_format(UI_SHORT_FORMAT).parse, lines, repeat),
+    }
+
+    print(f"Файл: {file_path}, строк: {len(lines)}, повторов: {repeat}")
+
+    for name, elapsed in results.items():
+        print(f"{name:<24} {elapsed:.4f} сек. ({len(lines) / elapsed:,.0f} строк/сек.)")
+
+    return results
+
+
+def bench_reader(file_path, repeat=3):
+    """
+    Сравнение чтения файла целиком: текстовый режим (строки декодируются в str) против чтения байтов
+    (mmap / блоки распакованного .gz, декодируется только url)
+    """
+    dir_name, file_name = os.path.split(file_path)
+
+    results = {
+        'text': measure(lambda _: aggregate_lines(process_logs(file_name, dir_name)), [None], repeat),
+        'mmap': measure(lambda _: aggregate_log_file(file_name, dir_name), [None], repeat),
+    }
+
+    print(f"Файл: {file_path}, размер: {os.path.getsize(file_path)} байт, повторов: {repeat}")
+
+    for name, elapsed in results.items():
+        print(f"{name:<24} {elapsed:.4f} сек.")
+
+    return results
+
+
+def build_urls_data_full_sort(aggregated, report_size):
+    """
+    Прежний способ отбора: итоговые показатели считаются для всех url, затем весь список сортируется и обрезается
+    """
+    total_count = aggregated.get('total_count')
+    total_time = aggregated.get('total_time')
+
+    urls_data_list = []
+
+    for url, url_stats in aggregated.get('urls').items():
+        urls_data_list.append({
+            'url': url,
+            'count': url_stats['count'],
+            'count_perc': url_stats['count'] / total_count * 100,
+            'time_sum': round(url_stats['time_sum'], 3),
+            'time_perc': round(url_stats['time_sum'] / total_time * 100, 3),
+            'time_avg': round(url_stats['time_sum'] / url_stats['count'], 3),
+            'time_max': url_stats['time_max'],
+            'time_med': round(median(url_stats['samples']), 3)
+        })
+
+    urls_data_list.sort(reverse=True, key=get_url_time)
+
+    return urls_data_list[0:report_size]
+
+
+def bench_top_n(urls_count=1000000, report_size=1000, repeat=3):
+    """
+    Сравнение отбора report_size url из urls_count различных: полная сортировка против кучи (build_urls_data)
+    """
+    rnd = random.Random(0)
+    urls_stats = {f'/api/v2/banner/{i}': new_url_stats(round(rnd.expovariate(5), 3)) for i in range(urls_count)}
+    aggregated = {
+        'urls': urls_stats,
+        'total_count': urls_count,
+        'total_time': sum(url_stats['time_sum'] for url_stats in urls_stats.values()),
+        'invalid_count': 0
+    }
+
+    results = {
+        'full sort': measure(lambda _: build_urls_data_full_sort(aggregated, report_size), [None], repeat),
+        'heapq.nlargest': measure(lambda _: build_urls_data(aggregated, report_size), [None], repeat),
+    }
+
+    print(f"Различных url: {urls_count}, REPORT_SIZE: {report_size}, повторов: {repeat}")
+
+    for name, elapsed in results.items():
+        print(f"{name:<24} {elapsed:.4f} сек.")
+
+    return results
+
+
+def bench_stats_backend(records_count=2000000, urls_count=10000, report_size=1000, repeat=3):
+    """
+    Сравнение расчета показателей по уже разобранным строкам: накопление по каждому url в цикле Python
+    против колонок и группировки numpy (STATS_BACKEND numpy)
+    """
+    if vectorized.numpy is None:
+        print("numpy не установлен - сравнение STATS_BACKEND пропущено")
+        return None
+
+    rnd = random.Random(0)
+    records = [
+        (f'/api/v2/banner/{int(rnd.paretovariate(1)) % urls_count}', round(rnd.expovariate(5), 3))
+        for _ in range(records_count)
+    ]
+
+    results = {}
+
+    for stats_backend in ('python', 'numpy'):
+        options = make_aggregate_options(stats_backend=stats_backend)
+        results[stats_backend] = measure(
+            lambda _: build_urls_data(aggregate_records(records, options), report_size), [None], repeat
+        )
+
+    print(f"Строк: {records_count}, различных url: до {urls_count}, повторов: {repeat}")
+
+    for name, elapsed in results.items():
+        print(f"{name:<24} {elapsed:.4f} сек.")
+
+    return results
+
+
+def generate_ui_short_log(file_path, lines=10000, urls_count=1000, zipf_skew=1.1, invalid_ratio=0.0,
+                          gzip_output=False, seed=0):
+    """
+    Синтетический лог в формате ui_short: url выбираются из urls_count различных по закону Ципфа
+    (вероятность k-го url пропорциональна 1 / k ** zipf_skew), время ответа - логнормальное, доля invalid_ratio
+    строк - невалидные (без url в "$request"). При одинаковых параметрах файл получается одинаковым
+    """
+    rnd = random.Random(seed)
+    urls = [f'/api/v2/banner/{i}/statistic/' if i % 3 else f'/api/1/campaigns/?id={i}' for i in range(urls_count)]
+    cum_weights = list(accumulate(1 / (k ** zipf_skew) for k in range(1, urls_count + 1)))
+    started = datetime(2017, 6, 29, 3, 50, 22)
+    seconds_per_line = 86400 / lines
+
+    log = gzip.open(file_path, 'wt') if gzip_output else open(file_path, 'w')
+    last_second = None
+
+    with log:
+        batch_size = 10000
+
+        for batch_start in range(0, lines, batch_size):
+            batch_urls = rnd.choices(urls, cum_weights=cum_weights, k=min(batch_size, lines - batch_start))
+            batch = []
+
+            for i, url in enumerate(batch_urls, start=batch_start):
+                second = int(i * seconds_per_line)
+
+                if second != last_second:  # строки за одну секунду - одно время без повторного форматирования
+                    time_local = (started + timedelta(seconds=second)).strftime('%d/%b/%Y:%H:%M:%S +0300')
+                    last_second = second
+
+                fields = {
+                    'ip': f'1.{i % 200}.{i % 7}.{i % 250}',
+                    'time_local': time_local,
+                    'url': url,
+                    'size': 100 + i % 900,
+                    'request_id': f'1498697422-{i}',
+                    'request_time': f'{rnd.lognormvariate(-2, 1):.3f}'
+                }
+
+                if invalid_ratio and rnd.random() < invalid_ratio:
+                    batch.append(UI_SHORT_INVALID_LINE.format(**fields))
+                else:
+                    batch.append(UI_SHORT_LINE.format(**fields))
+
+            log.write(''.join(batch))
+
+    return file_path
+
+
+def get_version():
+    """
+    Версия кода для записи результатов: короткий хэш коммита (или None вне git-репозитория)
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(sizes=BENCH_SIZES, urls_count=10000, zipf_skew=1.1, invalid_ratio=0.01, gzip_output=False,
+                report_size=1000, results_file=BENCH_RESULTS_FILE, work_dir=None):
+    """
+    Время process_lines и записи отчета на синтетических логах из sizes строк. Логи создаются в work_dir
+    (и переиспользуются при тех же параметрах), результаты дописываются в results_file (JSON на строку) вместе
+    с версией кода - так изменения производительности видны между версиями
+    """
+    if work_dir is None:
+        work_dir = os.path.join(tempfile.gettempdir(), 'log_analyzer_bench')
+
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    params = {
+        'urls_count': urls_count, 'zipf_skew': zipf_skew, 'invalid_ratio': invalid_ratio, 'gzip': gzip_output,
+        'report_size': report_size
+    }
+    results = []
+
+    for lines in sizes:
+        file_name = f'nginx-access-ui.log-{lines}-{urls_count}-{zipf_skew}-{invalid_ratio}'
+        file_name += '.gz' if gzip_output else ''
+        file_path = os.path.join(work_dir, file_name)
+
+        if not os.path.exists(file_path):
+            generate_ui_short_log(file_path, lines, urls_count, zipf_skew, invalid_ratio, gzip_output)
+
+        t = time.perf_counter()
+        urls = process_lines(process_logs(file_name, work_dir), file_name, work_dir, report_size, fail_coefficient=100)
+        process_seconds = time.perf_counter() - t
+
+        t = time.perf_counter()
+        create_report_file(urls, 20170629, os.path.join(work_dir, 'reports'))
+        render_seconds = time.perf_counter() - t
+
+        result = dict(
+            params,
+            date=datetime.now().isoformat(timespec='seconds'),
+            version=get_version(),
+            python=platform.python_version(),
+            lines=lines,
+            bytes=os.path.getsize(file_path),
+            process_lines_sec=round(process_seconds, 4),
+            lines_per_sec=round(lines / process_seconds),
+            render_sec=round(render_seconds, 4),
+            peak_rss_kb=get_peak_rss()
+        )
+        results.append(result)
+
+        print(f"Строк: {lines:>10}, process_lines: {process_seconds:.4f} сек. "
+              f"({result['lines_per_sec']:,} строк/сек.), отчет: {render_seconds:.4f} сек.")
+
+        if results_file:
+            with open(results_file, 'a', encoding='utf-8') as results_log:
+                results_log.write(json.dumps(result) + '\n')
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Бенчмарки анализатора логов')
+    parser.add_argument("--file", required=False, type=str, default='./log/nginx-access-ui.log-20170629')
+    parser.add_argument("--repeat", required=False, type=int, default=5)
+    parser.add_argument("--urls", required=False, type=int, default=1000000)
+    parser.add_argument("--suite", required=False, action="store_true")  # Замеры на синтетических логах
+    parser.add_argument("--sizes", required=False, type=int, nargs="+", default=list(BENCH_SIZES))
+    parser.add_argument("--url-cardinality", required=False, type=int, default=10000, dest="url_cardinality")
+    parser.add_argument("--zipf", required=False, type=float, default=1.1)
+    parser.add_argument("--invalid", required=False, type=float, default=0.01)
+    parser.add_argument("--gzip", required=False, action="store_true")
+    parser.add_argument("--results", required=False, type=str, default=BENCH_RESULTS_FILE)
+    parser.add_argument("--work-dir", required=False, type=str, dest="work_dir")
+    opts = parser.parse_args()
+
+    if opts.suite:
+        bench_suite(opts.sizes, opts.url_cardinality, opts.zipf, opts.invalid, opts.gzip,
+                    results_file=opts.results, work_dir=opts.work_dir)
+        raise SystemExit
+
+    bench_parser(opts.file, opts.repeat)
+    bench_reader(opts.file, opts.repeat)
+    bench_top_n(opts.urls, repeat=opts.repeat)
+    bench_stats_backend(repeat=opts.repeat)
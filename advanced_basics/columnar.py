@@ -0,0 +1,149 @@
+import ast
+import json
+import os
+import struct
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+COLUMNS_META_NAME = 'meta.json'
+COLUMNS_URLS_NAME = 'urls.json'
+
+# Колонка -> (typecode модуля array, dtype в заголовке .npy)
+COLUMN_TYPES = {
+    'url_id': ('I', '<u4'),  # номер url в словаре urls.json
+    'request_time': ('f', '<f4'),
+    'timestamp': ('q', '<i8'),  # $time_local в секундах от начала эпохи (UTC)
+}
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+
+def write_npy(file_path, values, dtype):
+    """
+    Записываем одномерный массив (array.array) в формате .npy версии 1.0 - файл читается numpy.load(mmap_mode='r')
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, len(values))
+    padding = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64  # данные выравниваются по 64 байтам
+    header = (header + ' ' * padding + '\n').encode('latin1')
+
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    with open(file_path, 'wb') as npy_file:
+        npy_file.write(NPY_MAGIC + struct.pack('<H', len(header)) + header)
+        values.tofile(npy_file)
+
+
+def read_npy(file_path, typecode):
+    """
+    Читаем .npy, записанный write_npy: с numpy - отображаем файл в память, без него - читаем в array.array
+    """
+    if numpy is not None:
+        return numpy.load(file_path, mmap_mode='r')
+
+    with open(file_path, 'rb') as npy_file:
+        if npy_file.read(len(NPY_MAGIC)) != NPY_MAGIC:
+            raise ValueError(f'{file_path}: неподдерживаемый формат .npy')
+
+        header_size = struct.unpack('<H', npy_file.read(2))[0]
+        shape = ast.literal_eval(npy_file.read(header_size).decode('latin1'))['shape']
+        values = array(typecode)
+        values.fromfile(npy_file, shape[0])
+
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+
+class ColumnWriter:
+    """
+    Запись разобранных строк лога по колонкам: url заменяются номерами из словаря, значения копятся в array.array
+    и сбрасываются на диск блоками по chunk_size строк (chunk-00000.url_id.npy, chunk-00000.request_time.npy, ...)
+    """
+
+    def __init__(self, dir_name, chunk_size=1000000):
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        self.dir_name = dir_name
+        self.chunk_size = chunk_size
+        self.url_ids = {}
+        self.chunks = []
+        self.invalid_count = 0
+        self.columns = {name: array(typecode) for name, (typecode, _) in COLUMN_TYPES.items()}
+
+    def add(self, url, request_time, timestamp):
+        url_id = self.url_ids.get(url)
+
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.url_ids)
+
+        self.columns['url_id'].append(url_id)
+        self.columns['request_time'].append(request_time)
+        self.columns['timestamp'].append(timestamp)
+
+        if len(self.columns['url_id']) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        rows = len(self.columns['url_id'])
+
+        if not rows:
+            return
+
+        for name, (typecode, dtype) in COLUMN_TYPES.items():
+            file_path = os.path.join(self.dir_name, f'chunk-{len(self.chunks):05d}.{name}.npy')
+            write_npy(file_path, self.columns[name], dtype)
+            self.columns[name] = array(typecode)
+
+        self.chunks.append(rows)
+
+    def close(self):
+        """
+        Дописываем последний блок, словарь url (список: номер -> url) и описание колонок
+        """
+        self.flush()
+
+        with open(os.path.join(self.dir_name, COLUMNS_URLS_NAME), 'w', encoding='utf-8') as urls_file:
+            json.dump(list(self.url_ids), urls_file, ensure_ascii=False)
+
+        meta = {
+            'rows': sum(self.chunks),
+            'invalid_count': self.invalid_count,
+            'chunks': self.chunks,
+            'columns': {name: dtype for name, (_, dtype) in COLUMN_TYPES.items()},
+        }
+
+        with open(os.path.join(self.dir_name, COLUMNS_META_NAME), 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file, indent=2)
+
+        return meta
+
+
+def load_columns(dir_name):
+    """
+    Читаем выгрузку: словарь url, описание и для каждого блока - колонки {имя: массив}
+    """
+    with open(os.path.join(dir_name, COLUMNS_META_NAME), encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+
+    with open(os.path.join(dir_name, COLUMNS_URLS_NAME), encoding='utf-8') as urls_file:
+        urls = json.load(urls_file)
+
+    chunks = [
+        {
+            name: read_npy(os.path.join(dir_name, f'chunk-{i:05d}.{name}.npy'), typecode)
+            for name, (typecode, _) in COLUMN_TYPES.items()
+        }
+        for i in range(len(meta['chunks']))
+    ]
+
+    return urls, meta, chunks
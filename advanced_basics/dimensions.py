@@ -0,0 +1,58 @@
+import ipaddress
+import re
+from functools import lru_cache
+
+
+# Семейства браузеров/клиентов по признаку в $http_user_agent - в порядке проверки (Edge и Opera содержат "Chrome/",
+# Chrome - "Safari/")
+USER_AGENT_FAMILIES = (
+    ('Bot', re.compile(r'bot\b|crawler|spider', re.IGNORECASE)),
+    ('Edge', re.compile(r'Edg(?:e|A|iOS)?/')),
+    ('Opera', re.compile(r'OPR/|Opera')),
+    ('Chrome', re.compile(r'Chrome/|CriOS/')),
+    ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('Safari', re.compile(r'Safari/')),
+    ('IE', re.compile(r'MSIE |Trident/')),
+)
+USER_AGENT_PRODUCT = re.compile(r'[A-Za-z][\w.-]*')  # прочие клиенты - по названию продукта: "Python-urllib/2.7"
+
+
+@lru_cache(maxsize=65536)
+def get_client_subnet(remote_addr):
+    """
+    Подсеть клиента: IPv4 - /24 ('1.196.116.32' -> '1.196.116.0/24'), IPv6 - /48 ('2001:db8::1' -> '2001:db8::/48');
+    не адрес ('-', имя хоста) - значение как есть
+    """
+    prefix = 48 if ':' in remote_addr else 24
+
+    try:
+        return str(ipaddress.ip_network(f'{remote_addr}/{prefix}', strict=False))
+    except ValueError:
+        return remote_addr
+
+
+@lru_cache(maxsize=65536)
+def get_user_agent_family(user_agent):
+    """
+    Семейство клиента по $http_user_agent: браузер (Chrome, Firefox, ...), 'Bot' или название продукта
+    в начале строки ('Lynx/2.8.8dev.9 libwww-FM/2.14' -> 'Lynx'); '-' - без заголовка
+    """
+    for family, marker in USER_AGENT_FAMILIES:
+        if marker.search(user_agent):
+            return family
+
+    if user_agent.startswith('Mozilla/'):
+        return 'Mozilla'
+
+    product = USER_AGENT_PRODUCT.match(user_agent)
+    return product.group() if product else '-'
+
+
+# Измерение отчета -> (поле log_format, из которого берется значение; преобразование значения или None).
+# Метод запроса берется из $request_method или первого слова $request
+DIMENSIONS = {
+    'status': ('status', None),
+    'method': ('request_method', None),
+    'client_subnet': ('remote_addr', get_client_subnet),
+    'user_agent': ('http_user_agent', get_user_agent_family),
+}
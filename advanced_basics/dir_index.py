@@ -0,0 +1,146 @@
+import fnmatch
+import json
+import os
+import re
+import time
+
+
+LOG_DATE = re.compile(r'-(\d{8})(?:\.gz)?$')  # дата в имени файла логов: nginx-access-ui.log-20170630[.gz]
+
+RACY_INTERVAL_NS = 2 * 10 ** 9  # изменения директории в пределах 2 сек. до чтения могут не отразиться в ее mtime
+
+
+class DirectoryIndex:
+    """
+    Кэш содержимого директорий (LOG_DIR, REPORT_DIR) в json-файле: для каждого файла - (дата из имени, размер, mtime).
+    Директория читается заново, только если изменился ее mtime (файл добавлен, удален или переименован), при этом
+    дата, размер и mtime вычисляются только для новых файлов. Пока директория не менялась - поиск самого нового
+    файла логов и проверка наличия отчета обходятся без чтения директории (одна проверка mtime). Размер и mtime
+    в кэше - на момент появления файла: актуальные значения для нужного файла дает get_file_info
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.dirs = {}
+        self.changed = False
+
+        try:
+            with open(index_path, encoding='utf-8') as index_file:
+                self.dirs = json.load(index_file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            pass
+
+    def refresh(self, dir_name):
+        """
+        Содержимое директории {имя файла: [дата или None, размер, mtime]} - из кэша или с повторным чтением
+        """
+        dir_key = os.path.abspath(dir_name)
+        cached = self.dirs.get(dir_key)
+
+        try:
+            dir_mtime = os.stat(dir_name).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+
+        if cached is not None and cached['mtime_ns'] == dir_mtime:
+            if cached['scanned_ns'] - dir_mtime > RACY_INTERVAL_NS:
+                return cached['files']
+
+        cached_files = cached['files'] if cached is not None else {}
+        files = {}
+        scanned_ns = time.time_ns()
+
+        with os.scandir(path=dir_name) as it:
+            for entry in it:
+                if entry.name in cached_files:
+                    files[entry.name] = cached_files[entry.name]
+                    continue
+
+                if not entry.is_file():
+                    continue
+
+                stat = entry.stat()
+                match = LOG_DATE.search(entry.name)
+                files[entry.name] = [int(match.group(1)) if match else None, stat.st_size, stat.st_mtime_ns]
+
+        # latest - самый новый файл по каждому шаблону имени, заполняется в find_latest_log
+        self.dirs[dir_key] = {'mtime_ns': dir_mtime, 'scanned_ns': scanned_ns, 'files': files, 'latest': {}}
+        self.changed = True
+
+        return files
+
+    def find_latest_log(self, log_dir_name, file_name_pattern):
+        """
+        Самый новый файл логов (имя, дата) или (None, None). Если за дату есть и несжатый, и .gz-файл - несжатый
+        """
+        files = self.refresh(log_dir_name)
+
+        if not files:
+            return None, None
+
+        latest = self.dirs[os.path.abspath(log_dir_name)]['latest']
+
+        if file_name_pattern not in latest:
+            candidates = [
+                (file_date, not name.endswith('.gz'), name)
+                for name, file_date in self.find_logs(log_dir_name, file_name_pattern)
+            ]
+            latest[file_name_pattern] = max(candidates)[2] if candidates else None
+            self.changed = True
+
+        name = latest[file_name_pattern]
+
+        return (name, files[name][0]) if name is not None else (None, None)
+
+    def find_logs(self, log_dir_name, file_name_pattern):
+        """
+        Все файлы логов по шаблону имени: [(имя, дата), ...]
+        """
+        return [
+            (name, file_date) for name, (file_date, _, _) in self.refresh(log_dir_name).items()
+            if file_date is not None and fnmatch.fnmatch(name, file_name_pattern)  # noqa
+        ]
+
+    def get_file_info(self, dir_name, file_name):
+        """
+        [дата, размер, mtime] файла с повторным запросом размера и mtime (файл мог быть дописан или перезаписан
+        без изменения директории) или None, если файла нет
+        """
+        files = self.refresh(dir_name)
+
+        try:
+            stat = os.stat(os.path.join(dir_name, file_name))
+        except FileNotFoundError:
+            return None
+
+        if file_name not in files:
+            return None
+
+        info = [files[file_name][0], stat.st_size, stat.st_mtime_ns]
+
+        if info != files[file_name]:
+            files[file_name] = info
+            self.changed = True
+
+        return info
+
+    def get_names(self, dir_name):
+        """
+        Содержимое директории из кэша - для проверки наличия файла через in, без копирования имен
+        """
+        return self.refresh(dir_name)
+
+    def save(self):
+        if not self.changed:
+            return
+
+        index_dir = os.path.dirname(self.index_path)
+
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as index_file:
+            json.dump(self.dirs, index_file)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+        self.changed = False
@@ -0,0 +1,67 @@
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+
+
+# Примерный объем в памяти (байт) показателей url без значений времени (словари, список, ключ) и одного значения
+# времени в списке (float и указатель на него) - для сравнения таблицы url с MEMORY_BUDGET_MB
+URL_STATS_BYTES = 450
+SAMPLE_BYTES = 32
+
+
+def read_run(file_path):
+    """
+    Записи частичного результата по возрастанию url: (url, номер строки первого появления, значения времени)
+    """
+    with open(file_path, 'rb') as run_file:
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+
+class SpillFiles:
+    """
+    Частичные результаты, сброшенные на диск, когда таблица url превысила бюджет памяти. Каждый сброс - отдельный
+    файл с записями, отсортированными по url (значения времени - array('d'), в порядке строк файла логов).
+    merge объединяет файлы k-путевым слиянием (heapq.merge): в памяти одновременно - по одной записи из файла
+    и значения времени одного url
+    """
+
+    def __init__(self, dir_name=None):
+        self.dir_name = tempfile.mkdtemp(prefix='log_analyzer-spill-', dir=dir_name or None)
+        self.runs = []
+
+    def spill(self, urls_stats, first_seen):
+        file_path = os.path.join(self.dir_name, f'run-{len(self.runs):05d}.pickle')
+
+        with open(file_path, 'wb') as run_file:
+            for url in sorted(urls_stats):
+                record = (url, first_seen[url], array('d', urls_stats[url]['samples']))
+                pickle.dump(record, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.runs.append(file_path)
+
+    def merge(self):
+        """
+        Все url по возрастанию: (url, номер строки первого появления, все значения времени в порядке строк).
+        При равных url heapq.merge сохраняет порядок файлов, т.е. порядок сбросов
+        """
+        merged = heapq.merge(*(read_run(file_path) for file_path in self.runs), key=itemgetter(0))
+
+        for url, parts in groupby(merged, key=itemgetter(0)):
+            _, first_seen, samples = next(parts)
+
+            for _, _, part_samples in parts:
+                samples.extend(part_samples)
+
+            yield url, first_seen, samples
+
+    def close(self):
+        shutil.rmtree(self.dir_name, ignore_errors=True)
@@ -15,15 +15,95 @@ import sys
 from statistics import median
 import logging
 import argparse
+import heapq
 import json
+import mmap
+import math
+import random
+import copy
+import time
+import socket
+import multiprocessing
+from functools import partial, reduce
+from operator import add, itemgetter
+from array import array
+from itertools import chain, groupby
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+from sketches import ExactSamples, LogHistogram, SpaceSaving, HyperLogLog, make_samples_factory
+from aggregates import AggregateStore
+from columnar import ColumnWriter
+import vectorized
+from profiling import stage_metrics, Profiler
+from dir_index import DirectoryIndex, LOG_DATE
+from log_formats import UI_SHORT_FORMAT, compile_log_format, find_log_format
+from dimensions import DIMENSIONS
+from external import SpillFiles, URL_STATS_BYTES, SAMPLE_BYTES
+from aggregate_files import write_aggregate_file, read_aggregate_file
 
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "QUANTILES": "exact",
+    "QUANTILES_COMPRESSION": 100,
+    "WORKERS": 1,
+    "INCREMENTAL": False,
+    "READ_MODE": "text",
+    "URL_NORMALIZATION": {},
+    "MAX_URLS": 0,
+    "EXPORT_DIR": "",
+    "EXPORT_CHUNK_SIZE": 1000000,
+    "STATS_BACKEND": "python",
+    "TIMESERIES_BUCKET": 0,
+    "METRICS_FILE": "",
+    "FOLLOW_FILE": "nginx-access-ui.log",
+    "FOLLOW_WINDOWS": [60, 300, 3600],
+    "FOLLOW_REFRESH": 10,
+    "FOLLOW_POLL": 1.0,
+    "PREFLIGHT": "abort",
+    "DIR_INDEX_FILE": "",
+    "LOG_FILE_PATTERN": "nginx-access-ui.log*",
+    "LOG_FORMATS": {},
+    "HEAVY_HITTERS": 0,
+    "MEMORY_BUDGET_MB": 0,
+    "SPILL_DIR": "",
+    "AGGREGATE_DIR": "",
+    "HOST_NAME": "",
+    "GROUP_BY": [],
+    "UNIQUE_CLIENTS": "",
+    "HLL_PRECISION": 12
 }
 
+REPORT_QUANTILES = (0.9, 0.95, 0.99)
+
+# Начало строки ui_short до кода ответа включительно: ... "$request" $status (url - второе слово в "$request")
+UI_SHORT_PREFIX = re.compile(r'[^"]*"\S+ (\S*/\S*) [^"]*" \d+ ')
+UI_SHORT_PREFIX_BYTES = re.compile(UI_SHORT_PREFIX.pattern.encode())
+# То же с $time_local: ... [$time_local] "$request" $status
+UI_SHORT_RECORD = re.compile(r'[^"\[]*\[([^\]]*)\] "\S+ (\S*/\S*) [^"]*" \d+ ')
+UI_SHORT_RECORD_BYTES = re.compile(UI_SHORT_RECORD.pattern.encode())
+
+MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), start=1
+)}
+
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+PREFLIGHT_SAMPLES = 16  # кол-во случайных позиций в файле для предварительной проверки
+PREFLIGHT_BLOCK_SIZE = 64 * 1024  # сколько байт читаем с каждой позиции (у .gz - начало файла samples * block)
+PREFLIGHT_Z = 3  # запас на ошибку выборки: прерываем, только если нижняя граница оценки (~99.9 %) выше порога
+
+OVERFLOW_URL = '(other)'  # url сверх лимита MAX_URLS учитываются вместе под этим ключом
+
+UUID_SEGMENT = re.compile(r'/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)')
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+REPORT_TEMPLATE_PATH = './report.html'
+TEMPLATE_PLACEHOLDER = re.compile(r'\$(\w+_json)\b')  # $table_json в шаблоне report.html ($ без _json - jQuery)
+
 
 def get_config():
     """
@@ -31,28 +111,58 @@ def get_config():
     """
     parser = argparse.ArgumentParser(description='Чтение настроек из файла конфигурации (--config=*.json)')
     parser.add_argument("--config", required=False, type=str)
-    config_file = parser.parse_args()
+    parser.add_argument("--workers", required=False, type=int)
+    parser.add_argument("--from", required=False, type=int, dest="date_from")  # Сводный отчет за период (YYYYMMDD)
+    parser.add_argument("--to", required=False, type=int, dest="date_to")
+    parser.add_argument("--backfill", required=False, action="store_true")  # Отчеты по всем файлам без отчета
+    parser.add_argument("--profile", required=False, nargs="?", const="./profile")  # Каталог cProfile/tracemalloc
+    parser.add_argument("--follow", required=False, nargs="?", const=True)  # Непрерывный анализ дописываемого файла
+    parser.add_argument("command", nargs="?", choices=["merge"])  # merge файл... - сводный отчет по файлам показателей
+    parser.add_argument("files", nargs="*")
+    opts = parser.parse_args()
 
-    if config_file.config:
-        config_file_name = config_file.config
+    config_data = config
+
+    if opts.config:
+        config_file_name = opts.config
 
         try:
             data = json.load(open(config_file_name))  # Считываем данные конфигурации из файла 'config.json'
 
-            config_data = config
-
             for key, value in data.items():
                 config_data[key] = value
 
-            return config_data
-
         except FileNotFoundError:
             return {'failure': 'Файл конфигурации указан, но не найден.'}
 
         except json.decoder.JSONDecodeError:
-            return config
+            pass
+
+    if opts.workers:  # Параметры командной строки имеют приоритет над файлом конфигурации
+        config_data.update({"WORKERS": opts.workers})
+
+    if opts.date_from or opts.date_to:
+        config_data.update({"ROLLUP_FROM": opts.date_from or opts.date_to, "ROLLUP_TO": opts.date_to or opts.date_from})
+
+    if opts.backfill:
+        config_data.update({"BACKFILL": True})
+
+    if opts.profile:
+        config_data.update({"PROFILE_DIR": opts.profile})
+
+    if opts.follow:
+        config_data.update({"FOLLOW": True})
 
-    return config
+        if opts.follow is not True:
+            config_data.update({"FOLLOW_FILE": opts.follow})
+
+    if opts.command == "merge":
+        if not opts.files:
+            return {'failure': 'Не указаны файлы показателей для объединения.'}
+
+        config_data.update({"MERGE_FILES": opts.files})
+
+    return config_data
 
 
 def setup_logging(configuration, logging_level='info'):
@@ -95,12 +205,25 @@ def find_log_file(file_name_pattern, dir_name):
                 yield entry
 
 
+def get_log_date(file_name):
+    """
+    Дата файла логов из его имени (например 'nginx-access-ui.log-20170630.gz' -> 20170630) или None, если даты нет
+    (текущий nginx-access-ui.log, который еще пишется)
+    """
+    match = LOG_DATE.search(file_name)
+
+    return int(match.group(1)) if match else None
+
+
 def find_latest_date(log_file, recent_date):
     """
     Сравнение даты файла с самой поздней датой ранее проверенного файла. Если дата текущего файла новее, возвращается
     его дата и имя, чтобы далее проводить сравнение данных остальных файлов с ними
     """
-    file_date = int(log_file.name.split('.')[1].split('-')[-1])
+    file_date = get_log_date(log_file.name)
+
+    if file_date is None:
+        return recent_date, None
 
     if recent_date is None:
         return file_date, log_file.name
@@ -131,14 +254,41 @@ def get_recent_log_file(file_iterator):
     return file_name, recent_date
 
 
-def check_report_exist(report_date, report_dir_name):
+def get_report_file_name(report_date, report_date_to=None, prefix='report'):
+    """
+    Имя файла отчета за дату (report-2017.06.30.html) или за период (report-2017.06.26-2017.06.30.html)
+    """
+    report_period = f"{str(report_date)[:4]}.{str(report_date)[4:6]}.{str(report_date)[-2:]}"
+
+    if report_date_to is not None and report_date_to != report_date:
+        report_period += f"-{str(report_date_to)[:4]}.{str(report_date_to)[4:6]}.{str(report_date_to)[-2:]}"
+
+    return f"{prefix}-{report_period}.html"
+
+
+def get_report_index(report_dir_name):
     """
-    Проверяем наличие ранее созданного отчета по файлу с самой новой датой. Если в наличии - останавливаем обработку
+    Имена всех файлов в директории отчетов (один проход по директории для проверки многих дат)
     """
     if not os.path.exists(report_dir_name):
-        return False
+        return set()
 
-    report_file_pattern = f"report-{str(report_date)[:4]}.{str(report_date)[4:6]}.{str(report_date)[-2:]}.html"
+    with os.scandir(path=report_dir_name) as it:
+        return {entry.name for entry in it}
+
+
+def check_report_exist(report_date, report_dir_name, report_index=None):
+    """
+    Проверяем наличие ранее созданного отчета по файлу с самой новой датой. Если в наличии - останавливаем обработку.
+    Если передан report_index (см. get_report_index, DirectoryIndex.get_names) - проверяем по нему, не читая директорию
+    """
+    report_file_pattern = get_report_file_name(report_date)
+
+    if report_index is not None:
+        return report_file_pattern in report_index
+
+    if not os.path.exists(report_dir_name):
+        return False
 
     with os.scandir(path=report_dir_name) as it:
         for entry in it:
@@ -148,6 +298,37 @@ def check_report_exist(report_date, report_dir_name):
     return False
 
 
+def find_pending_log_files(log_dir_name, report_dir_name, dir_index=None, file_name_pattern="nginx-access-ui.log*"):
+    """
+    Все файлы логов с датой в имени, для даты которых еще нет отчета, по возрастанию даты: [(имя файла, дата), ...].
+    Если за дату есть и несжатый, и .gz-файл - берем несжатый. С dir_index (DirectoryIndex) содержимое
+    директорий берется из кэша
+    """
+    if dir_index is not None:
+        report_index = dir_index.get_names(report_dir_name)
+        log_files = dir_index.find_logs(log_dir_name, file_name_pattern)
+    else:
+        report_index = get_report_index(report_dir_name)
+        log_files = []
+
+        for log_file in find_log_file(file_name_pattern, log_dir_name):
+            log_date = get_log_date(log_file.name)
+
+            if log_date is not None:  # по текущему файлу без даты, который еще пишется, отчет не строим
+                log_files.append((log_file.name, log_date))
+
+    pending = {}
+
+    for log_file_name, log_date in log_files:
+        if check_report_exist(log_date, report_dir_name, report_index):
+            continue
+
+        if log_date not in pending or pending[log_date].endswith(".gz"):
+            pending[log_date] = log_file_name
+
+    return [(pending[log_date], log_date) for log_date in sorted(pending)]
+
+
 def process_logs(file_name, log_dir_name):
     """
     Открываем файл и передаем в дальнейшую обработку построчно
@@ -164,6 +345,91 @@ def process_logs(file_name, log_dir_name):
     log.close()
 
 
+def split_file_ranges(file_path, parts, start=0, end=None):
+    """
+    Делим файл (или его часть [start, end)) на диапазоны байтов примерно равного размера,
+    границы выравниваем по концу строки
+    """
+    if end is None:
+        end = os.path.getsize(file_path)
+
+    bounds = [start]
+
+    with open(file_path, 'rb') as log:
+        for i in range(1, parts):
+            log.seek(max(start + (end - start) * i // parts, bounds[-1]))
+            log.readline()  # Дочитываем строку до конца, чтобы граница пришлась на начало следующей
+            position = log.tell()
+
+            if position >= end:
+                break
+
+            if position > bounds[-1]:
+                bounds.append(position)
+
+    bounds.append(end)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def find_lines_end(file_path, start=0, block_size=65536):
+    """
+    Позиция сразу после последнего символа перевода строки в файле (но не меньше start): до нее в файле только
+    полностью записанные строки, а последняя строка дописываемого файла может быть еще неполной
+    """
+    end = os.path.getsize(file_path)
+
+    with open(file_path, 'rb') as log:
+        while end > start:
+            block_start = max(start, end - block_size)
+            log.seek(block_start)
+            position = log.read(end - block_start).rfind(b'\n')
+
+            if position != -1:
+                return block_start + position + 1
+
+            end = block_start
+
+    return start
+
+
+def split_buffer_lines(buffer, start, end, block_size=READ_BLOCK_SIZE):
+    """
+    Делим диапазон [start, end) буфера байтов (mmap) на строки без перевода строки: буфер читается блоками,
+    неполная строка в конце блока переносится в следующий
+    """
+    tail = b''
+
+    for position in range(start, end, block_size):
+        lines = (tail + buffer[position:min(position + block_size, end)]).split(b'\n')
+        tail = lines.pop()
+        yield lines
+
+    if tail:
+        yield [tail]
+
+
+def split_gzip_lines(file_path, block_size=READ_BLOCK_SIZE):
+    """
+    Распаковываем сжатый файл большими блоками и делим их на строки (как split_buffer_lines)
+    """
+    with gzip.open(file_path, 'rb') as log:
+        tail = b''
+
+        while True:
+            block = log.read(block_size)
+
+            if not block:
+                break
+
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop()
+            yield lines
+
+        if tail:
+            yield [tail]
+
+
 def validate_log(log):
     """
     Валидация формата логирования - проверяем: url содержит '/', код ответа 'is_numeric', время приводится к типу float
@@ -181,6 +447,142 @@ def validate_log(log):
         return False
 
 
+def parse_ui_short(line):
+    """
+    Быстрый разбор строки в формате ui_short без split(): регулярное выражение проходит только начало строки
+    до кода ответа и выделяет url из "$request", $request_time берем после последнего пробела. Проверки те же,
+    что в validate_log: url содержит '/', код ответа числовой, время - float.
+    Возвращаем (url, время) или None для невалидной строки
+    """
+    match = UI_SHORT_PREFIX.match(line)
+
+    if match is None:
+        return None
+
+    try:
+        return match.group(1), float(line[line.rfind(' ') + 1:])
+    except ValueError:
+        return None
+
+
+def parse_ui_short_bytes(line):
+    """
+    То же, что parse_ui_short, для строки в байтах: декодируется только url
+    """
+    match = UI_SHORT_PREFIX_BYTES.match(line)
+
+    if match is None:
+        return None
+
+    try:
+        return match.group(1).decode('utf-8', 'replace'), float(line[line.rfind(b' ') + 1:])
+    except ValueError:
+        return None
+
+
+class TimeLocalParser:
+    """
+    Перевод $time_local ('29/Jun/2017:22:50:56 +0300') в секунды от начала эпохи. Начало часа с часовым поясом
+    разбирается один раз и кэшируется, для каждой строки остается сложить минуты и секунды
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def __call__(self, time_local):
+        hour_key = time_local[:14] + time_local[20:]
+        hour_start = self.cache.get(hour_key)
+
+        if hour_start is None:
+            try:
+                offset = int(time_local[22:24]) * 60 + int(time_local[24:26])
+                hour_start = datetime(
+                    int(time_local[7:11]), MONTHS[time_local[3:6]], int(time_local[:2]), int(time_local[12:14]),
+                    tzinfo=timezone(timedelta(minutes=-offset if time_local[21] == '-' else offset))
+                ).timestamp()
+            except (KeyError, ValueError, IndexError):
+                return None
+
+            self.cache[hour_key] = hour_start = int(hour_start)
+
+        try:
+            return hour_start + int(time_local[15:17]) * 60 + int(time_local[18:20])
+        except ValueError:
+            return None
+
+
+def parse_ui_short_record(line, time_parser):
+    """
+    Разбор строки ui_short для выгрузки по колонкам: (url, время ответа, $time_local в секундах) или None
+    """
+    match = UI_SHORT_RECORD.match(line)
+
+    if match is None:
+        return None
+
+    timestamp = time_parser(match.group(1))
+
+    if timestamp is None:
+        return None
+
+    try:
+        return match.group(2), float(line[line.rfind(' ') + 1:]), timestamp
+    except ValueError:
+        return None
+
+
+def parse_ui_short_record_bytes(line, time_parser):
+    """
+    То же, что parse_ui_short_record, для строки в байтах
+    """
+    match = UI_SHORT_RECORD_BYTES.match(line)
+
+    if match is None:
+        return None
+
+    timestamp = time_parser(match.group(1).decode('ascii', 'replace'))
+
+    if timestamp is None:
+        return None
+
+    try:
+        return match.group(2).decode('utf-8', 'replace'), float(line[line.rfind(b' ') + 1:]), timestamp
+    except ValueError:
+        return None
+
+
+def get_line_parser(options=None, binary=False):
+    """
+    Функция разбора строки для настроек сбора показателей: если нужен временной ряд (timeseries_bucket),
+    из строки дополнительно берется $time_local. Если задан формат логов (options['log_format'], см. LogFormat) -
+    строка разбирается по нему, иначе - как ui_short. Если нужны уникальные клиенты (options['unique_clients'])
+    и группировка (options['dimensions']), в конец записи добавляются значение поля клиента и полей измерений
+    (см. DIMENSIONS)
+    """
+    log_format = options.get('log_format') if options else None
+    fields = []
+
+    if options and options.get('unique_clients'):
+        fields.append(options['unique_clients'])
+
+    if options and options.get('dimensions'):
+        fields.extend(DIMENSIONS[name][0] for name in options['dimensions'])
+
+    if fields:
+        log_format = log_format or compile_log_format(UI_SHORT_FORMAT)
+        time_parser = TimeLocalParser() if options.get('timeseries_bucket') else None
+        return log_format.get_fields_parser(fields, time_parser, binary)
+
+    if options and options.get('timeseries_bucket'):
+        if log_format is not None:
+            return log_format.get_record_parser(TimeLocalParser(), binary)
+        return partial(parse_ui_short_record_bytes if binary else parse_ui_short_record, time_parser=TimeLocalParser())
+
+    if log_format is not None:
+        return log_format.parse_bytes if binary else log_format.parse
+    return parse_ui_short_bytes if binary else parse_ui_short
+
+
 def get_url_time(x):
     """
     Вспомогательная функция для сортировки списка словарей по указанному ключу ('time_sum')
@@ -188,6 +590,13 @@ def get_url_time(x):
     return x.get('time_sum')
 
 
+def get_url_stats_time(item):
+    """
+    Ключ отбора пар (url, показатели) по 'time_sum' - с тем же округлением, что и в отчете
+    """
+    return round(item[1]['time_sum'], 3)
+
+
 def time_it(func):
     import time
     def wrapper(*args, **kwargs):  # noqa
@@ -255,169 +664,1920 @@ def check_line(line, log_iterator, first_time=True):
     return checked_data
 
 
-@time_it
-def process_lines(line_iterator, file_name, log_dir_name, report_size, fail_coefficient=20):
+class UrlNormalizer:
     """
-    Вычисляем показатели по каждому валидному логу и добавляем список, сортируем его и возвращаем заданного размера
+    Приведение url к общему виду перед подсчетом показателей: сначала применяются правила пользователя
+    (регулярное выражение, замена), затем отбрасываются параметры запроса и/или числовые и UUID-сегменты пути
+    заменяются на '{id}' и '{uuid}'. Результаты кэшируются - повторяющиеся url не разбираются заново
     """
-    try:
-        urls_done = []
-        urls_data_list = []
 
-        first_time = True
-        logs_validated = True
+    def __init__(self, strip_query=False, collapse_ids=False, rules=(), cache_size=65536):
+        self.strip_query = strip_query
+        self.collapse_ids = collapse_ids
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.cache_size = cache_size
+        self.cache = {}
 
-        while True:
-            if not logs_validated:
-                break
-            try:
-                line = next(line_iterator)
-                line_list = line.split()
+    def __call__(self, url):
+        normalized = self.cache.get(url)
 
-                if not validate_log(line_list):
-                    continue
+        if normalized is None:
+            normalized = self.normalize(url)
 
-                line_url = line_list[6]
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
 
-                if line_url in urls_done:
-                    continue
+            self.cache[url] = normalized
 
-                log_iterator = process_logs(file_name, log_dir_name)
+        return normalized
 
-                res = check_line(line_url, log_iterator, first_time)
+    def normalize(self, url):
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
 
-                if first_time:
-                    first_time = False
+        path, sep, query = url.partition('?')
 
-                    total_count = res.get('total_count')
-                    total_time = res.get('total_time')
-                    invalid_count = res.get('invalid_count')
+        if self.collapse_ids:
+            path = ID_SEGMENT.sub('/{id}', UUID_SEGMENT.sub('/{uuid}', path))
 
-                    logging.info(f"Всего логов, включая невалидные: {total_count} шт.")
+        if self.strip_query:
+            return path
 
-                    validity_perc = invalid_count / total_count * 100
-                    logging.info(f"Невалидные логи: {validity_perc:.2f} % (допустимо: {fail_coefficient} %).")
+        return path + sep + query
 
-                    if validity_perc > fail_coefficient:  # Проверяем превышение порога валидности логов
-                        logs_validated = False
-                        logging.info(f"Превышен порог погрешности ({fail_coefficient} %).")
-                        break
 
-                line_count_perc = res.get('line_count') / total_count * 100
-                line_time_sum_perc = res.get('line_time_sum') / total_time * 100
-                line_time_avg = res.get('line_time_sum') / res.get('line_count')
-                line_time_max = max(res.get('line_time_list'))
-                line_time_median = median(res.get('line_time_list'))
+def make_url_normalizer(settings):
+    """
+    Создаем нормализатор url по настройкам из конфига ("URL_NORMALIZATION") или None, если нормализация не нужна
+    """
+    if not settings:
+        return None
 
-                urls_done.append(line_url)
+    normalizer = UrlNormalizer(
+        strip_query=settings.get('strip_query', False),
+        collapse_ids=settings.get('collapse_ids', False),
+        rules=settings.get('rules', ())
+    )
 
-                urls_data_list.append({
-                    'url': line_url,
-                    'count': res.get('line_count'),
-                    'count_perc': line_count_perc,
-                    'time_sum': round(res.get('line_time_sum'), 3),
-                    'time_perc': round(line_time_sum_perc, 3),
-                    'time_avg': round(line_time_avg, 3),
-                    'time_max': line_time_max,
-                    'time_med': round(line_time_median, 3)
-                })
+    if not (normalizer.strip_query or normalizer.collapse_ids or normalizer.rules):
+        return None
 
-            except StopIteration:
-                break
+    return normalizer
 
-        if not logs_validated:
-            return None
 
-        urls_data_list.sort(reverse=True, key=get_url_time)
+def make_aggregate_options(quantiles='exact', compression=100, url_normalization=None, max_urls=0,
+                           stats_backend='python', timeseries_bucket=0, log_format=None, heavy_hitters=0,
+                           memory_budget_mb=0, spill_dir=None, dimensions=(), unique_clients=None, hll_precision=12):
+    """
+    Настройки сбора показателей, общие для всех способов чтения файла (передаются и в процессы-обработчики).
+    log_format - строка nginx log_format (None - ui_short), heavy_hitters - кол-во отслеживаемых url
+    в приближенном режиме (0 - показатели по всем url, см. aggregate_heavy_hitters), memory_budget_mb - бюджет
+    памяти таблицы url, сверх которого она сбрасывается на диск в spill_dir (см. aggregate_records_external),
+    dimensions - имена измерений из DIMENSIONS, по которым показатели группируются в том же проходе,
+    unique_clients - поле log_format с идентификатором клиента для оценки кол-ва клиентов url (HyperLogLog
+    точности hll_precision, см. track_unique_clients)
+    """
+    return {
+        'quantiles': quantiles,
+        'samples_factory': make_samples_factory(quantiles, compression),
+        'url_normalizer': make_url_normalizer(url_normalization),
+        'max_urls': max_urls or 0,
+        'stats_backend': stats_backend,
+        'timeseries_bucket': timeseries_bucket or 0,
+        'log_format': compile_log_format(log_format) if log_format else None,
+        'heavy_hitters': heavy_hitters or 0,
+        'memory_budget': (memory_budget_mb or 0) * 1024 * 1024,
+        'spill_dir': spill_dir or None,
+        'dimensions': tuple(dimensions or ()),
+        'unique_clients': unique_clients or None,
+        'hll_precision': hll_precision or 12
+    }
 
-        if len(urls_data_list) >= report_size:
-            return urls_data_list[0:report_size]
 
-        return urls_data_list
+def choose_stats_backend(stats_backend, quantiles='exact', workers=1, store=None):
+    """
+    Векторный расчет показателей (stats_backend='numpy') возможен, если установлен numpy, медиана точная и файл
+    обрабатывается целиком в одном процессе - иначе показатели считаются в цикле Python
+    """
+    if stats_backend != 'numpy':
+        return 'python'
 
-    except KeyboardInterrupt:
-        logging.exception(msg="Обработка логов остановлена.")
-        return {'failure': 'Принудительная остановка.'}
+    if vectorized.numpy is None:
+        logging.info("numpy не установлен - показатели будут рассчитаны без него (STATS_BACKEND: python).")
+        return 'python'
 
+    if quantiles != 'exact' or workers > 1 or store is not None:
+        logging.info("STATS_BACKEND numpy используется только для точной медианы без --workers и INCREMENTAL.")
+        return 'python'
 
-def create_report_file(final_data, file_date, dir_path):
+    return 'numpy'
+
+
+def new_url_stats(log_time, samples_factory=ExactSamples):
     """
-    Создаем файл и записываем текст шаблона + обработанные данные логов
+    Создаем накопитель показателей для нового url по первому найденному для него логу
     """
+    samples = samples_factory()
+    samples.add(log_time)
+
+    return {
+        'count': 1,
+        'time_sum': log_time,
+        'time_max': log_time,
+        'samples': samples
+    }
 
-    report_file_name = f"report-{str(file_date)[:4]}.{str(file_date)[4:6]}.{str(file_date)[-2:]}.html"
 
-    if not os.path.exists(dir_path):
-        os.mkdir(dir_path)
+def track_timeseries(records, timeseries, bucket_size):
+    """
+    Раскладываем время ответа по интервалам $time_local длиной bucket_size секунд (гистограмма на интервал)
+    и передаем записи (url, время) дальше - в сбор показателей по url
+    """
+    for record in records:
+        if record is None:
+            yield None
+            continue
 
-    file_path = os.path.join(dir_path, report_file_name)
+        log_url, log_time, timestamp = record
+        bucket = timestamp - timestamp % bucket_size
 
-    report_template_path = './report.html'
+        histogram = timeseries.get(bucket)
 
-    data = ''
+        if histogram is None:
+            histogram = timeseries[bucket] = LogHistogram()
 
-    try:
-        with open(report_template_path, 'r', encoding='utf-8') as html_file:
-            tmp = html_file.readlines()
+        histogram.add(log_time)
 
-            for i in tmp:
-                x = re.search(r'\$table_json', i)
-                if x:
-                    data += f'    var table = {final_data};\n'
-                else:
-                    data += i
+        yield log_url, log_time
 
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(data)
 
-        return {'ok': '----- Анализ завершен ----'}
+def track_dimensions(records, groups, dimensions):
+    """
+    Собираем показатели времени ответа по значениям измерений (код ответа, метод, ...) - значения в конце записи,
+    по одному на измерение; гистограмма вместо всех значений: различных значений мало, а медиана и квантили
+    по гистограмме складываются между частями файла. Записи без значений измерений передаются дальше
+    """
+    transforms = [(groups[name], DIMENSIONS[name][1]) for name in dimensions]
+    size = len(dimensions)
 
-    except FileNotFoundError:
-        return {'failure': 'Невозможно создать файл с отчетом: файл c HTML-шаблоном не найден.'}
+    for record in records:
+        if record is None:
+            yield None
+            continue
 
+        log_time = record[1]
 
-def main():
-    actual_conf = get_config()
+        for (values_stats, transform), value in zip(transforms, record[-size:]):
+            if transform is not None:
+                value = transform(value)
 
-    if actual_conf.get('failure'):
-        logging.error(f"{actual_conf.get('failure')}")
-        sys.exit()
+            value_stats = values_stats.get(value)
 
-    setup_logging(actual_conf, logging_level='info')
+            if value_stats is None:
+                values_stats[value] = new_url_stats(log_time, LogHistogram)
+                continue
 
-    logging.info("----- Анализ в процессе -----")
+            value_stats['count'] += 1
+            value_stats['time_sum'] += log_time
+            value_stats['samples'].add(log_time)
 
-    gen_log_files = find_log_file("nginx-access-ui.log*", actual_conf.get("LOG_DIR"))
+            if log_time > value_stats['time_max']:
+                value_stats['time_max'] = log_time
 
-    log_file_name, report_date = get_recent_log_file(gen_log_files)
+        yield record[:-size]
 
-    if check_report_exist(report_date, actual_conf.get("REPORT_DIR")):
-        logging.error('Отчет за указанную дату уже создан.')
-        sys.exit()
 
-    gen_lines = process_logs(log_file_name, actual_conf.get("LOG_DIR"))
+def track_unique_clients(records, unique_clients, options):
+    """
+    Оцениваем кол-во различных клиентов каждого url: значение поля клиента (в конце записи) добавляется
+    в HyperLogLog url, пустое значение ('-') не учитывается. Url нормализуются здесь и после max_urls различных
+    url заменяются на OVERFLOW_URL - так же, как в aggregate_records, поэтому у каждого url таблицы есть оценка.
+    Записи без поля клиента передаются дальше
+    """
+    url_normalizer = options['url_normalizer']
+    max_urls = options['max_urls']
+    precision = options['hll_precision']
 
-    try:
-        urls = process_lines(
-            gen_lines,
-            log_file_name,
-            actual_conf.get("LOG_DIR"),
-            actual_conf.get("REPORT_SIZE"),
-            fail_coefficient=50  # Установить порог валидности логов в %
-        )
+    for record in records:
+        if record is None:
+            yield None
+            continue
 
-        if not isinstance(urls, list):
-            if not urls:
-                logging.error("Обработка логов невозможна. Проверьте формат логирования.")
-            else:
-                logging.error(f"Причина: {urls.get('failure')}")
-            sys.exit()
+        log_url = record[0]
 
-    except Exception as e:
-        logging.exception(msg=f"Обработка логов остановлена. Причина: {e}", exc_info=True)
-        sys.exit()
+        if url_normalizer is not None:
+            log_url = url_normalizer(log_url)
+
+        clients = unique_clients.get(log_url)
+
+        if clients is None:
+            if max_urls and len(unique_clients) >= max_urls:
+                log_url = OVERFLOW_URL
+                clients = unique_clients.get(log_url)
+
+            if clients is None:
+                clients = unique_clients[log_url] = HyperLogLog(precision)
+
+        if record[-1] not in ('-', ''):
+            clients.add(record[-1])
+
+        yield (log_url,) + record[1:-1]
+
+
+def aggregate_records(records, options=None):
+    """
+    За один проход по разобранным логам (url, время) или None для невалидной строки собираем показатели по каждому
+    url (кол-во, сумма и максимум времени, значения времени для медианы - все или в виде t-digest), а также общее
+    кол-во логов, общее время и кол-во невалидных.
+    Url предварительно нормализуются (если задано), а после MAX_URLS различных url новые учитываются в OVERFLOW_URL.
+    Если задан timeseries_bucket - записи содержат и $time_local, дополнительно собирается временной ряд
+    ('timeseries': начало интервала -> LogHistogram). Если заданы dimensions - в том же проходе собираются
+    показатели по значениям каждого измерения ('dimensions': измерение -> значение -> показатели), если задан
+    unique_clients - оценка кол-ва различных клиентов url ('clients' в показателях url, см. track_unique_clients)
+    """
+    if options is None:
+        options = make_aggregate_options()
+
+    dimensions = options.get('dimensions')
+
+    if dimensions:
+        groups = {name: {} for name in dimensions}
+        aggregated = aggregate_records(track_dimensions(records, groups, dimensions), dict(options, dimensions=()))
+        aggregated['dimensions'] = groups
+        return aggregated
+
+    if options.get('unique_clients'):
+        unique_clients = {}
+        aggregated = aggregate_records(track_unique_clients(records, unique_clients, options),
+                                       dict(options, unique_clients=None, url_normalizer=None))
+
+        for url, url_stats in aggregated['urls'].items():
+            url_stats['clients'] = unique_clients[url]
+
+        return aggregated
+
+    timeseries_bucket = options.get('timeseries_bucket')
+
+    if timeseries_bucket:
+        timeseries = {}
+        aggregated = aggregate_records(track_timeseries(records, timeseries, timeseries_bucket),
+                                       dict(options, timeseries_bucket=0))
+        aggregated['timeseries'] = timeseries
+        return aggregated
+
+    if options.get('heavy_hitters'):
+        return aggregate_heavy_hitters(records, options)
+
+    if options.get('memory_budget'):
+        return aggregate_records_external(records, options)
+
+    if options.get('stats_backend') == 'numpy':
+        return collect_records(records, options)
+
+    samples_factory = options['samples_factory']
+    url_normalizer = options['url_normalizer']
+    max_urls = options['max_urls']
+
+    urls_stats = {}
+    total_count = 0
+    total_time = 0.0
+    invalid_count = 0
+
+    for record in records:
+        total_count += 1
+
+        if record is None:
+            invalid_count += 1
+            continue
+
+        log_url, log_time = record
+
+        total_time += log_time
+
+        if url_normalizer is not None:
+            log_url = url_normalizer(log_url)
+
+        url_stats = urls_stats.get(log_url)
+
+        if url_stats is None:
+            if max_urls and len(urls_stats) >= max_urls:
+                url_stats = urls_stats.get(OVERFLOW_URL)
+                log_url = OVERFLOW_URL
+
+            if url_stats is None:
+                urls_stats[log_url] = new_url_stats(log_time, samples_factory)
+                continue
+
+        url_stats['count'] += 1
+        url_stats['time_sum'] += log_time
+        url_stats['samples'].add(log_time)
+
+        if log_time > url_stats['time_max']:
+            url_stats['time_max'] = log_time
+
+    return {
+        'urls': urls_stats,
+        'total_count': total_count,
+        'total_time': total_time,
+        'invalid_count': invalid_count
+    }
+
+
+def aggregate_heavy_hitters(records, options):
+    """
+    Приближенный режим (HEAVY_HITTERS): память не зависит от кол-ва различных url. Url с наибольшим time_sum
+    отбираются взвешенным Space-Saving (см. SpaceSaving) на options['heavy_hitters'] url, точные показатели
+    (кол-во, время, медиана) ведутся только для отслеживаемых url - с момента, когда url попал в таблицу.
+    time_sum такого url занижен не больше чем на его ошибку ('heavy_hitters'.errors), а любой url, не попавший
+    в таблицу, суммарно занял не больше threshold секунд. Общие кол-во и время - точные
+    """
+    samples_factory = options['samples_factory']
+    url_normalizer = options['url_normalizer']
+    heavy_hitters = SpaceSaving(options['heavy_hitters'])
+
+    urls_stats = {}
+    total_count = 0
+    total_time = 0.0
+    invalid_count = 0
+
+    for record in records:
+        total_count += 1
+
+        if record is None:
+            invalid_count += 1
+            continue
+
+        log_url, log_time = record
+
+        total_time += log_time
+
+        if url_normalizer is not None:
+            log_url = url_normalizer(log_url)
+
+        evicted = heavy_hitters.add(log_url, log_time)
+        url_stats = urls_stats.get(log_url)
+
+        if url_stats is None:
+            if evicted is not None:
+                del urls_stats[evicted]
+
+            urls_stats[log_url] = new_url_stats(log_time, samples_factory)
+            continue
+
+        url_stats['count'] += 1
+        url_stats['time_sum'] += log_time
+        url_stats['samples'].add(log_time)
+
+        if log_time > url_stats['time_max']:
+            url_stats['time_max'] = log_time
+
+    return {
+        'urls': urls_stats,
+        'total_count': total_count,
+        'total_time': total_time,
+        'invalid_count': invalid_count,
+        'heavy_hitters': heavy_hitters
+    }
+
+
+def aggregate_records_external(records, options):
+    """
+    То же, что aggregate_records (точная медиана, без MAX_URLS), с ограничением памяти таблицы url: когда ее
+    примерный объем превышает options['memory_budget'], таблица сбрасывается на диск (отсортированной по url,
+    см. SpillFiles) и собирается заново. Если сбросов не было - результат как у aggregate_records, иначе
+    показатели url объединяются при отборе топ-url (см. build_urls_data_external)
+    """
+    url_normalizer = options['url_normalizer']
+    memory_budget = options['memory_budget']
+    spill_files = SpillFiles(options.get('spill_dir'))
+
+    urls_stats = {}
+    first_seen = {}  # номер строки первого появления url - порядок url при равном time_sum
+    table_bytes = 0
+    total_count = 0
+    total_time = 0.0
+    invalid_count = 0
+
+    try:
+        for record in records:
+            total_count += 1
+
+            if record is None:
+                invalid_count += 1
+                continue
+
+            log_url, log_time = record
+
+            total_time += log_time
+
+            if url_normalizer is not None:
+                log_url = url_normalizer(log_url)
+
+            url_stats = urls_stats.get(log_url)
+
+            if url_stats is None:
+                urls_stats[log_url] = new_url_stats(log_time)
+                first_seen[log_url] = total_count
+                table_bytes += URL_STATS_BYTES + len(log_url)
+            else:
+                url_stats['count'] += 1
+                url_stats['time_sum'] += log_time
+                url_stats['samples'].add(log_time)
+
+                if log_time > url_stats['time_max']:
+                    url_stats['time_max'] = log_time
+
+                table_bytes += SAMPLE_BYTES
+
+            if table_bytes > memory_budget:
+                spill_files.spill(urls_stats, first_seen)
+                urls_stats = {}
+                first_seen = {}
+                table_bytes = 0
+
+        if spill_files.runs and urls_stats:
+            spill_files.spill(urls_stats, first_seen)
+            urls_stats = {}
+
+    except BaseException:
+        spill_files.close()
+        raise
+
+    aggregated = {
+        'urls': urls_stats,
+        'total_count': total_count,
+        'total_time': total_time,
+        'invalid_count': invalid_count
+    }
+
+    if spill_files.runs:
+        logging.info(f"Таблица url превысила бюджет памяти, сбросов на диск: {len(spill_files.runs)}.")
+        aggregated['spill_files'] = spill_files
+    else:
+        spill_files.close()
+
+    return aggregated
+
+
+def collect_records(records, options):
+    """
+    Для векторного расчета (STATS_BACKEND numpy): вместо показателей по каждому url собираем колонки -
+    номер url (в порядке первого появления) и время ответа, показатели считаются потом сразу для всех url
+    """
+    url_normalizer = options['url_normalizer']
+    max_urls = options['max_urls']
+
+    url_ids = {}
+    ids_column = array('I')
+    times_column = array('d')
+    add_id = ids_column.append
+    add_time = times_column.append
+    total_count = 0
+    total_time = 0.0
+    invalid_count = 0
+
+    for record in records:
+        total_count += 1
+
+        if record is None:
+            invalid_count += 1
+            continue
+
+        log_url, log_time = record
+
+        total_time += log_time
+
+        if url_normalizer is not None:
+            log_url = url_normalizer(log_url)
+
+        url_id = url_ids.get(log_url)
+
+        if url_id is None:
+            if max_urls and len(url_ids) >= max_urls:
+                log_url = OVERFLOW_URL
+                url_id = url_ids.get(log_url)
+
+            if url_id is None:
+                url_id = url_ids[log_url] = len(url_ids)
+
+        add_id(url_id)
+        add_time(log_time)
+
+    return {
+        'urls': url_ids,
+        'url_ids': ids_column,
+        'times': times_column,
+        'total_count': total_count,
+        'total_time': total_time,
+        'invalid_count': invalid_count
+    }
+
+
+def aggregate_lines(line_iterator, options=None, line_parser=None):
+    """
+    Собираем показатели по строкам логов (str), разбирая каждую строку функцией line_parser
+    (по-умолчанию - подходящей для настроек, см. get_line_parser)
+    """
+    if line_parser is None:
+        line_parser = get_line_parser(options)
+
+    return aggregate_records(map(line_parser, line_iterator), options)
+
+
+def aggregate_file_range(file_path, start, end, options=None):
+    """
+    Собираем показатели по диапазону байтов [start, end) несжатого файла через mmap (в т.ч. задача для
+    процесса-обработчика при параллельной обработке)
+    """
+    if start >= end:
+        return aggregate_records((), options)
+
+    with open(file_path, 'rb') as log, mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        lines = chain.from_iterable(split_buffer_lines(buffer, start, end))
+        return aggregate_records(map(get_line_parser(options, binary=True), lines), options)
+
+
+def aggregate_log_file(file_name, log_dir_name, options=None):
+    """
+    Собираем показатели по файлу целиком, читая его как байты: несжатый - через mmap, сжатый - большими блоками
+    """
+    file_path = os.path.join(log_dir_name, file_name)
+
+    if file_name.endswith(".gz"):
+        lines = chain.from_iterable(split_gzip_lines(file_path))
+        return aggregate_records(map(get_line_parser(options, binary=True), lines), options)
+
+    return aggregate_file_range(file_path, 0, os.path.getsize(file_path), options)
+
+
+def merge_url_stats(url_stats, other_stats):
+    """
+    Добавляем показатели url из другой части файла (или другого файла)
+    """
+    url_stats['count'] += other_stats['count']
+    url_stats['time_sum'] += other_stats['time_sum']
+    url_stats['samples'].merge(other_stats['samples'])
+
+    if other_stats['time_max'] > url_stats['time_max']:
+        url_stats['time_max'] = other_stats['time_max']
+
+    if 'clients' in other_stats:
+        if 'clients' in url_stats:
+            url_stats['clients'].merge(other_stats['clients'])
+        else:
+            url_stats['clients'] = other_stats['clients']
+
+
+def merge_timeseries(timeseries, other_timeseries, bucket_size=0):
+    """
+    Добавляем гистограммы интервалов other_timeseries к timeseries. Если задан bucket_size - интервалы
+    укрупняются до него (например, поминутный ряд в почасовой)
+    """
+    for bucket, histogram in other_timeseries.items():
+        if bucket_size:
+            bucket -= bucket % bucket_size
+
+        target_histogram = timeseries.get(bucket)
+
+        if target_histogram is None:
+            timeseries[bucket] = histogram
+        else:
+            target_histogram.merge(histogram)
+
+    return timeseries
+
+
+def merge_aggregates(target, other, max_urls=0):
+    """
+    Объединяем частичные показатели (other добавляется к target). Частичные результаты нужно объединять в порядке
+    следования диапазонов в файле - тогда порядок url совпадает с последовательной обработкой.
+    Новые url сверх лимита max_urls добавляются к OVERFLOW_URL
+    """
+    target['total_count'] += other['total_count']
+    target['total_time'] += other['total_time']
+    target['invalid_count'] += other['invalid_count']
+
+    if 'timeseries' in other:
+        merge_timeseries(target.setdefault('timeseries', {}), other['timeseries'])
+
+    for name, other_values in other.get('dimensions', {}).items():
+        values_stats = target.setdefault('dimensions', {}).setdefault(name, {})
+
+        for value, other_stats in other_values.items():
+            if value in values_stats:
+                merge_url_stats(values_stats[value], other_stats)
+            else:
+                values_stats[value] = other_stats
+
+    urls_stats = target['urls']
+
+    if 'heavy_hitters' in other:  # остаются url, отслеживаемые после объединения таблиц Space-Saving
+        heavy_hitters = target['heavy_hitters'].merge(other['heavy_hitters'])
+
+        for url, other_stats in other['urls'].items():
+            if url in urls_stats:
+                merge_url_stats(urls_stats[url], other_stats)
+            else:
+                urls_stats[url] = other_stats
+
+        target['urls'] = {url: url_stats for url, url_stats in urls_stats.items() if url in heavy_hitters.counters}
+        return target
+
+    for url, other_stats in other['urls'].items():
+        url_stats = urls_stats.get(url)
+
+        if url_stats is None and max_urls and len(urls_stats) >= max_urls:
+            url = OVERFLOW_URL
+            url_stats = urls_stats.get(url)
+
+        if url_stats is None:
+            urls_stats[url] = other_stats
+        else:
+            merge_url_stats(url_stats, other_stats)
+
+    return target
+
+
+def limit_urls(aggregated, max_urls):
+    """
+    Применяем лимит max_urls к показателям, собранным без лимита (частям файла, новым строкам, дням): первые
+    max_urls url в порядке появления остаются, остальные объединяются в OVERFLOW_URL - как при сборе с лимитом
+    за один проход. Части собираются без лимита, иначе url, уже учтенный в объединенной таблице, мог попасть
+    в OVERFLOW_URL своей части и его показатели были бы занижены
+    """
+    if not max_urls or len(aggregated['urls']) <= max_urls:
+        return aggregated
+
+    urls_stats = {}
+
+    for url, url_stats in aggregated['urls'].items():
+        if url not in urls_stats and len(urls_stats) >= max_urls:
+            url = OVERFLOW_URL
+
+        if url not in urls_stats:
+            # показатели OVERFLOW_URL копируются: к ним добавляются показатели других url
+            urls_stats[url] = copy.deepcopy(url_stats) if url == OVERFLOW_URL else url_stats
+        else:
+            merge_url_stats(urls_stats[url], url_stats)
+
+    return dict(aggregated, urls=urls_stats)
+
+
+def aggregate_file_parallel(file_name, log_dir_name, workers, options=None, start=0, end=None):
+    """
+    Делим файл (или его часть [start, end)) на диапазоны и собираем показатели в пуле из workers процессов,
+    затем объединяем результаты. Диапазоны собираются без лимита url, лимит применяется к объединенным
+    показателям (см. limit_urls)
+    """
+    file_path = os.path.join(log_dir_name, file_name)
+    ranges = split_file_ranges(file_path, workers, start, end) or [(start, start)]
+    max_urls = options['max_urls'] if options else 0
+    range_options = dict(options, max_urls=0) if max_urls else options
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+        futures = [
+            executor.submit(aggregate_file_range, file_path, start, end, range_options)
+            for start, end in ranges
+        ]
+        parts = [future.result() for future in futures]
+
+    aggregated = parts[0]
+
+    for part in parts[1:]:
+        merge_aggregates(aggregated, part)
+
+    return limit_urls(aggregated, max_urls)
+
+
+def check_new_data(store, file_name, log_dir_name):
+    """
+    Проверяем, появились ли в файле данные, которые еще не учтены в сохраненных показателях
+    (файл дописан, заменен другим файлом с тем же именем или обрезан). Сохраняется позиция после последней
+    полной строки, поэтому неполная последняя строка (файл без перевода строки в конце) новыми данными не считается
+    """
+    info = store.get_log_info(file_name)
+
+    if info is None:
+        return False
+
+    file_path = os.path.join(log_dir_name, file_name)
+    stat = os.stat(file_path)
+
+    if info['inode'] != stat.st_ino or info['offset'] > stat.st_size:
+        return True
+
+    return find_lines_end(file_path, info['offset']) > info['offset']
+
+
+def aggregate_incremental(store, file_name, log_dir_name, options=None, workers=1):
+    """
+    Собираем показатели с учетом сохраненных ранее: обрабатываем только байты после сохраненной позиции и добавляем
+    их к сохраненным показателям. Если файл был заменен/обрезан или изменился режим медианы (или интервал
+    временного ряда) - обрабатываем заново.
+    Сохраняются только полностью записанные строки; неполная последняя строка учитывается в отчете, но будет
+    прочитана заново при следующем запуске.
+    Показатели собираются и сохраняются без лимита url, лимит применяется к возвращаемым (см. limit_urls) -
+    так сводный отчет за период (rollup_aggregates) тоже совпадает с обработкой всех файлов подряд
+    """
+    if options is None:
+        options = make_aggregate_options()
+
+    quantiles = options['quantiles']
+    max_urls = options['max_urls']
+    options = dict(options, max_urls=0)
+    timeseries_bucket = options.get('timeseries_bucket', 0)
+
+    file_path = os.path.join(log_dir_name, file_name)
+    stat = os.stat(file_path)
+
+    loaded = store.load(file_name)
+    aggregated = None
+    offset = 0
+
+    if loaded:
+        aggregated, info = loaded
+
+        if (info['inode'] == stat.st_ino and info['offset'] <= stat.st_size and info['quantiles'] == quantiles
+                and info['timeseries_bucket'] == timeseries_bucket):
+            offset = info['offset']
+            logging.info(f"Найдены сохраненные показатели, обработка продолжается с байта {offset}.")
+        else:
+            aggregated = None
+            logging.info("Сохраненные показатели не подходят для файла, выполняется полная обработка.")
+
+    if file_name.endswith(".gz"):  # Сжатый файл не дописывается - обрабатываем его целиком один раз
+        if aggregated is None or offset != stat.st_size:
+            aggregated = aggregate_log_file(file_name, log_dir_name, options)
+            store.save(file_name, get_log_date(file_name), aggregated, stat.st_ino, stat.st_size, quantiles,
+                       timeseries_bucket=timeseries_bucket)
+        return limit_urls(aggregated, max_urls)
+
+    end = find_lines_end(file_path, offset)
+
+    if workers > 1:
+        new_aggregated = aggregate_file_parallel(file_name, log_dir_name, workers, options, offset, end)
+    else:
+        new_aggregated = aggregate_file_range(file_path, offset, end, options)
+
+    if aggregated is None:
+        aggregated = new_aggregated
+        touched_urls = None
+    else:
+        # Сохраняем только затронутые url: сначала новые (в порядке появления), затем уже известные
+        known_urls = aggregated['urls']
+        new_urls = [url for url in new_aggregated['urls'] if url not in known_urls]
+        old_urls = [url for url in new_aggregated['urls'] if url in known_urls]
+
+        merge_aggregates(aggregated, new_aggregated)
+
+        touched_urls = new_urls + old_urls
+
+    store.save(file_name, get_log_date(file_name), aggregated, stat.st_ino, end, quantiles, touched_urls,
+               timeseries_bucket)
+
+    if end < stat.st_size:
+        merge_aggregates(aggregated, aggregate_file_range(file_path, end, stat.st_size, options))
+
+    return limit_urls(aggregated, max_urls)
+
+
+def rollup_aggregates(store, date_from, date_to, quantiles='exact', max_urls=0, timeseries_bucket=0):
+    """
+    Объединяем сохраненные показатели всех файлов за период [date_from, date_to] без повторного чтения логов.
+    Файлы, обработанные с другим режимом медианы, пропускаем. Временные ряды файлов укрупняются до
+    timeseries_bucket секунд (если задан). Лимит url применяется к показателям за весь период
+    """
+    aggregated = None
+    dates_done = set()
+
+    for info in store.get_logs_info(date_from, date_to):
+        if info['quantiles'] != quantiles:
+            logging.info(f"Пропускаем {info['log_name']}: показатели сохранены в режиме '{info['quantiles']}'.")
+            continue
+
+        log_aggregated, _ = store.load(info['log_name'])
+        dates_done.add(info['log_date'])
+
+        if timeseries_bucket and 'timeseries' in log_aggregated:
+            log_aggregated['timeseries'] = merge_timeseries({}, log_aggregated['timeseries'], timeseries_bucket)
+
+        if aggregated is None:
+            aggregated = log_aggregated
+        else:
+            merge_aggregates(aggregated, log_aggregated)
+
+    day = datetime.strptime(str(date_from), '%Y%m%d')
+    last_day = datetime.strptime(str(date_to), '%Y%m%d')
+
+    while day <= last_day:
+        if int(day.strftime('%Y%m%d')) not in dates_done:
+            logging.info(f"Нет сохраненных показателей за {day.strftime('%Y.%m.%d')}.")
+        day += timedelta(days=1)
+
+    if aggregated is None:
+        return None
+
+    return limit_urls(aggregated, max_urls)
+
+
+def create_rollup_report(configuration):
+    """
+    Сводный отчет за период из сохраненных показателей (см. "INCREMENTAL")
+    """
+    date_from = configuration.get("ROLLUP_FROM")
+    date_to = configuration.get("ROLLUP_TO")
+
+    store = AggregateStore(configuration.get("REPORT_DIR"))
+
+    with stage_metrics.stage('load') as stage:
+        aggregated = rollup_aggregates(
+            store, date_from, date_to, configuration.get("QUANTILES"), configuration.get("MAX_URLS"),
+            configuration.get("TIMESERIES_BUCKET")
+        )
+        stage['lines'] = aggregated.get('total_count') if aggregated else 0
+
+    if aggregated is None:
+        return {'failure': 'Нет сохраненных показателей за указанный период.'}
+
+    logging.info(f"Всего логов за период, включая невалидные: {aggregated.get('total_count')} шт.")
+
+    with stage_metrics.stage('select') as stage:
+        urls = build_urls_data(aggregated, configuration.get("REPORT_SIZE"))
+        report_sections = build_report_sections(aggregated)
+        stage['lines'] = len(aggregated['urls'])
+
+    return create_report_file(urls, date_from, configuration.get("REPORT_DIR"), date_to, report_sections)
+
+
+def sample_log_lines(file_path, samples=PREFLIGHT_SAMPLES, block_size=PREFLIGHT_BLOCK_SIZE, seed=0):
+    """
+    Выборка строк файла без чтения его целиком: блоки с samples случайных позиций, начало блока сдвигается
+    к началу следующей строки. Небольшой файл читается целиком, у .gz берем начало (произвольный доступ невозможен).
+    Возвращаем (строки в байтах, прочитан ли файл целиком)
+    """
+    budget = samples * block_size
+
+    if file_path.endswith(".gz"):
+        with gzip.open(file_path, 'rb') as log:
+            data = log.read(budget + 1)
+        whole = len(data) <= budget
+        lines = data[:budget].split(b'\n')
+        return (lines if whole else lines[:-1]), whole
+
+    size = os.path.getsize(file_path)
+
+    with open(file_path, 'rb') as log:
+        if size <= budget:
+            return log.read().split(b'\n'), True
+
+        rnd = random.Random(seed)
+        lines = []
+
+        for offset in sorted(rnd.randrange(size - block_size) for _ in range(samples)):
+            log.seek(offset)
+            block = log.read(block_size).split(b'\n')
+            lines.extend(block[1:-1])  # первая и последняя строки блока неполные
+
+    return lines, False
+
+
+def preflight_check(file_name, log_dir_name, fail_coefficient, mode='abort', line_parser=parse_ui_short_bytes):
+    """
+    Быстрая предварительная проверка доли невалидных логов по выборке строк (см. sample_log_lines) - до полного
+    прохода по файлу. При mode='abort' возвращаем False, если доля невалидных заведомо (с учетом ошибки выборки)
+    выше fail_coefficient, при mode='warn' - только предупреждаем. Точная доля все равно считается при обработке.
+    line_parser - разбор строки в байтах (см. get_line_parser)
+    """
+    started = time.perf_counter()
+    lines, whole = sample_log_lines(os.path.join(log_dir_name, file_name))
+    lines = [line for line in lines if line]
+
+    if not lines:
+        return True
+
+    invalid_ratio = sum(1 for line in lines if line_parser(line) is None) / len(lines)
+    threshold = fail_coefficient / 100
+
+    if whole:
+        lower_bound = invalid_ratio
+    else:  # нижняя граница доверительного интервала Уилсона
+        n = len(lines)
+        z2 = PREFLIGHT_Z ** 2
+        lower_bound = (invalid_ratio + z2 / (2 * n) - PREFLIGHT_Z * math.sqrt(
+            invalid_ratio * (1 - invalid_ratio) / n + z2 / (4 * n * n)
+        )) / (1 + z2 / n)
+
+    logging.info(
+        f"Предварительная оценка доли невалидных логов: {invalid_ratio * 100:.2f} % по {len(lines)} строкам "
+        f"({(time.perf_counter() - started) * 1000:.1f} мс)."
+    )
+
+    if lower_bound > threshold:
+        if mode == 'abort':
+            logging.info(f"Превышен порог погрешности ({fail_coefficient} %) - обработка файла не начата.")
+            return False
+        logging.warning(f"Вероятно превышен порог погрешности ({fail_coefficient} %) - проверьте формат логирования.")
+
+    return True
+
+
+def check_validity(aggregated, fail_coefficient):
+    """
+    Проверяем, что доля невалидных логов не превышает допустимый порог (в %)
+    """
+    total_count = aggregated.get('total_count')
+    invalid_count = aggregated.get('invalid_count')
+
+    logging.info(f"Всего логов, включая невалидные: {total_count} шт.")
+
+    if not total_count:
+        return True
+
+    validity_perc = invalid_count / total_count * 100
+    logging.info(f"Невалидные логи: {validity_perc:.2f} % (допустимо: {fail_coefficient} %).")
+
+    if validity_perc > fail_coefficient:  # Проверяем превышение порога валидности логов
+        logging.info(f"Превышен порог погрешности ({fail_coefficient} %).")
+        return False
+
+    return True
+
+
+def build_urls_data(aggregated, report_size):
+    """
+    Отбираем report_size url с наибольшим 'time_sum' (через кучу, без сортировки всех url), вычисляем для них
+    итоговые показатели и возвращаем список по убыванию 'time_sum'.
+    Для приближенного режима (t-digest) добавляем квантили p90/p95/p99, для HEAVY_HITTERS - ошибку time_sum,
+    для UNIQUE_CLIENTS - оценку кол-ва различных клиентов
+    """
+    if 'url_ids' in aggregated:
+        return build_urls_data_vectorized(aggregated, report_size)
+
+    if 'spill_files' in aggregated:
+        return build_urls_data_external(aggregated, report_size)
+
+    total_count = aggregated.get('total_count')
+    total_time = aggregated.get('total_time')
+
+    # nlargest сохраняет порядок url с равным 'time_sum', как и устойчивая сортировка
+    top_urls = heapq.nlargest(report_size, aggregated.get('urls').items(), key=get_url_stats_time)
+
+    urls_data_list = []
+
+    for url, url_stats in top_urls:
+        line_count = url_stats['count']
+        line_time_sum = url_stats['time_sum']
+        samples = url_stats['samples']
+
+        url_data = {
+            'url': url,
+            'count': line_count,
+            'count_perc': line_count / total_count * 100,
+            'time_sum': round(line_time_sum, 3),
+            'time_perc': round(line_time_sum / total_time * 100, 3),
+            'time_avg': round(line_time_sum / line_count, 3),
+            'time_max': url_stats['time_max'],
+            'time_med': round(samples.median(), 3)
+        }
+
+        if not isinstance(samples, ExactSamples):
+            for q in REPORT_QUANTILES:
+                url_data[f'time_p{round(q * 100)}'] = round(samples.quantile(q), 3)
+
+        if 'heavy_hitters' in aggregated:  # на сколько time_sum может быть занижен (см. aggregate_heavy_hitters)
+            url_data['time_sum_err'] = round(aggregated['heavy_hitters'].errors[url], 3)
+
+        if 'clients' in url_stats:
+            url_data['clients'] = round(url_stats['clients'].count())
+
+        urls_data_list.append(url_data)
+
+    return urls_data_list
+
+
+def build_urls_data_external(aggregated, report_size):
+    """
+    То же, что build_urls_data, для таблицы url, сброшенной на диск (см. aggregate_records_external): url идут
+    из k-путевого слияния частичных результатов по одному, в памяти остается только report_size лучших.
+    Значения времени url объединяются в порядке строк, и сумма считается в том же порядке - показатели и отбор
+    (при равном time_sum - по первому появлению url) совпадают с обработкой в памяти
+    """
+    spill_files = aggregated['spill_files']
+
+    def merged_urls():
+        for url, first_seen, samples in spill_files.merge():
+            url_stats = {
+                'count': len(samples),
+                'time_sum': reduce(add, samples),
+                'time_max': max(samples),
+                'samples': ExactSamples(samples)
+            }
+            yield first_seen, url, url_stats
+
+    try:
+        top_urls = heapq.nlargest(
+            report_size, merged_urls(), key=lambda item: (round(item[2]['time_sum'], 3), -item[0])
+        )
+    finally:
+        spill_files.close()
+
+    top_urls.sort(key=itemgetter(0))
+    in_memory = {key: value for key, value in aggregated.items() if key != 'spill_files'}
+    in_memory['urls'] = {url: url_stats for _, url, url_stats in top_urls}
+
+    return build_urls_data(in_memory, report_size)
+
+
+def build_timeseries_data(timeseries):
+    """
+    Строки временного ряда для отчета: по каждому интервалу (начало - секунды от начала эпохи) кол-во запросов,
+    суммарное, среднее и максимальное время ответа, квантили времени по гистограмме интервала
+    """
+    timeseries_data = []
+
+    for bucket in sorted(timeseries):
+        histogram = timeseries[bucket]
+        timeseries_data.append({
+            'time': bucket,
+            'count': histogram.count,
+            'time_sum': round(histogram.sum, 3),
+            'time_avg': round(histogram.sum / histogram.count, 3),
+            'time_med': round(histogram.median(), 3),
+            'time_p90': round(histogram.quantile(0.9), 3),
+            'time_p99': round(histogram.quantile(0.99), 3),
+            'time_max': histogram.max
+        })
+
+    return timeseries_data
+
+
+def build_dimensions_data(aggregated, report_size):
+    """
+    Таблицы по измерениям для отчета: {измерение: строки как у url (до report_size значений по убыванию
+    'time_sum'), где вместо 'url' - значение измерения}
+    """
+    dimensions_data = {}
+
+    for name, values_stats in aggregated['dimensions'].items():
+        rows = build_urls_data({
+            'urls': values_stats,
+            'total_count': aggregated['total_count'],
+            'total_time': aggregated['total_time']
+        }, report_size)
+        dimensions_data[name] = [dict({name: row.pop('url')}, **row) for row in rows]
+
+    return dimensions_data
+
+
+def build_report_sections(aggregated, report_size=1000):
+    """
+    Дополнительные разделы отчета (кроме таблицы url): {имя подстановки в шаблоне без '_json': данные}
+    """
+    report_sections = {}
+
+    if 'timeseries' in aggregated:
+        report_sections['timeseries'] = build_timeseries_data(aggregated['timeseries'])
+
+    if 'dimensions' in aggregated:
+        report_sections['dimensions'] = build_dimensions_data(aggregated, report_size)
+
+    return report_sections
+
+
+def build_urls_data_vectorized(collected, report_size):
+    """
+    То же, что build_urls_data, по колонкам из collect_records: показатели всех url считаются сразу (numpy),
+    отбор топ-url и округление - как в build_urls_data
+    """
+    total_count = collected.get('total_count')
+    total_time = collected.get('total_time')
+    urls = list(collected.get('urls'))
+
+    counts, time_sums, time_maxes, time_meds = vectorized.grouped_url_stats(
+        collected.get('url_ids'), collected.get('times'), len(urls)
+    )
+
+    top_ids = heapq.nlargest(report_size, range(len(urls)), key=lambda url_id: round(time_sums[url_id], 3))
+
+    return [
+        {
+            'url': urls[url_id],
+            'count': counts[url_id],
+            'count_perc': counts[url_id] / total_count * 100,
+            'time_sum': round(time_sums[url_id], 3),
+            'time_perc': round(time_sums[url_id] / total_time * 100, 3),
+            'time_avg': round(time_sums[url_id] / counts[url_id], 3),
+            'time_max': time_maxes[url_id],
+            'time_med': round(time_meds[url_id], 3)
+        }
+        for url_id in top_ids
+    ]
+
+
+@time_it
+def resolve_aggregate_options(options, file_name, workers=1, store=None, aggregates=None):
+    """
+    Согласуем настройки сбора показателей (см. make_aggregate_options) со способом обработки файла: несовместимые
+    возможности отключаются с сообщением в лог, неизвестные измерения отбрасываются, stats_backend выбирается
+    через choose_stats_backend. Возвращаем новый словарь настроек, переданный не меняется
+    """
+    options = dict(options)
+
+    if options['heavy_hitters'] and store is not None:
+        logging.info("HEAVY_HITTERS не используется с INCREMENTAL - показатели собираются по всем url.")
+        options['heavy_hitters'] = 0
+
+    if options['memory_budget'] and (options['quantiles'] != 'exact' or options['max_urls'] or options['heavy_hitters']
+                                     or store is not None or workers > 1 and not file_name.endswith(".gz")
+                                     or aggregates is not None):
+        logging.info("MEMORY_BUDGET_MB используется только для точной медианы без MAX_URLS, HEAVY_HITTERS, "
+                     "INCREMENTAL, AGGREGATE_DIR и --workers - таблица url хранится в памяти.")
+        options['memory_budget'] = 0
+
+    if aggregates is not None:
+        options['stats_backend'] = 'python'  # для файла показателей нужны показатели каждого url, а не колонки
+
+    unknown_dimensions = [name for name in options['dimensions'] if name not in DIMENSIONS]
+
+    if unknown_dimensions:
+        logging.info(f"Неизвестные измерения GROUP_BY: {', '.join(unknown_dimensions)} "
+                     f"(возможны: {', '.join(DIMENSIONS)}).")
+        options['dimensions'] = tuple(name for name in options['dimensions'] if name in DIMENSIONS)
+
+    if options['dimensions'] and store is not None:
+        logging.info("GROUP_BY не используется с INCREMENTAL - показатели собираются только по url.")
+        options['dimensions'] = ()
+
+    if options['unique_clients'] and (options['heavy_hitters'] or options['memory_budget'] or store is not None):
+        logging.info("UNIQUE_CLIENTS не используется с HEAVY_HITTERS, MEMORY_BUDGET_MB и INCREMENTAL.")
+        options['unique_clients'] = None
+
+    if options['unique_clients']:
+        options['stats_backend'] = 'python'  # оценка клиентов хранится в показателях каждого url
+
+    options['stats_backend'] = choose_stats_backend(options['stats_backend'], options['quantiles'], workers, store)
+
+    return options
+
+
+def process_lines(line_iterator, file_name, log_dir_name, report_size, fail_coefficient=20, single_pass=True,
+                  options=None, workers=1, store=None, read_mode='text', report_sections=None, preflight='off',
+                  aggregates=None):
+    """
+    Вычисляем показатели по каждому валидному логу и добавляем список, сортируем его и возвращаем заданного размера.
+    По-умолчанию все показатели собираются за один проход по файлу (single_pass), иначе - файл перечитывается
+    для каждого url (прежний режим, оставлен для сверки результатов).
+    options - настройки сбора показателей (см. make_aggregate_options, по-умолчанию - точная медиана по всем url
+    в формате ui_short), несовместимые со способом обработки отключаются (см. resolve_aggregate_options).
+    При workers > 1 несжатый файл делится на части, которые обрабатываются параллельно в пуле процессов.
+    Если передано хранилище показателей (store) - обрабатываются только новые строки файла (см. aggregate_incremental).
+    При read_mode='mmap' файл читается как байты (несжатый - через mmap) без декодирования строк целиком,
+    по-умолчанию (read_mode='text') разбираются строки из line_iterator.
+    Дополнительные разделы отчета (временной ряд, измерения) добавляются в словарь report_sections, если он передан.
+    preflight='abort'/'warn' - до полного прохода оценить долю невалидных логов по выборке (см. preflight_check).
+    Если передан словарь aggregates - в него сохраняются собранные показатели по всем url (для файла показателей,
+    см. write_aggregate_file)
+    """
+    if not single_pass:
+        return process_lines_multi_pass(line_iterator, file_name, log_dir_name, report_size, fail_coefficient)
+
+    try:
+        options = resolve_aggregate_options(options or make_aggregate_options(), file_name, workers, store, aggregates)
+
+        if preflight in ('abort', 'warn') and not preflight_check(
+                file_name, log_dir_name, fail_coefficient, preflight, get_line_parser(options, binary=True)):
+            return None
+
+        # Чтение (распаковка), разбор, проверка и подсчет показателей идут в одном проходе - это один этап 'scan'
+        with stage_metrics.stage('scan') as stage:
+            if store is not None:
+                aggregated = aggregate_incremental(store, file_name, log_dir_name, options, workers)
+            elif workers > 1 and not file_name.endswith(".gz"):
+                aggregated = aggregate_file_parallel(file_name, log_dir_name, workers, options)
+            elif read_mode == 'mmap':
+                aggregated = aggregate_log_file(file_name, log_dir_name, options)
+            else:
+                aggregated = aggregate_lines(line_iterator, options)
+
+            stage['lines'] = aggregated['total_count']
+            stage['bytes'] = os.path.getsize(os.path.join(log_dir_name, file_name))
+
+        try:
+            if OVERFLOW_URL in aggregated['urls']:
+                logging.info(
+                    f"Превышен лимит различных url ({options['max_urls']}), остальные учтены в '{OVERFLOW_URL}'."
+                )
+
+            if 'heavy_hitters' in aggregated:
+                logging.info(
+                    f"Отслеживалось url: {len(aggregated['heavy_hitters'])}, любой неотслеживаемый url занял "
+                    f"не больше {aggregated['heavy_hitters'].threshold:.3f} сек. "
+                    f"(общее время {aggregated['total_time']:.3f} сек.)."
+                )
+
+            if not check_validity(aggregated, fail_coefficient):
+                return None
+
+            if aggregates is not None:
+                aggregates.update(aggregated)
+
+            with stage_metrics.stage('select') as stage:
+                if report_sections is not None:
+                    report_sections.update(build_report_sections(aggregated, report_size))
+
+                urls_data = build_urls_data(aggregated, report_size)
+                stage['lines'] = len(aggregated['urls'])
+
+            return urls_data
+        finally:
+            if 'spill_files' in aggregated:  # при невалидных логах или ошибке до отбора url
+                aggregated['spill_files'].close()
+
+    except KeyboardInterrupt:
+        logging.exception(msg="Обработка логов остановлена.")
+        return {'failure': 'Принудительная остановка.'}
+
+
+def process_lines_multi_pass(line_iterator, file_name, log_dir_name, report_size, fail_coefficient=20):
+    """
+    Прежний режим: для каждого нового url файл перечитывается заново (check_line), сложность O(N*U)
+    """
+    try:
+        urls_done = set()
+        urls_data_list = []
+
+        first_time = True
+        logs_validated = True
+
+        while True:
+            if not logs_validated:
+                break
+            try:
+                line = next(line_iterator)
+                line_list = line.split()
+
+                if not validate_log(line_list):
+                    continue
+
+                line_url = line_list[6]
+
+                if line_url in urls_done:
+                    continue
+
+                log_iterator = process_logs(file_name, log_dir_name)
+
+                res = check_line(line_url, log_iterator, first_time)
+
+                if first_time:
+                    first_time = False
+
+                    total_count = res.get('total_count')
+                    total_time = res.get('total_time')
+                    invalid_count = res.get('invalid_count')
+
+                    logging.info(f"Всего логов, включая невалидные: {total_count} шт.")
+
+                    validity_perc = invalid_count / total_count * 100
+                    logging.info(f"Невалидные логи: {validity_perc:.2f} % (допустимо: {fail_coefficient} %).")
+
+                    if validity_perc > fail_coefficient:  # Проверяем превышение порога валидности логов
+                        logs_validated = False
+                        logging.info(f"Превышен порог погрешности ({fail_coefficient} %).")
+                        break
+
+                line_count_perc = res.get('line_count') / total_count * 100
+                line_time_sum_perc = res.get('line_time_sum') / total_time * 100
+                line_time_avg = res.get('line_time_sum') / res.get('line_count')
+                line_time_max = max(res.get('line_time_list'))
+                line_time_median = median(res.get('line_time_list'))
+
+                urls_done.add(line_url)
+
+                urls_data_list.append({
+                    'url': line_url,
+                    'count': res.get('line_count'),
+                    'count_perc': line_count_perc,
+                    'time_sum': round(res.get('line_time_sum'), 3),
+                    'time_perc': round(line_time_sum_perc, 3),
+                    'time_avg': round(line_time_avg, 3),
+                    'time_max': line_time_max,
+                    'time_med': round(line_time_median, 3)
+                })
+
+            except StopIteration:
+                break
+
+        if not logs_validated:
+            return None
+
+        urls_data_list.sort(reverse=True, key=get_url_time)
+
+        if len(urls_data_list) >= report_size:
+            return urls_data_list[0:report_size]
+
+        return urls_data_list
+
+    except KeyboardInterrupt:
+        logging.exception(msg="Обработка логов остановлена.")
+        return {'failure': 'Принудительная остановка.'}
+
+
+def export_columns(line_iterator, file_name, export_dir, chunk_size=1000000, log_format=None):
+    """
+    Выгружаем разобранные строки лога в export_dir/<имя файла>/ по колонкам (.npy блоками по chunk_size строк):
+    номер url в словаре urls.json, время ответа (float32), $time_local (секунды от начала эпохи)
+    """
+    writer = ColumnWriter(os.path.join(export_dir, file_name.removesuffix('.gz')), chunk_size)
+    if log_format:
+        line_parser = compile_log_format(log_format).get_record_parser(TimeLocalParser())
+    else:
+        line_parser = partial(parse_ui_short_record, time_parser=TimeLocalParser())
+
+    for line in line_iterator:
+        record = line_parser(line)
+
+        if record is None:
+            writer.invalid_count += 1
+        else:
+            writer.add(*record)
+
+    meta = writer.close()
+    logging.info(
+        f"Выгружено строк: {meta['rows']}, различных url: {len(writer.url_ids)}, блоков: {len(meta['chunks'])}"
+    )
+
+    return meta
+
+
+class ReportTemplate:
+    """
+    HTML-шаблон отчета, разобранный один раз: текст между подстановками ($table_json и т.п.) и имена подстановок.
+    Данные подстановок пишутся в файл отчета по частям как JSON - весь текст отчета в памяти не собирается
+    """
+    cache = {}  # путь к шаблону -> (mtime, шаблон)
+
+    def __init__(self, text):
+        self.chunks = TEMPLATE_PLACEHOLDER.split(text)  # [текст, имя, текст, имя, ..., текст]
+
+    @classmethod
+    def load(cls, template_path):
+        """
+        Шаблон из кэша, пока файл шаблона не изменился
+        """
+        mtime = os.stat(template_path).st_mtime_ns
+        cached = cls.cache.get(template_path)
+
+        if cached is None or cached[0] != mtime:
+            with open(template_path, 'r', encoding='utf-8') as html_file:
+                cached = (mtime, cls(html_file.read()))
+            cls.cache[template_path] = cached
+
+        return cached[1]
+
+    def render(self, out, **values):
+        encoder = json.JSONEncoder()
+
+        for i, chunk in enumerate(self.chunks):
+            if i % 2 == 0:
+                out.write(chunk)
+            else:
+                for part in encoder.iterencode(values.get(chunk)):
+                    out.write(part.replace('</', '<\\/'))  # строка с '</script>' не должна закрыть тег скрипта
+
+
+def create_report_file(final_data, file_date, dir_path, file_date_to=None, report_sections=None):
+    """
+    Создаем файл и записываем текст шаблона + обработанные данные логов (за дату или за период до file_date_to).
+    Разделы report_sections подставляются вместо $<имя>_json (например, временной ряд - $timeseries_json)
+    """
+
+    report_file_name = get_report_file_name(file_date, file_date_to)
+
+    os.makedirs(dir_path, exist_ok=True)
+
+    file_path = os.path.join(dir_path, report_file_name)
+
+    return render_report(file_path, final_data, report_sections)
+
+
+def render_report(file_path, final_data, report_sections=None):
+    """
+    Записываем файл отчета по шаблону: final_data - вместо $table_json, разделы report_sections - вместо $<имя>_json
+    """
+    try:
+        template = ReportTemplate.load(REPORT_TEMPLATE_PATH)
+    except FileNotFoundError:
+        return {'failure': 'Невозможно создать файл с отчетом: файл c HTML-шаблоном не найден.'}
+
+    with stage_metrics.stage('render') as stage, open(file_path, 'w', encoding='utf-8') as f:
+        template.render(f, table_json=final_data, **{
+            f'{name}_json': data for name, data in (report_sections or {}).items()
+        })
+        stage['lines'] = len(final_data)
+        stage['bytes'] = f.tell()
+
+    return {'ok': '----- Анализ завершен ----'}
+
+
+def create_log_report(configuration, log_file_name, report_date, workers=None):
+    """
+    Отчет по одному файлу логов с настройками из конфига (и выгрузка по колонкам, если задан "EXPORT_DIR").
+    Возвращаем {'ok': ...} или {'failure': причина}
+    """
+    store = AggregateStore(configuration.get("REPORT_DIR")) if configuration.get("INCREMENTAL") else None
+    log_format = find_log_format(configuration.get("LOG_FORMATS"), log_file_name)
+    report_sections = {}
+    aggregates = {} if configuration.get("AGGREGATE_DIR") else None
+
+    try:
+        urls = process_lines(
+            process_logs(log_file_name, configuration.get("LOG_DIR")),
+            log_file_name,
+            configuration.get("LOG_DIR"),
+            configuration.get("REPORT_SIZE"),
+            fail_coefficient=50,  # Установить порог валидности логов в %
+            options=make_aggregate_options(
+                quantiles=configuration.get("QUANTILES"),
+                compression=configuration.get("QUANTILES_COMPRESSION"),
+                url_normalization=configuration.get("URL_NORMALIZATION"),
+                max_urls=configuration.get("MAX_URLS"),
+                stats_backend=configuration.get("STATS_BACKEND"),
+                timeseries_bucket=configuration.get("TIMESERIES_BUCKET"),
+                log_format=log_format,
+                heavy_hitters=configuration.get("HEAVY_HITTERS"),
+                memory_budget_mb=configuration.get("MEMORY_BUDGET_MB"),
+                spill_dir=configuration.get("SPILL_DIR"),
+                dimensions=configuration.get("GROUP_BY"),
+                unique_clients=configuration.get("UNIQUE_CLIENTS"),
+                hll_precision=configuration.get("HLL_PRECISION")
+            ),
+            workers=configuration.get("WORKERS") if workers is None else workers,
+            store=store,
+            read_mode=configuration.get("READ_MODE"),
+            report_sections=report_sections,
+            preflight=configuration.get("PREFLIGHT"),
+            aggregates=aggregates
+        )
+
+        if not isinstance(urls, list):
+            if not urls:
+                return {'failure': 'Обработка логов невозможна. Проверьте формат логирования.'}
+            return {'failure': f"Причина: {urls.get('failure')}"}
+
+    except Exception as e:
+        logging.exception(msg=f"Обработка логов остановлена. Причина: {e}", exc_info=True)
+        return {'failure': f'Обработка логов {log_file_name} остановлена.'}
+
+    result = create_report_file(urls, report_date, configuration.get("REPORT_DIR"), report_sections=report_sections)
+
+    if result.get('ok') and aggregates:
+        with stage_metrics.stage('aggregate_file') as stage:
+            file_path = save_aggregate_file(configuration, aggregates, log_file_name, report_date)
+            stage['lines'] = len(aggregates['urls'])
+            stage['bytes'] = os.path.getsize(file_path)
+
+    if result.get('ok') and configuration.get("EXPORT_DIR"):
+        with stage_metrics.stage('export') as stage:
+            meta = export_columns(
+                process_logs(log_file_name, configuration.get("LOG_DIR")),
+                log_file_name,
+                configuration.get("EXPORT_DIR"),
+                configuration.get("EXPORT_CHUNK_SIZE"),
+                log_format
+            )
+            stage['lines'] = meta['rows'] + meta['invalid_count']
+            stage['bytes'] = os.path.getsize(os.path.join(configuration.get("LOG_DIR"), log_file_name))
+
+    return result
+
+
+def save_aggregate_file(configuration, aggregated, log_file_name, report_date):
+    """
+    Файл показателей сервера за дату для сводного отчета по нескольким серверам (см. merge_aggregate_files):
+    AGGREGATE_DIR/aggregate-<HOST_NAME>-<дата>.jsonl.gz
+    """
+    host_name = configuration.get("HOST_NAME") or socket.gethostname()
+    aggregate_dir = configuration.get("AGGREGATE_DIR")
+
+    os.makedirs(aggregate_dir, exist_ok=True)
+
+    file_path = os.path.join(aggregate_dir, f"aggregate-{host_name}-{report_date}.jsonl.gz")
+    write_aggregate_file(file_path, aggregated, {
+        'host': host_name,
+        'log_name': log_file_name,
+        'log_date': report_date,
+        'quantiles': configuration.get("QUANTILES"),
+        'timeseries_bucket': configuration.get("TIMESERIES_BUCKET") or 0
+    })
+    logging.info(f"Показатели сохранены: {file_path}")
+
+    return file_path
+
+
+def merge_aggregate_files(configuration):
+    """
+    Команда merge: сводный отчет по файлам показателей нескольких серверов (save_aggregate_file) без чтения логов.
+    Показатели url складываются, медиана и квантили - по объединенным гистограммам. Отчет -
+    REPORT_DIR/report-fleet-<дата>.html (или за период, если даты файлов разные)
+    """
+    aggregated = None
+    log_dates = []
+    hosts = []
+
+    with stage_metrics.stage('load') as stage:
+        for file_path in configuration.get("MERGE_FILES"):
+            try:
+                header, part = read_aggregate_file(file_path)
+            except (OSError, ValueError, KeyError) as e:
+                return {'failure': f'Файл показателей {file_path} не прочитан: {e}'}
+
+            log_dates.append(header['log_date'])
+            hosts.append(header['host'])
+            stage['lines'] += len(part['urls'])
+            stage['bytes'] += os.path.getsize(file_path)
+
+            if aggregated is None:
+                aggregated = part
+            else:
+                merge_aggregates(aggregated, part)
+
+    logging.info(f"Объединены показатели серверов: {', '.join(hosts)}, всего логов: {aggregated['total_count']} шт.")
+
+    with stage_metrics.stage('select') as stage:
+        urls = build_urls_data(aggregated, configuration.get("REPORT_SIZE"))
+        report_sections = build_report_sections(aggregated)
+        stage['lines'] = len(aggregated['urls'])
+
+    report_dir = configuration.get("REPORT_DIR")
+
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+
+    report_name = get_report_file_name(min(log_dates), max(log_dates), prefix='report-fleet')
+
+    return render_report(os.path.join(report_dir, report_name), urls, report_sections)
+
+
+def create_pending_report(task):
+    """
+    Задача backfill_reports: отчет по одному файлу (configuration, имя файла, дата) -> (имя файла, результат)
+    """
+    configuration, log_file_name, report_date = task
+    return log_file_name, create_log_report(configuration, log_file_name, report_date, 1)
+
+
+def map_fresh_processes(func, tasks, processes, configuration):
+    """
+    Выполняем func(task) для каждой задачи в пуле из processes процессов, каждую задачу - в новом процессе,
+    результаты - по мере готовности. ProcessPoolExecutor пересоздает процессы (max_tasks_per_child) начиная
+    с Python 3.11, в более ранних версиях - multiprocessing.Pool(maxtasksperchild=1)
+    """
+    if sys.version_info >= (3, 11):
+        with ProcessPoolExecutor(max_workers=processes, max_tasks_per_child=1,
+                                 initializer=setup_logging, initargs=(configuration,)) as executor:
+            for future in as_completed([executor.submit(func, task) for task in tasks]):
+                yield future.result()
+    else:
+        with multiprocessing.Pool(processes, initializer=setup_logging, initargs=(configuration,),
+                                  maxtasksperchild=1) as pool:
+            yield from pool.imap_unordered(func, tasks)
+
+
+def backfill_reports(configuration):
+    """
+    Отчеты по всем файлам логов, для которых их еще нет (например, после простоя). Файлы обрабатываются
+    параллельно в пуле из "WORKERS" процессов, каждый файл - в новом процессе (см. map_fresh_processes), поэтому
+    память одновременно занимают не больше WORKERS файлов и она освобождается после каждого отчета
+    """
+    dir_index = DirectoryIndex(configuration.get("DIR_INDEX_FILE")) if configuration.get("DIR_INDEX_FILE") else None
+    pending = find_pending_log_files(configuration.get("LOG_DIR"), configuration.get("REPORT_DIR"), dir_index,
+                                     configuration.get("LOG_FILE_PATTERN"))
+
+    if dir_index is not None:
+        dir_index.save()
+
+    if not pending:
+        return {'failure': 'Нет файлов логов без отчета.'}
+
+    logging.info(f"Файлов логов без отчета: {len(pending)}.")
+
+    workers = max(1, configuration.get("WORKERS") or 1)
+    failures = 0
+
+    tasks = [(configuration, log_file_name, report_date) for log_file_name, report_date in pending]
+
+    for log_file_name, result in map_fresh_processes(create_pending_report, tasks, min(workers, len(pending)),
+                                                     configuration):
+        if result.get('ok'):
+            logging.info(f"{log_file_name}: отчет создан.")
+        else:
+            failures += 1
+            logging.error(f"{log_file_name}: {result.get('failure')}")
+
+    if failures:
+        return {'failure': f'Не удалось создать отчеты по {failures} из {len(pending)} файлов.'}
+
+    return {'ok': '----- Анализ завершен ----'}
+
+
+class LogFollower:
+    """
+    Чтение дописываемого файла логов (как tail -F): при каждом вызове read_lines возвращаются новые полностью
+    записанные строки (в байтах). Если файл ротирован (под тем же именем появился файл с другим inode) или обрезан -
+    дочитываем старый файл и продолжаем с начала нового
+    """
+
+    def __init__(self, file_path, from_start=False):
+        self.file_path = file_path
+        self.log = None
+        self.inode = None
+        self.tail = b''
+        self.open(from_start)
+
+    def open(self, from_start=True):
+        if self.log is not None:
+            self.log.close()
+
+        try:
+            self.log = open(self.file_path, 'rb')
+        except FileNotFoundError:  # ротация: старый файл переименован, новый еще не создан
+            self.log = None
+            return
+
+        self.inode = os.fstat(self.log.fileno()).st_ino
+        self.tail = b''
+
+        if not from_start:
+            self.log.seek(0, os.SEEK_END)
+
+    def is_rotated(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return False
+
+        return stat.st_ino != self.inode or stat.st_size < self.log.tell()
+
+    def read_lines(self, block_size=READ_BLOCK_SIZE):
+        if self.log is None:
+            self.open()
+            if self.log is None:
+                return []
+
+        data = self.log.read(block_size)
+
+        if not data and self.is_rotated():
+            self.open()
+            if self.log is None:
+                return []
+            data = self.log.read(block_size)
+
+        lines = (self.tail + data).split(b'\n')
+        self.tail = lines.pop()
+
+        return lines
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+def get_window_name(seconds):
+    """
+    Имя окна для отчета: 60 -> '1m', 3600 -> '1h'
+    """
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600}h'
+    if seconds % 60 == 0:
+        return f'{seconds // 60}m'
+    return f'{seconds}s'
+
+
+class SlidingWindows:
+    """
+    Показатели по url в скользящих окнах (например 1m/5m/1h) по $time_local. Строки раскладываются по интервалам
+    bucket_size секунд (в каждом - показатели как у aggregate_records), окно - объединение интервалов за последние
+    N секунд до самого позднего $time_local. Интервалы старше самого длинного окна удаляются. По-умолчанию
+    время ответа хранится в гистограммах (QUANTILES "histogram") - память не зависит от кол-ва запросов
+    """
+
+    def __init__(self, windows=(60, 300, 3600), bucket_size=10, options=None):
+        self.windows = sorted(windows)
+        self.bucket_size = bucket_size
+        self.options = options or make_aggregate_options('histogram')
+        self.buckets = {}
+        self.latest = None
+        self.current_bucket = None
+        self.line_parser = get_line_parser(dict(self.options, timeseries_bucket=bucket_size), binary=True)
+
+    def record_bucket(self, record):
+        if record is not None:
+            self.latest = record[2] if self.latest is None else max(self.latest, record[2])
+            self.current_bucket = record[2] - record[2] % self.bucket_size
+        return self.current_bucket  # невалидная строка учитывается в интервале предыдущей строки
+
+    def add_lines(self, lines):
+        """
+        Добавляем строки (в байтах). Строки идут почти по порядку времени - собираем показатели подряд идущих строк
+        одного интервала через aggregate_records и добавляем их к показателям интервала
+        """
+        for bucket, records in groupby(map(self.line_parser, lines), key=self.record_bucket):
+            if bucket is None:
+                continue
+
+            aggregated = aggregate_records(
+                (record[:2] if record is not None else None for record in records), self.options
+            )
+
+            if bucket in self.buckets:
+                merge_aggregates(self.buckets[bucket], aggregated, self.options['max_urls'])
+            else:
+                self.buckets[bucket] = aggregated
+
+        self.expire()
+
+    def expire(self):
+        if self.latest is None:
+            return
+
+        oldest = self.latest - self.windows[-1]
+
+        for bucket in [bucket for bucket in self.buckets if bucket + self.bucket_size <= oldest]:
+            del self.buckets[bucket]
+
+    def get_window(self, seconds):
+        """
+        Показатели за последние seconds секунд (копия - показатели интервалов не меняются) или None
+        """
+        aggregated = None
+
+        for bucket in sorted(self.buckets):
+            if bucket + self.bucket_size <= self.latest - seconds:
+                continue
+
+            bucket_aggregated = copy.deepcopy(self.buckets[bucket])
+
+            if aggregated is None:
+                aggregated = bucket_aggregated
+            else:
+                merge_aggregates(aggregated, bucket_aggregated, self.options['max_urls'])
+
+        return aggregated
+
+    def build_windows_data(self, report_size):
+        """
+        Топ-url по 'time_sum' для каждого окна: {'1m': [...], '5m': [...], '1h': [...]}
+        """
+        windows_data = {}
+
+        for seconds in self.windows:
+            aggregated = self.get_window(seconds)
+            windows_data[get_window_name(seconds)] = build_urls_data(aggregated, report_size) if aggregated else []
+
+        return windows_data
+
+
+def write_live_reports(windows, configuration):
+    """
+    Сохраняем текущие показатели окон: REPORT_DIR/live.json ({'updated', 'latest', 'windows'}) и HTML-отчет
+    на каждое окно (report-live-1m.html и т.д.). Файлы заменяются целиком (os.replace) - читатель не увидит
+    недописанный файл
+    """
+    report_dir = configuration.get("REPORT_DIR")
+
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+
+    windows_data = windows.build_windows_data(configuration.get("REPORT_SIZE"))
+
+    live_path = os.path.join(report_dir, 'live.json')
+
+    with open(live_path + '.tmp', 'w', encoding='utf-8') as live_file:
+        json.dump({'updated': int(time.time()), 'latest': windows.latest, 'windows': windows_data}, live_file)
+    os.replace(live_path + '.tmp', live_path)
+
+    for window_name, urls in windows_data.items():
+        report_path = os.path.join(report_dir, f'report-live-{window_name}.html')
+        render_report(report_path + '.tmp', urls)
+        os.replace(report_path + '.tmp', report_path)
+
+    return windows_data
+
+
+def follow_log(configuration):
+    """
+    Режим --follow: дочитываем текущий файл логов по мере записи (с учетом ротации), держим показатели
+    в скользящих окнах FOLLOW_WINDOWS и каждые FOLLOW_REFRESH секунд обновляем live.json и report-live-*.html.
+    Работает до остановки (Ctrl+C)
+    """
+    file_path = os.path.join(configuration.get("LOG_DIR"), configuration.get("FOLLOW_FILE"))
+
+    if not os.path.exists(file_path):
+        return {'failure': f'Файл {file_path} не найден.'}
+
+    options = make_aggregate_options(
+        'histogram', url_normalization=configuration.get("URL_NORMALIZATION"), max_urls=configuration.get("MAX_URLS"),
+        log_format=find_log_format(configuration.get("LOG_FORMATS"), configuration.get("FOLLOW_FILE"))
+    )
+    follower = LogFollower(file_path)
+    windows = SlidingWindows(configuration.get("FOLLOW_WINDOWS"), options=options)
+    refresh = configuration.get("FOLLOW_REFRESH")
+    next_refresh = time.monotonic() + refresh
+
+    logging.info(f"Отслеживаем {file_path}, окна: {', '.join(map(get_window_name, windows.windows))}.")
+
+    try:
+        while True:
+            lines = follower.read_lines()
+            windows.add_lines(lines)
+
+            if time.monotonic() >= next_refresh:
+                stage_metrics.reset()  # в итоговых метриках - только последнее обновление отчетов
+                write_live_reports(windows, configuration)
+                next_refresh = time.monotonic() + refresh
+
+            if not lines:
+                time.sleep(configuration.get("FOLLOW_POLL"))
+
+    except KeyboardInterrupt:
+        write_live_reports(windows, configuration)
+        return {'ok': '----- Отслеживание остановлено ----'}
+
+    finally:
+        follower.close()
+
+
+def run_analysis(configuration):
+    """
+    Сводный отчет за период, отчеты по всем файлам без отчета или (по-умолчанию) отчет по самому новому файлу.
+    Возвращаем {'ok': ...} или {'failure': причина}
+    """
+    if configuration.get("ROLLUP_FROM"):
+        return create_rollup_report(configuration)
+
+    if configuration.get("BACKFILL"):
+        return backfill_reports(configuration)
+
+    if configuration.get("FOLLOW"):
+        return follow_log(configuration)
+
+    if configuration.get("MERGE_FILES"):
+        return merge_aggregate_files(configuration)
+
+    with stage_metrics.stage('discovery') as stage:
+        if configuration.get("DIR_INDEX_FILE"):
+            dir_index = DirectoryIndex(configuration.get("DIR_INDEX_FILE"))
+            log_file_name, report_date = dir_index.find_latest_log(
+                configuration.get("LOG_DIR"), configuration.get("LOG_FILE_PATTERN")
+            )
+            report_index = dir_index.get_names(configuration.get("REPORT_DIR"))
+            dir_index.save()
+        else:
+            gen_log_files = find_log_file(configuration.get("LOG_FILE_PATTERN"), configuration.get("LOG_DIR"))
+            log_file_name, report_date = get_recent_log_file(gen_log_files)
+            report_index = None
+
+        store = AggregateStore(configuration.get("REPORT_DIR")) if configuration.get("INCREMENTAL") else None
+        report_exist = check_report_exist(report_date, configuration.get("REPORT_DIR"), report_index)
+        stage['lines'] = 1 if log_file_name else 0
+
+    if report_exist:
+        if store is None or not check_new_data(store, log_file_name, configuration.get("LOG_DIR")):
+            return {'failure': 'Отчет за указанную дату уже создан.'}
+
+        logging.info('В файле появились новые данные - отчет будет обновлен.')
+
+    return create_log_report(configuration, log_file_name, report_date)
+
+
+def main():
+    actual_conf = get_config()
+
+    if actual_conf.get('failure'):
+        logging.error(f"{actual_conf.get('failure')}")
+        sys.exit()
+
+    setup_logging(actual_conf, logging_level='info')
+
+    logging.info("----- Анализ в процессе -----")
+
+    stage_metrics.reset()
+    profiler = Profiler(actual_conf.get("PROFILE_DIR")) if actual_conf.get("PROFILE_DIR") else None
+
+    if profiler is not None:
+        profiler.start()
+
+    try:
+        result = run_analysis(actual_conf)
+    finally:
+        if profiler is not None:
+            logging.info(f"Результаты профилирования сохранены: {profiler.stop()}")
+
+        logging.info(f"Метрики этапов: {stage_metrics.as_json()}")
 
-    result = create_report_file(urls, report_date, actual_conf.get("REPORT_DIR"))
+        if actual_conf.get("METRICS_FILE"):
+            with open(actual_conf.get("METRICS_FILE"), 'a', encoding='utf-8') as metrics_file:
+                metrics_file.write(stage_metrics.as_json() + '\n')
 
     if not result.get('ok'):
         logging.error(f"{result.get('failure')}")
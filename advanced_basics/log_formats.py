@@ -0,0 +1,305 @@
+import fnmatch
+import re
+from functools import lru_cache, partial
+
+
+# Формат логов по-умолчанию (его разбирают parse_ui_short и parse_ui_short_record в log_analyzer)
+UI_SHORT_FORMAT = (
+    '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
+    '$status $body_bytes_sent "$http_referer" '
+    '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+    '$request_time'
+)
+
+LOG_FORMAT_VARIABLE = re.compile(r'\$(?:(\w+)|\{(\w+)\})')
+
+URL_VARIABLES = ('request', 'request_uri', 'uri')  # откуда берем url - в порядке предпочтения
+CHECKED_VARIABLES = {'status': r'\d+'}  # поля, которые проверяются, даже если их значение не нужно
+
+
+def tokenize_log_format(log_format):
+    """
+    Разбиваем строку nginx log_format на части: [('literal', текст) или ('variable', имя переменной), ...]
+    """
+    tokens = []
+    position = 0
+
+    for match in LOG_FORMAT_VARIABLE.finditer(log_format):
+        if match.start() > position:
+            tokens.append(('literal', log_format[position:match.start()]))
+
+        tokens.append(('variable', match.group(1) or match.group(2)))
+        position = match.end()
+
+    if position < len(log_format):
+        tokens.append(('literal', log_format[position:]))
+
+    return tokens
+
+
+def literal_pattern(text):
+    """
+    Текст между переменными: пробелы - любым (ненулевым) кол-вом, т.к. при склейке строк log_format
+    в конфиге nginx кол-во пробелов между полями часто не совпадает с описанием формата
+    """
+    return ''.join(' +' if part.startswith(' ') else re.escape(part) for part in re.split(r'( +)', text) if part)
+
+
+def variable_pattern(name, delimiter, field=None, method_field=None):
+    """
+    Значение переменной - до первого символа следующего за ней текста (delimiter), например до '"' в кавычках
+    или до ']' в [$time_local]. url в $request должен содержать '/', как и в validate_log.
+    field - имя группы, если значение нужно, method_field - имя группы для метода из $request
+    """
+    stop = re.escape(delimiter) if delimiter else r'\s'
+
+    if name == 'request':
+        method = f'(?P<{method_field}>\\S+)' if method_field else r'\S+'
+        url = r'(?P<url>\S*/\S*)' if field else r'\S*/\S*'
+        return rf'{method} {url} [^{stop}]*'
+
+    if name in URL_VARIABLES:
+        pattern = rf'[^{stop}/]*/[^{stop}]*'
+    else:
+        pattern = CHECKED_VARIABLES.get(name, rf'[^{stop}]*')
+
+    return f'(?P<{field}>{pattern})' if field else pattern
+
+
+class LogFormat:
+    """
+    Разбор строк логов по формату, заданному строкой nginx log_format. Из формата строится регулярное выражение
+    только для нужных полей: url ($request, $request_uri или $uri), $request_time и (для временного ряда)
+    $time_local - оно проходит строку лишь до последнего нужного поля. Если $request_time - последнее поле строки,
+    оно берется после последнего разделителя без регулярного выражения (как в parse_ui_short).
+    Методы parse*/parse_record* возвращают то же, что parse_ui_short*/parse_ui_short_record* - кортеж или None
+    """
+
+    def __init__(self, log_format):
+        self.log_format = log_format
+        self.tokens = tokens = tokenize_log_format(log_format)
+        self.variables = names = [value for kind, value in tokens if kind == 'variable']
+
+        self.url_variable = next((name for name in URL_VARIABLES if name in names), None)
+
+        if self.url_variable is None or 'request_time' not in names:
+            raise ValueError(f'В log_format нет $request (или $request_uri, $uri) либо $request_time: {log_format}')
+
+        self.time_separator = None
+
+        if tokens[-1] == ('variable', 'request_time') and len(tokens) > 1 and tokens[-2][0] == 'literal':
+            self.time_separator = tokens[-2][1][-1]
+
+        self.regex = re.compile(self.build_pattern(tokens, ('url', 'request_time')))
+        self.regex_bytes = re.compile(self.regex.pattern.encode())
+        self.groups = dict(self.regex.groupindex)
+
+        self.record_regex = self.record_regex_bytes = self.record_groups = None
+
+        if 'time_local' in names:
+            self.record_regex = re.compile(self.build_pattern(tokens, ('url', 'request_time', 'time_local')))
+            self.record_regex_bytes = re.compile(self.record_regex.pattern.encode())
+            self.record_groups = dict(self.record_regex.groupindex)
+
+    def build_pattern(self, tokens, fields):
+        """
+        Регулярное выражение до последнего нужного (или проверяемого) поля, нужные поля - именованные группы
+        """
+        def field_name(name):
+            return 'url' if name == self.url_variable else name
+
+        # метод запроса - из $request, если в формате нет $request_method
+        method_field = 'request_method' if 'request_method' in fields and 'request_method' not in self.variables \
+            else None
+
+        needed = [
+            i for i, (kind, value) in enumerate(tokens) if kind == 'variable' and (
+                field_name(value) in fields and not (value == 'request_time' and self.time_separator)
+                or value in CHECKED_VARIABLES
+            )
+        ]
+        last = needed[-1] + 1
+
+        if last < len(tokens) and tokens[last][0] == 'literal':
+            last += 1  # текст после поля - граница его значения
+
+        parts = []
+        captured = set()
+        start = needed[0]
+        skip_to = tokens[start - 1][1][-1] if start and tokens[start - 1][0] == 'literal' else ' '
+        skipped_text = ''.join(value for kind, value in tokens[:start] if kind == 'literal')[:-1]
+
+        # Поля до первого нужного пропускаем одним [^"]*" (до символа перед ним), если этот символ однозначен:
+        # не пробел и не встречается раньше в тексте формата (в значениях переменных nginx экранирует '"')
+        if skip_to != ' ' and skip_to not in skipped_text:
+            parts.append(f'[^{re.escape(skip_to)}]*{re.escape(skip_to)}')
+        else:
+            start = 0
+
+        for i in range(start, last):
+            kind, value = tokens[i]
+
+            if kind == 'literal':
+                parts.append(literal_pattern(value))
+                continue
+
+            delimiter = tokens[i + 1][1][0] if i + 1 < len(tokens) and tokens[i + 1][0] == 'literal' else None
+            field = field_name(value) if field_name(value) in fields and field_name(value) not in captured else None
+            parts.append(variable_pattern(value, delimiter, field, method_field if value == 'request' else None))
+
+            if field:
+                captured.add(field)
+
+        return ''.join(parts)
+
+    def get_record_parser(self, time_parser, binary=False):
+        """
+        Разбор строки с $time_local (для временного ряда и выгрузки по колонкам)
+        """
+        if self.record_regex is None:
+            raise ValueError(f'Для временного ряда в log_format нужен $time_local: {self.log_format}')
+
+        return partial(self.parse_record_bytes if binary else self.parse_record, time_parser=time_parser)
+
+    def get_fields_parser(self, fields, time_parser=None, binary=False):
+        """
+        Разбор строки с дополнительными полями (например, для группировки по $status, $http_user_agent):
+        (url, время ответа[, $time_local в секундах], значения fields...) или None для невалидной строки.
+        fields - имена переменных log_format ('request_method' - и метод из $request)
+        """
+        missing = [
+            field for field in fields
+            if field not in self.variables and not (field == 'request_method' and 'request' in self.variables)
+        ]
+
+        if missing:
+            raise ValueError(f"В log_format нет полей {', '.join(missing)}: {self.log_format}")
+
+        if time_parser is not None and 'time_local' not in self.variables:
+            raise ValueError(f'Для временного ряда в log_format нужен $time_local: {self.log_format}')
+
+        needed = ('url', 'request_time') + (('time_local',) if time_parser is not None else ()) + tuple(fields)
+        pattern = self.build_pattern(self.tokens, needed)
+        match_line = re.compile(pattern.encode() if binary else pattern).match
+        separator = self.time_separator.encode() if binary and self.time_separator else self.time_separator
+        groups = ('url',) + tuple(fields)
+
+        def parse_fields(line):
+            match = match_line(line)
+
+            if match is None:
+                return None
+
+            try:
+                request_time = float(line[line.rfind(separator) + 1:] if separator else match.group('request_time'))
+            except ValueError:
+                return None
+
+            values = match.group(*groups) if len(groups) > 1 else (match.group(groups[0]),)
+
+            if binary:
+                values = tuple(value.decode('utf-8', 'replace') for value in values)
+
+            if time_parser is None:
+                return (values[0], request_time) + values[1:]
+
+            time_local = match.group('time_local')
+            timestamp = time_parser(time_local.decode('ascii', 'replace') if binary else time_local)
+
+            if timestamp is None:
+                return None
+
+            return (values[0], request_time, timestamp) + values[1:]
+
+        return parse_fields
+
+    def parse(self, line):
+        match = self.regex.match(line)
+
+        if match is None:
+            return None
+
+        try:
+            if self.time_separator:
+                return match.group(self.groups['url']), float(line[line.rfind(self.time_separator) + 1:])
+            return match.group(self.groups['url']), float(match.group(self.groups['request_time']))
+        except ValueError:
+            return None
+
+    def parse_bytes(self, line):
+        match = self.regex_bytes.match(line)
+
+        if match is None:
+            return None
+
+        try:
+            if self.time_separator:
+                request_time = float(line[line.rfind(self.time_separator.encode()) + 1:])
+            else:
+                request_time = float(match.group(self.groups['request_time']))
+        except ValueError:
+            return None
+
+        return match.group(self.groups['url']).decode('utf-8', 'replace'), request_time
+
+    def parse_record(self, line, time_parser):
+        match = self.record_regex.match(line)
+
+        if match is None:
+            return None
+
+        timestamp = time_parser(match.group(self.record_groups['time_local']))
+
+        if timestamp is None:
+            return None
+
+        try:
+            if self.time_separator:
+                request_time = float(line[line.rfind(self.time_separator) + 1:])
+            else:
+                request_time = float(match.group(self.record_groups['request_time']))
+        except ValueError:
+            return None
+
+        return match.group(self.record_groups['url']), request_time, timestamp
+
+    def parse_record_bytes(self, line, time_parser):
+        match = self.record_regex_bytes.match(line)
+
+        if match is None:
+            return None
+
+        timestamp = time_parser(match.group(self.record_groups['time_local']).decode('ascii', 'replace'))
+
+        if timestamp is None:
+            return None
+
+        try:
+            if self.time_separator:
+                request_time = float(line[line.rfind(self.time_separator.encode()) + 1:])
+            else:
+                request_time = float(match.group(self.record_groups['request_time']))
+        except ValueError:
+            return None
+
+        return match.group(self.record_groups['url']).decode('utf-8', 'replace'), request_time, timestamp
+
+
+@lru_cache(maxsize=None)
+def compile_log_format(log_format):
+    """
+    LogFormat для строки log_format - строится один раз на формат
+    """
+    return LogFormat(log_format)
+
+
+def find_log_format(log_formats, file_name):
+    """
+    Строка log_format для файла логов: первый из шаблонов имени {шаблон: log_format}, которому соответствует
+    имя файла, или None (формат ui_short по-умолчанию)
+    """
+    for file_name_pattern, log_format in (log_formats or {}).items():
+        if fnmatch.fnmatch(file_name, file_name_pattern):  # noqa
+            return log_format
+
+    return None
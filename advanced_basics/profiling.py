@@ -0,0 +1,104 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
+PROFILE_TOP_SIZE = 30
+
+
+def get_peak_rss():
+    """
+    Пиковый объем памяти процесса (и завершенных дочерних процессов - обработчиков пула) в KB
+    """
+    scale = 1 / 1024 if sys.platform == 'darwin' else 1  # на macOS ru_maxrss в байтах
+
+    return round(max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    ) * scale)
+
+
+class StageMetrics:
+    """
+    Показатели этапов работы анализатора: время, строк/сек., байт/сек. и пиковый объем памяти на момент окончания
+    этапа. Этап отмечается блоком with stage_metrics.stage('имя') as stage, в котором заполняются stage['lines']
+    и stage['bytes']
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def reset(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'lines': 0, 'bytes': 0}
+        started = time.perf_counter()
+
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - started
+            record.update({
+                'seconds': round(seconds, 6),
+                'lines_per_sec': round(record['lines'] / seconds) if seconds else None,
+                'bytes_per_sec': round(record['bytes'] / seconds) if seconds else None,
+                'peak_rss_kb': get_peak_rss()
+            })
+            self.stages.append(record)
+
+    def as_json(self):
+        return json.dumps({'stages': self.stages, 'peak_rss_kb': get_peak_rss()}, ensure_ascii=False)
+
+
+stage_metrics = StageMetrics()
+
+
+class Profiler:
+    """
+    Профилирование запуска (--profile): cProfile по времени и tracemalloc по памяти. Результаты сохраняются
+    в директорию dir_name: profile-<время>.prof (для pstats/snakeviz), а также текстовые сводки
+    profile-<время>.txt и tracemalloc-<время>.txt с PROFILE_TOP_SIZE самыми затратными местами
+    """
+
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        tracemalloc.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        if not os.path.exists(self.dir_name):
+            os.makedirs(self.dir_name)
+
+        suffix = datetime.now().strftime('%Y%m%d-%H%M%S')
+        file_prefix = os.path.join(self.dir_name, '{}-' + suffix)
+
+        self.profile.dump_stats(file_prefix.format('profile') + '.prof')
+
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP_SIZE)
+
+        with open(file_prefix.format('profile') + '.txt', 'w', encoding='utf-8') as profile_file:
+            profile_file.write(summary.getvalue())
+
+        with open(file_prefix.format('tracemalloc') + '.txt', 'w', encoding='utf-8') as tracemalloc_file:
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_SIZE]:
+                tracemalloc_file.write(f'{stat}\n')
+
+        return file_prefix.format('profile') + '.prof'
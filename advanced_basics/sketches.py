@@ -0,0 +1,485 @@
+import heapq
+import math
+from functools import partial
+from hashlib import blake2b
+from itertools import chain
+from statistics import median
+
+
+HISTOGRAM_MIN_VALUE = 0.001  # значения до 1 мс попадают в первую корзину
+HISTOGRAM_BUCKETS_PER_DOUBLING = 8  # ширина корзины - 2 ** (1/8), относительная ошибка квантиля не более ~4.4 %
+
+HLL_MIN_PRECISION = 4
+HLL_MAX_PRECISION = 16
+HLL_POWERS = [2.0 ** -rank for rank in range(65)]  # вклад регистра в оценку HyperLogLog
+
+
+def interpolate_quantile(sorted_values, q):
+    """
+    Квантиль по отсортированному списку с линейной интерполяцией (для q=0.5 совпадает со statistics.median)
+    """
+    position = q * (len(sorted_values) - 1)
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+class ExactSamples(list):
+    """
+    Точный режим: храним все значения $request_time для url (память растет вместе с кол-вом запросов)
+    """
+    add = list.append
+
+    def merge(self, other):
+        self.extend(other)
+        return self
+
+    def median(self):
+        return median(self)
+
+    def quantile(self, q):
+        return interpolate_quantile(sorted(self), q)
+
+
+class TDigest:
+    """
+    Приближенный режим: t-digest (вариант со слиянием буфера). Память на url ограничена ~compression центроидами,
+    ошибка по рангу убывает как 1/compression и минимальна у хвостов распределения (p99). Пока значений не больше
+    размера буфера - квантили считаются точно
+    """
+    __slots__ = ('compression', 'buffer_size', 'means', 'weights', 'buffer', 'count', 'min', 'max')
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.buffer_size = int(compression) * 5
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        self.buffer.append(value)
+        self.count += 1
+
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other):
+        if isinstance(other, TDigest):
+            self.buffer.extend(other.buffer)
+            self.means.extend(other.means)
+            self.weights.extend(other.weights)
+            self.count += other.count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+            if self.means or len(self.buffer) >= self.buffer_size:
+                self.compress()
+        else:
+            for value in other:
+                self.add(value)
+        return self
+
+    def _k_to_q(self, k):
+        """
+        Обратная функция масштаба k1: k(q) = compression / (2 * pi) * asin(2q - 1)
+        """
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _q_to_k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def compress(self):
+        """
+        Сливаем буфер с центроидами: соседние значения объединяются, пока вес центроида не превышает предел,
+        заданный функцией масштаба
+        """
+        if not self.buffer and len(self.means) <= 1:
+            return
+
+        items = sorted(zip(self.means + self.buffer, self.weights + [1] * len(self.buffer)))
+        self.buffer = []
+
+        total = self.count
+        means = []
+        weights = []
+
+        weight_so_far = 0
+        weight_limit = total * self._k_to_q(self._q_to_k(0) + 1)
+        current_mean, current_weight = items[0]
+
+        for mean, weight in items[1:]:
+            if weight_so_far + current_weight + weight <= weight_limit:
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                weight_so_far += current_weight
+                means.append(current_mean)
+                weights.append(current_weight)
+                weight_limit = total * self._k_to_q(self._q_to_k(weight_so_far / total) + 1)
+                current_mean, current_weight = mean, weight
+
+        means.append(current_mean)
+        weights.append(current_weight)
+
+        self.means = means
+        self.weights = weights
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+
+        if not self.means:
+            return interpolate_quantile(sorted(self.buffer), q)
+
+        self.compress()
+
+        if len(self.means) == 1:
+            return self.means[0]
+
+        target = q * self.count
+        weights = self.weights
+        means = self.means
+
+        if target < weights[0] / 2:
+            return self.min + (means[0] - self.min) * target / (weights[0] / 2)
+
+        cumulative = weights[0] / 2
+        for i in range(len(means) - 1):
+            step = (weights[i] + weights[i + 1]) / 2
+            if target <= cumulative + step:
+                return means[i] + (means[i + 1] - means[i]) * (target - cumulative) / step
+            cumulative += step
+
+        tail = self.count - cumulative
+        if tail <= 0:
+            return self.max
+        return means[-1] + (self.max - means[-1]) * (target - cumulative) / tail
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+class LogHistogram:
+    """
+    Гистограмма времени ответа с фиксированными логарифмическими корзинами: корзина i > 0 содержит значения
+    (HISTOGRAM_MIN_VALUE * 2 ** ((i - 1) / k), HISTOGRAM_MIN_VALUE * 2 ** (i / k)], k - HISTOGRAM_BUCKETS_PER_DOUBLING.
+    Границы корзин одинаковы для всех гистограмм, поэтому гистограммы частей файла, разных файлов и дней
+    складываются без потери точности. Хранятся только непустые корзины, кол-во, сумма и максимум - точные
+    """
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def bucket_index(value):
+        if value <= HISTOGRAM_MIN_VALUE:
+            return 0
+        return math.ceil(math.log2(value / HISTOGRAM_MIN_VALUE) * HISTOGRAM_BUCKETS_PER_DOUBLING)
+
+    @staticmethod
+    def bucket_value(index):
+        """
+        Значение, которым представлена корзина: середина корзины в логарифмической шкале
+        """
+        if index == 0:
+            return HISTOGRAM_MIN_VALUE
+        return HISTOGRAM_MIN_VALUE * 2 ** ((index - 0.5) / HISTOGRAM_BUCKETS_PER_DOUBLING)
+
+    def add(self, value):
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+
+        if value > self.max:
+            self.max = value
+
+    def add_count(self, value, count):
+        """
+        Добавляем count одинаковых значений (например, центроид t-digest)
+        """
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.sum += value * count
+
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if isinstance(other, LogHistogram):
+            for index, count in other.buckets.items():
+                self.buckets[index] = self.buckets.get(index, 0) + count
+            self.count += other.count
+            self.sum += other.sum
+            self.max = max(self.max, other.max)
+        else:
+            for value in other:
+                self.add(value)
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+
+        target = q * self.count
+        cumulative = 0
+
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            if cumulative >= target:
+                return min(self.bucket_value(index), self.max)
+
+        return self.max
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def make_samples_factory(mode='exact', compression=100):
+    """
+    Возвращаем фабрику накопителей значений времени для выбранного режима расчета медианы/квантилей
+    """
+    if mode == 'tdigest':
+        return partial(TDigest, compression)
+    if mode == 'histogram':
+        return LogHistogram
+    return ExactSamples
+
+
+class SpaceSaving:
+    """
+    Взвешенный Space-Saving: отслеживаем не больше capacity ключей со счетчиками (сумма весов, например time_sum).
+    Новый ключ при заполненной таблице вытесняет ключ с минимальным счетчиком и получает его счетчик как ошибку
+    (errors). Счетчик завышает сумму ключа не больше чем на его ошибку, ошибка не больше threshold (минимального
+    счетчика), а threshold не больше суммы всех весов / capacity: ключ с суммой больше threshold гарантированно
+    в таблице. Минимум ищется по куче с ленивым обновлением - счетчики только растут, поэтому устаревшая запись
+    обновляется, только когда оказывается на вершине кучи
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+        self.errors = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, key, weight):
+        """
+        Добавляем вес ключу. Возвращаем вытесненный ключ, если новый ключ занял его место, иначе None
+        """
+        counter = self.counters.get(key)
+
+        if counter is not None:
+            self.counters[key] = counter + weight
+            return None
+
+        if len(self.counters) < self.capacity:
+            self.counters[key] = weight
+            self.errors[key] = 0.0
+            heapq.heappush(self.heap, (weight, key))
+            return None
+
+        threshold, evicted = self.min_entry()
+        del self.counters[evicted]
+        del self.errors[evicted]
+
+        self.counters[key] = threshold + weight
+        self.errors[key] = threshold
+        heapq.heapreplace(self.heap, (threshold + weight, key))
+
+        return evicted
+
+    def min_entry(self):
+        heap = self.heap
+
+        while True:
+            counter, key = heap[0]
+            actual = self.counters[key]
+
+            if actual == counter:
+                return counter, key
+
+            heapq.heapreplace(heap, (actual, key))
+
+    @property
+    def threshold(self):
+        """
+        Верхняя граница суммы любого ключа, которого нет в таблице
+        """
+        return self.min_entry()[0] if len(self.counters) >= self.capacity else 0.0
+
+    def merge(self, other):
+        """
+        Объединение таблиц (частей файла): ключу, которого нет в одной из таблиц, к счетчику и ошибке добавляется
+        ее threshold; остаются capacity ключей с наибольшими счетчиками
+        """
+        threshold, other_threshold = self.threshold, other.threshold
+        counters = {}
+        errors = {}
+
+        for key in chain(self.counters, other.counters):
+            if key not in counters:
+                counters[key] = self.counters.get(key, threshold) + other.counters.get(key, other_threshold)
+                errors[key] = self.errors.get(key, threshold) + other.errors.get(key, other_threshold)
+
+        kept = heapq.nlargest(self.capacity, counters, key=counters.get)
+        self.counters = {key: counters[key] for key in kept}
+        self.errors = {key: errors[key] for key in kept}
+        self.heap = [(counter, key) for key, counter in self.counters.items()]
+        heapq.heapify(self.heap)
+
+        return self
+
+
+class HyperLogLog:
+    """
+    Оценка кол-ва различных значений (например, клиентов url) в памяти 2 ** precision байт: 64-битный хэш
+    значения (blake2b) делится на номер регистра (старшие precision бит) и остаток, в регистре - максимальный
+    номер первой единицы остатка. Стандартная ошибка ~1.04 / sqrt(2 ** precision): 1.6 % при precision 12 (4 KB).
+    Пока заполнено мало регистров, они хранятся словарем {номер: значение} - редкие url занимают меньше памяти.
+    Объединение - максимум по регистрам, поэтому оценки частей файла, серверов и дней складываются без потерь;
+    при разной точности результат - с меньшей (см. fold)
+    """
+    __slots__ = ('precision', 'sparse', 'registers')
+
+    def __init__(self, precision=12):
+        if not HLL_MIN_PRECISION <= precision <= HLL_MAX_PRECISION:
+            raise ValueError(f'Точность HyperLogLog должна быть от {HLL_MIN_PRECISION} до {HLL_MAX_PRECISION}')
+
+        self.precision = precision
+        self.sparse = {}
+        self.registers = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def size(self):
+        return 1 << self.precision
+
+    def add(self, value):
+        hashed = int.from_bytes(blake2b(value.encode('utf-8', 'replace'), digest_size=8).digest(), 'big')
+        width = 64 - self.precision
+        index = hashed >> width
+        rank = width - (hashed & ((1 << width) - 1)).bit_length() + 1
+        self.set_register(index, rank)
+
+    def set_register(self, index, rank):
+        registers = self.registers
+
+        if registers is not None:
+            if rank > registers[index]:
+                registers[index] = rank
+            return
+
+        if rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+
+            if len(self.sparse) > self.size // 64:  # словарь уже не меньше массива регистров
+                self.to_dense()
+
+    def to_dense(self):
+        self.registers = bytearray(self.size)
+
+        for index, rank in self.sparse.items():
+            self.registers[index] = rank
+
+        self.sparse = {}
+
+    def items(self):
+        """
+        Непустые регистры: (номер, значение)
+        """
+        if self.registers is None:
+            return self.sparse.items()
+        return ((index, rank) for index, rank in enumerate(self.registers) if rank)
+
+    def fold(self, precision):
+        """
+        Та же оценка с меньшей точностью: старшие биты номера регистра остаются номером, младшие становятся
+        началом остатка хэша
+        """
+        folded = HyperLogLog(precision)
+        shift = self.precision - precision
+
+        for index, rank in self.items():
+            low_bits = index & ((1 << shift) - 1)
+            folded.set_register(index >> shift, shift - low_bits.bit_length() + 1 if low_bits else rank + shift)
+
+        return folded
+
+    def merge(self, other):
+        if other.precision < self.precision:
+            folded = self.fold(other.precision)
+            self.precision, self.sparse, self.registers = folded.precision, folded.sparse, folded.registers
+        elif other.precision > self.precision:
+            other = other.fold(self.precision)
+
+        if self.registers is not None and other.registers is not None:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+        else:
+            for index, rank in other.items():
+                self.set_register(index, rank)
+
+        return self
+
+    def count(self):
+        """
+        Оценка кол-ва различных значений; при большом кол-ве пустых регистров - линейный подсчет по ним
+        """
+        size = self.size
+
+        if self.registers is None:
+            zeros = size - len(self.sparse)
+            harmonic = zeros + sum(HLL_POWERS[rank] for rank in self.sparse.values())
+        else:
+            zeros = self.registers.count(0)
+            harmonic = sum(map(HLL_POWERS.__getitem__, self.registers))
+
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / harmonic
+
+        if estimate <= 2.5 * size and zeros:
+            return size * math.log(size / zeros)
+
+        return estimate
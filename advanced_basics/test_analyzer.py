@@ -1,4 +1,13 @@
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
 import unittest
+from concurrent.futures import ProcessPoolExecutor
+import unittest.mock
+from statistics import median
 from typing import Iterable
 
 from log_analyzer import (
@@ -7,7 +16,40 @@ from log_analyzer import (
     process_logs,
     process_lines,
     check_report_exist,
+    find_pending_log_files,
+    backfill_reports,
+    config,
+    validate_log,
+    parse_ui_short,
+    check_new_data,
+    create_report_file,
+    export_columns,
+    get_report_file_name,
+    rollup_aggregates,
+    UrlNormalizer,
+    OVERFLOW_URL,
+    aggregate_lines,
+    LogFollower,
+    preflight_check,
+    SlidingWindows,
+    TimeLocalParser,
+    make_aggregate_options,
+    resolve_aggregate_options,
+    build_urls_data,
+    get_url_time,
+    merge_aggregates,
+    merge_aggregate_files,
 )
+from sketches import ExactSamples, TDigest, LogHistogram, SpaceSaving, HyperLogLog
+from aggregates import AggregateStore
+from columnar import load_columns
+import vectorized
+from profiling import stage_metrics
+from dir_index import DirectoryIndex
+from log_formats import LogFormat, UI_SHORT_FORMAT, find_log_format
+from aggregate_files import write_aggregate_file, read_aggregate_file
+from dimensions import get_client_subnet, get_user_agent_family
+from bench_analyzer import generate_ui_short_log
 
 
 test_dir_name = 'testing_logs'
@@ -21,6 +63,22 @@ already_exist_report_date = '20231216'
 invalid_log_25_perc_file_name = 'nginx-test-access-ui.log-20231216'  # файл содержит 20 логов - 5 из них невалидные
 
 
+def save_to_store(dir_name, day, urls_count):
+    """
+    Сохраняем показатели файла за день в хранилище из отдельного процесса - как при --backfill --workers
+    """
+    aggregated = {
+        'urls': {
+            f'/api/{index}': {'count': 1, 'time_sum': 0.5, 'time_max': 0.5, 'samples': ExactSamples([0.5])}
+            for index in range(urls_count)
+        },
+        'total_count': urls_count,
+        'total_time': urls_count * 0.5,
+        'invalid_count': 0
+    }
+    AggregateStore(dir_name).save(f'nginx-access-ui.log-202312{day:02}', 20231200 + day, aggregated, day, 1, 'exact')
+
+
 class Testing(unittest.TestCase):
     def test_find_log_file(self):
         """
@@ -77,6 +135,867 @@ class Testing(unittest.TestCase):
         )
         self.assertIsInstance(urls, list)
 
+    def test_process_lines_single_pass_matches_multi_pass(self):
+        """
+        Тестируем, что однопроходный режим возвращает те же данные, что и прежний режим с перечитыванием файла
+        """
+        results = []
+        for single_pass in (True, False):
+            gen_lines = process_logs(
+                file_name=correct_log_file_name,
+                log_dir_name=test_dir_name
+            )
+            results.append(process_lines(
+                line_iterator=gen_lines,
+                file_name=correct_log_file_name,
+                log_dir_name=test_dir_name,
+                report_size=test_report_size,
+                single_pass=single_pass
+            ))
+        self.assertEqual(results[0], results[1])
+
+    def test_process_lines_workers_match_serial(self):
+        """
+        Тестируем, что параллельная обработка файла по частям (workers > 1) совпадает с последовательной обработкой
+        """
+        results = []
+        for workers in (1, 3):
+            gen_lines = process_logs(
+                file_name=correct_log_file_name,
+                log_dir_name=test_dir_name
+            )
+            results.append(process_lines(
+                line_iterator=gen_lines,
+                file_name=correct_log_file_name,
+                log_dir_name=test_dir_name,
+                report_size=test_report_size,
+                workers=workers
+            ))
+        self.assertEqual(results[0], results[1])
+
+    def test_process_lines_mmap_read_mode(self):
+        """
+        Тестируем чтение файла как байтов (mmap для несжатого файла, блоки для .gz) - результат как в текстовом режиме
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        with open(os.path.join(test_dir_name, invalid_log_25_perc_file_name), 'rb') as log:
+            with gzip.open(os.path.join(tmp_dir, invalid_log_25_perc_file_name + '.gz'), 'wb') as gz_log:
+                gz_log.write(log.read())
+
+        expected = process_lines(
+            process_logs(invalid_log_25_perc_file_name, test_dir_name),
+            invalid_log_25_perc_file_name, test_dir_name, test_report_size, fail_coefficient=25
+        )
+        for file_name, dir_name in ((invalid_log_25_perc_file_name, test_dir_name),
+                                    (invalid_log_25_perc_file_name + '.gz', tmp_dir)):
+            urls = process_lines(None, file_name, dir_name, test_report_size, fail_coefficient=25, read_mode='mmap')
+            self.assertEqual(urls, expected)
+
+    def test_process_lines_tdigest_quantiles(self):
+        """
+        Тестируем приближенный режим медианы (t-digest): в отчет добавляются квантили p90/p95/p99
+        """
+        gen_lines = process_logs(
+            file_name=correct_log_file_name,
+            log_dir_name=test_dir_name
+        )
+        urls = process_lines(
+            line_iterator=gen_lines,
+            file_name=correct_log_file_name,
+            log_dir_name=test_dir_name,
+            report_size=test_report_size,
+            options=make_aggregate_options('tdigest')
+        )
+        self.assertTrue(all('time_p99' in url for url in urls))
+
+    def test_tdigest_median_error(self):
+        """
+        Тестируем точность t-digest: ошибка медианы по рангу на 100000 значений не превышает 1 %
+        """
+        rnd = random.Random(0)
+        values = [rnd.lognormvariate(-2, 1) for _ in range(100000)]
+        digest = TDigest(compression=100)
+        for value in values:
+            digest.add(value)
+        digest_median = digest.median()
+        rank = sum(1 for value in values if value <= digest_median) / len(values)
+        self.assertAlmostEqual(rank, 0.5, delta=0.01)
+        self.assertLess(len(digest.means), 100)
+        self.assertAlmostEqual(digest.median(), median(values), delta=0.01)
+
+    def test_parse_ui_short_matches_validate_log(self):
+        """
+        Тестируем быстрый разбор строк: результат совпадает с прежним split() + validate_log для каждой строки файла
+        """
+        for line in process_logs(file_name=invalid_log_25_perc_file_name, log_dir_name=test_dir_name):
+            log_list = line.split()
+            expected = (log_list[6], float(log_list[-1])) if validate_log(log_list) else None
+            self.assertEqual(parse_ui_short(line), expected)
+
+    def test_process_lines_incremental(self):
+        """
+        Тестируем инкрементальную обработку: файл дописывается (в т.ч. с неполной последней строкой), при каждом
+        запуске обрабатываются только новые байты, а результат совпадает с полной обработкой файла
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        with open(os.path.join(test_dir_name, correct_log_file_name), 'rb') as log:
+            data = log.read()
+
+        store = AggregateStore(os.path.join(tmp_dir, 'reports'))
+
+        for size in (len(data) // 3, len(data) // 2 + 7, len(data)):
+            with open(os.path.join(tmp_dir, correct_log_file_name), 'wb') as log:
+                log.write(data[:size])
+
+            self.assertEqual(check_new_data(store, correct_log_file_name, tmp_dir), size != len(data) // 3)
+
+            incremental = process_lines(None, correct_log_file_name, tmp_dir, test_report_size, store=store)
+            full = process_lines(
+                process_logs(correct_log_file_name, tmp_dir), correct_log_file_name, tmp_dir, test_report_size
+            )
+            self.assertEqual(incremental, full)
+
+        # файл без перевода строки в конце: последняя строка не сохраняется, но и новыми данными не считается
+        self.assertFalse(data.endswith(b'\n'))
+        self.assertFalse(check_new_data(store, correct_log_file_name, tmp_dir))
+
+    def test_max_urls_parts(self):
+        """
+        Тестируем лимит url при обработке по частям (новые строки при INCREMENTAL, диапазоны --workers): url,
+        уже учтенный в объединенных показателях, не попадает в OVERFLOW_URL своей части - отчет совпадает
+        с обработкой файла целиком
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        with open(os.path.join(test_dir_name, correct_log_file_name), 'rb') as log:
+            lines = log.readlines()
+
+        for max_urls in (3, 5, 8):
+            options = make_aggregate_options(max_urls=max_urls)
+            full = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                 test_dir_name, test_report_size, options=options)
+            self.assertIn(OVERFLOW_URL, [url['url'] for url in full])
+
+            for workers in (2, 3):
+                self.assertEqual(
+                    process_lines(None, correct_log_file_name, test_dir_name, test_report_size, options=options,
+                                  workers=workers),
+                    full
+                )
+
+            store = AggregateStore(os.path.join(tmp_dir, f'reports-{max_urls}'))
+
+            for size in (len(lines) // 3, len(lines) // 2, len(lines)):
+                with open(os.path.join(tmp_dir, correct_log_file_name), 'wb') as log:
+                    log.writelines(lines[:size])
+
+                incremental = process_lines(None, correct_log_file_name, tmp_dir, test_report_size, options=options,
+                                            store=store)
+
+            self.assertEqual(incremental, full)
+
+    def test_store_concurrent_save(self):
+        """
+        Тестируем одновременную запись в хранилище из нескольких процессов: каталог и база создаются без гонки,
+        запись ждет освобождения базы, а не падает с "database is locked"
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        store_dir = os.path.join(tmp_dir, 'reports')
+
+        with ProcessPoolExecutor(4) as executor:
+            futures = [executor.submit(save_to_store, store_dir, day, 20000) for day in range(1, 9)]
+            for future in futures:
+                future.result()
+
+        store = AggregateStore(store_dir)
+        conn = store.get_con()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        conn.close()
+
+        aggregated = rollup_aggregates(store, 20231201, 20231208)
+        self.assertEqual(aggregated['total_count'], 8 * 20000)
+        self.assertEqual(len(aggregated['urls']), 20000)
+
+    def test_rollup_aggregates(self):
+        """
+        Тестируем сводные показатели за период: объединяются сохраненные показатели всех файлов с датой в периоде
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        store = AggregateStore(tmp_dir)
+
+        for file_name in (correct_log_file_name, invalid_log_25_perc_file_name):
+            # Сохраняются только завершенные строки - дописываем перевод строки, как в ротированных логах nginx
+            shutil.copy(os.path.join(test_dir_name, file_name), tmp_dir)
+            with open(os.path.join(tmp_dir, file_name), 'a') as log:
+                log.write('\n')
+
+            process_lines(None, file_name, tmp_dir, test_report_size, fail_coefficient=100, store=store)
+
+        aggregated = rollup_aggregates(store, 20231216, 20231217)
+        self.assertEqual(aggregated['total_count'], 40)
+        self.assertEqual(sum(url_stats['count'] for url_stats in aggregated['urls'].values()), 35)
+        self.assertIsNone(rollup_aggregates(store, 20231218, 20231220))
+
+    def test_url_normalizer(self):
+        """
+        Тестируем нормализацию url: правила пользователя, отбрасывание параметров запроса, замена id и UUID в пути
+        """
+        normalizer = UrlNormalizer(
+            strip_query=True,
+            collapse_ids=True,
+            rules=[[r'^/export/appinstall_raw/[^/]+/', '/export/appinstall_raw/{date}/']]
+        )
+        self.assertEqual(
+            normalizer('/api/v2/banner/17538309/statistic/?date_from=2017-06-29'), '/api/v2/banner/{id}/statistic/'
+        )
+        self.assertEqual(normalizer('/export/appinstall_raw/2017-06-29/'), '/export/appinstall_raw/{date}/')
+        self.assertEqual(
+            normalizer('/api/1/users/123e4567-e89b-12d3-a456-426614174000'), '/api/{id}/users/{uuid}'
+        )
+        self.assertEqual(UrlNormalizer(collapse_ids=True)('/api/v2/banner/1?id=2'), '/api/v2/banner/{id}?id=2')
+
+    def test_process_lines_max_urls(self):
+        """
+        Тестируем лимит различных url: сверх лимита url учитываются вместе в OVERFLOW_URL, кол-во логов сохраняется
+        """
+        urls = process_lines(
+            line_iterator=process_logs(correct_log_file_name, test_dir_name),
+            file_name=correct_log_file_name,
+            log_dir_name=test_dir_name,
+            report_size=test_report_size,
+            options=make_aggregate_options(max_urls=5)
+        )
+        self.assertEqual(len(urls), 6)
+        self.assertIn(OVERFLOW_URL, [url['url'] for url in urls])
+        self.assertEqual(sum(url['count'] for url in urls), 20)
+
+    def test_build_urls_data_top(self):
+        """
+        Тестируем отбор топ-url через кучу: результат совпадает с прежним способом - показатели всех url,
+        устойчивая сортировка по убыванию 'time_sum' и первые report_size (url с равным time_sum - в порядке
+        появления)
+        """
+        rnd = random.Random(0)
+        urls_stats = {}
+
+        for i in range(2000):
+            samples = [rnd.choice((0.1, 0.2, 0.3)) for _ in range(rnd.randint(1, 3))]  # много равных time_sum
+            urls_stats[f'/api/v2/banner/{i}'] = {
+                'count': len(samples), 'time_sum': sum(samples), 'time_max': max(samples),
+                'samples': ExactSamples(samples)
+            }
+
+        aggregated = {
+            'urls': urls_stats,
+            'total_count': sum(url_stats['count'] for url_stats in urls_stats.values()),
+            'total_time': sum(url_stats['time_sum'] for url_stats in urls_stats.values())
+        }
+        all_urls_data = [
+            build_urls_data(dict(aggregated, urls={url: url_stats}), 1)[0] for url, url_stats in urls_stats.items()
+        ]
+        all_urls_data.sort(reverse=True, key=get_url_time)
+
+        for report_size in (1, 15, 1000, 5000):
+            self.assertEqual(build_urls_data(aggregated, report_size), all_urls_data[:report_size])
+
+    def test_create_report_file_json(self):
+        """
+        Тестируем запись отчета: вместо $table_json в шаблон подставляется JSON (в т.ч. url с '</script>')
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                             test_dir_name, test_report_size)
+        urls.append({'url': '/</script><script>alert(1)</script>', 'count': 1})
+
+        self.assertIn('ok', create_report_file(urls, correct_latest_date, tmp_dir))
+
+        with open(os.path.join(tmp_dir, get_report_file_name(correct_latest_date)), encoding='utf-8') as report:
+            text = report.read()
+
+        table_json = text.split('var table = ', 1)[1].split(';\n', 1)[0]
+        self.assertEqual(json.loads(table_json), urls)
+        self.assertNotIn('</script><script>', text)
+
+    def test_export_columns(self):
+        """
+        Тестируем выгрузку по колонкам: блоки .npy по chunk_size строк, url восстанавливаются по словарю,
+        $time_local переводится в секунды от начала эпохи, невалидные строки не выгружаются
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        meta = export_columns(process_logs(invalid_log_25_perc_file_name, test_dir_name),
+                              invalid_log_25_perc_file_name, tmp_dir, chunk_size=7)
+        self.assertEqual((meta['rows'], meta['invalid_count'], meta['chunks']), (15, 5, [7, 7, 1]))
+
+        urls, meta, chunks = load_columns(os.path.join(tmp_dir, invalid_log_25_perc_file_name))
+        records = [
+            (urls[url_id], request_time, timestamp)
+            for chunk in chunks
+            for url_id, request_time, timestamp in zip(chunk['url_id'], chunk['request_time'], chunk['timestamp'])
+        ]
+        expected = [
+            parse_ui_short(line) for line in process_logs(invalid_log_25_perc_file_name, test_dir_name)
+            if parse_ui_short(line)
+        ]
+        self.assertEqual([(url, round(request_time, 3)) for url, request_time, _ in records], expected)
+        self.assertEqual(records[0][2], 1498765856)  # 29/Jun/2017:22:50:56 +0300
+
+    @unittest.skipUnless(vectorized.numpy, 'numpy не установлен')
+    def test_process_lines_numpy_backend(self):
+        """
+        Тестируем векторный расчет показателей (STATS_BACKEND numpy): отчет совпадает с расчетом в цикле Python
+        """
+        for max_urls in (0, 5):
+            results = [
+                process_lines(process_logs(file_name, test_dir_name), file_name, test_dir_name, test_report_size,
+                              fail_coefficient=25,
+                              options=make_aggregate_options(max_urls=max_urls, stats_backend=stats_backend))
+                for file_name in (correct_log_file_name, invalid_log_25_perc_file_name)
+                for stats_backend in ('python', 'numpy')
+            ]
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[2], results[3])
+
+    def test_log_histogram_merge(self):
+        """
+        Тестируем логарифмическую гистограмму: гистограммы частей совпадают с гистограммой всех значений,
+        ошибка квантилей не превышает ширины корзины
+        """
+        rnd = random.Random(0)
+        values = [rnd.lognormvariate(-2, 1) for _ in range(30000)]
+
+        full = LogHistogram()
+        for value in values:
+            full.add(value)
+
+        parts = [LogHistogram(), LogHistogram(), LogHistogram()]
+        for i, value in enumerate(values):
+            parts[i % 3].add(value)
+        merged = parts[0].merge(parts[1]).merge(parts[2])
+
+        self.assertEqual((merged.buckets, merged.count, merged.max), (full.buckets, full.count, full.max))
+
+        sorted_values = sorted(values)
+        for q in (0.5, 0.9, 0.99):
+            exact = sorted_values[int(q * len(values))]
+            self.assertAlmostEqual(merged.quantile(q) / exact, 1, delta=0.05)
+
+    def test_process_lines_timeseries(self):
+        """
+        Тестируем временной ряд по $time_local: одинаков при чтении строк, mmap и параллельной обработке,
+        учитывает все валидные логи и не меняет таблицу url; в отчет подставляется вместо $timeseries_json
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        expected_urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                      test_dir_name, test_report_size)
+        results = []
+
+        for kwargs in ({}, {'read_mode': 'mmap'}, {'workers': 3}):
+            report_sections = {}
+            urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                 test_dir_name, test_report_size, options=make_aggregate_options(timeseries_bucket=60),
+                                 report_sections=report_sections, **kwargs)
+            self.assertEqual(urls, expected_urls)
+            results.append(report_sections['timeseries'])
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(sum(point['count'] for point in results[0]), 20)
+
+        create_report_file(expected_urls, correct_latest_date, tmp_dir, report_sections={'timeseries': results[0]})
+
+        with open(os.path.join(tmp_dir, get_report_file_name(correct_latest_date)), encoding='utf-8') as report:
+            text = report.read()
+
+        timeseries_json = text.split('var timeseries = ', 1)[1].split(';\n', 1)[0]
+        self.assertEqual(json.loads(timeseries_json), results[0])
+
+    def test_backfill_reports(self):
+        """
+        Тестируем обработку всех файлов без отчета: файлы с отчетом пропускаются, как и текущий файл без даты
+        в имени, остальные обрабатываются в пуле
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        log_dir = os.path.join(tmp_dir, 'log')
+        report_dir = os.path.join(tmp_dir, 'reports')
+        os.makedirs(log_dir)
+        os.makedirs(report_dir)
+
+        for log_date in (20231214, 20231215, 20231216):
+            shutil.copy(os.path.join(test_dir_name, correct_log_file_name),
+                        os.path.join(log_dir, f'nginx-access-ui.log-{log_date}'))
+        open(os.path.join(report_dir, get_report_file_name(20231215)), 'w').close()
+        open(os.path.join(log_dir, 'nginx-access-ui.log'), 'w').close()
+
+        self.assertEqual(
+            find_pending_log_files(log_dir, report_dir),
+            [('nginx-access-ui.log-20231214', 20231214), ('nginx-access-ui.log-20231216', 20231216)]
+        )
+
+        configuration = dict(config, LOG_DIR=log_dir, REPORT_DIR=report_dir, WORKERS=2)
+        self.assertIn('ok', backfill_reports(configuration))
+        self.assertTrue(os.path.exists(os.path.join(report_dir, get_report_file_name(20231216))))
+        self.assertEqual(find_pending_log_files(log_dir, report_dir), [])
+
+    def test_stage_metrics(self):
+        """
+        Тестируем метрики этапов: для обработки файла записываются этапы 'scan' и 'select' с кол-вом строк и байт
+        """
+        stage_metrics.reset()
+        process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name, test_dir_name,
+                      test_report_size)
+
+        metrics = json.loads(stage_metrics.as_json())
+        self.assertEqual([stage['stage'] for stage in metrics['stages']], ['scan', 'select'])
+        self.assertEqual(metrics['stages'][0]['lines'], 20)
+        self.assertEqual(metrics['stages'][0]['bytes'],
+                         os.path.getsize(os.path.join(test_dir_name, correct_log_file_name)))
+        self.assertGreater(metrics['peak_rss_kb'], 0)
+
+    def test_generate_ui_short_log(self):
+        """
+        Тестируем генератор синтетических логов: кол-во строк, доля невалидных и число различных url как заданы,
+        при одинаковых параметрах (в т.ч. .gz) содержимое одинаковое
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        file_name = 'nginx-access-ui.log-20170629'
+        generate_ui_short_log(os.path.join(tmp_dir, file_name), lines=5000, urls_count=50, invalid_ratio=0.2)
+        generate_ui_short_log(os.path.join(tmp_dir, file_name + '.gz'), lines=5000, urls_count=50, invalid_ratio=0.2,
+                              gzip_output=True)
+
+        aggregated = aggregate_lines(process_logs(file_name, tmp_dir))
+        self.assertEqual(aggregated['total_count'], 5000)
+        self.assertAlmostEqual(aggregated['invalid_count'] / 5000, 0.2, delta=0.02)
+        self.assertLessEqual(len(aggregated['urls']), 50)
+        self.assertEqual(list(process_logs(file_name, tmp_dir)), list(process_logs(file_name + '.gz', tmp_dir)))
+
+    def test_log_follower_rotation(self):
+        """
+        Тестируем чтение дописываемого файла: возвращаются только завершенные строки, после ротации (новый inode)
+        старый файл дочитывается и чтение продолжается с начала нового файла
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        file_path = os.path.join(tmp_dir, 'nginx-access-ui.log')
+
+        with open(file_path, 'wb') as log:
+            log.write(b'line 1\nline 2\nline')
+
+        follower = LogFollower(file_path, from_start=True)
+        self.addCleanup(follower.close)
+        self.assertEqual(follower.read_lines(), [b'line 1', b'line 2'])
+
+        with open(file_path, 'ab') as log:
+            log.write(b' 3\n')
+        os.rename(file_path, file_path + '.1')
+        with open(file_path + '.1', 'ab') as log:  # nginx дописывает в старый файл до переоткрытия
+            log.write(b'line 4\n')
+        with open(file_path, 'wb') as log:
+            log.write(b'line 5\n')
+
+        self.assertEqual(follower.read_lines(), [b'line 3', b'line 4'])
+        self.assertEqual(follower.read_lines(), [b'line 5'])
+        self.assertEqual(follower.read_lines(), [])
+
+    def test_sliding_windows(self):
+        """
+        Тестируем скользящие окна: окно учитывает строки за последние N секунд до самого позднего $time_local,
+        строки старше самого длинного окна удаляются
+        """
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:{time} +0300] "GET {url} HTTP/1.1" 200 927 "-" "-" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" {request_time}')
+        lines = [
+            line.format(time='50:22', url='/api/v2/banner/1/', request_time='0.390').encode(),
+            line.format(time='53:42', url='/api/v2/banner/2/', request_time='0.100').encode(),
+            b'invalid line',
+            line.format(time='54:12', url='/api/v2/banner/2/', request_time='0.300').encode(),
+        ]
+
+        windows = SlidingWindows(windows=(60, 300))
+        windows.add_lines(lines)
+
+        windows_data = windows.build_windows_data(10)
+        self.assertEqual([(url['url'], url['count']) for url in windows_data['1m']], [('/api/v2/banner/2/', 2)])
+        self.assertEqual([(url['url'], url['count']) for url in windows_data['5m']],
+                         [('/api/v2/banner/2/', 2), ('/api/v2/banner/1/', 1)])
+        self.assertEqual(windows.get_window(300)['invalid_count'], 1)
+
+        windows.add_lines([line.format(time='59:59', url='/api/v2/banner/3/', request_time='0.200').encode()])
+        self.assertEqual([url['url'] for url in windows.build_windows_data(10)['5m']], ['/api/v2/banner/3/'])
+        self.assertEqual(len(windows.buckets), 1)
+
+    def test_preflight_check(self):
+        """
+        Тестируем предварительную проверку по выборке строк: файл с 90 % невалидных логов отбрасывается без полного
+        прохода (в режиме 'warn' - только предупреждение), файл с 1 % невалидных - проходит проверку
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        for file_name, invalid_ratio, gzip_output in (('nginx-access-ui.log-20170629', 0.9, False),
+                                                      ('nginx-access-ui.log-20170630', 0.01, False),
+                                                      ('nginx-access-ui.log-20170701.gz', 0.9, True)):
+            generate_ui_short_log(os.path.join(tmp_dir, file_name), lines=20000, invalid_ratio=invalid_ratio,
+                                  gzip_output=gzip_output)
+
+        self.assertFalse(preflight_check('nginx-access-ui.log-20170629', tmp_dir, 50))
+        self.assertFalse(preflight_check('nginx-access-ui.log-20170701.gz', tmp_dir, 50))
+        self.assertTrue(preflight_check('nginx-access-ui.log-20170629', tmp_dir, 50, mode='warn'))
+        self.assertTrue(preflight_check('nginx-access-ui.log-20170630', tmp_dir, 5))
+        self.assertIsNone(process_lines(None, 'nginx-access-ui.log-20170629', tmp_dir, test_report_size,
+                                        fail_coefficient=50, read_mode='mmap', preflight='abort'))
+
+        # Маленький файл читается целиком: оценка точная, 25 % невалидных при пороге 25 % - проходит
+        self.assertTrue(preflight_check(invalid_log_25_perc_file_name, test_dir_name, 25))
+        self.assertFalse(preflight_check(invalid_log_25_perc_file_name, test_dir_name, 24))
+
+    def test_directory_index(self):
+        """
+        Тестируем кэш содержимого директорий: пока директория не менялась - она не читается повторно, новые файлы
+        подхватываются после изменения ее mtime; поиск самого нового файла и файлов без отчета - как без кэша
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        log_dir = os.path.join(tmp_dir, 'log')
+        report_dir = os.path.join(tmp_dir, 'reports')
+        index_path = os.path.join(tmp_dir, 'dir_index.json')
+        os.makedirs(log_dir)
+        os.makedirs(report_dir)
+
+        for file_name in ('nginx-access-ui.log-20231215.gz', 'nginx-access-ui.log-20231216',
+                          'nginx-access-ui.log-20231216.gz', 'nginx-access-other.log-20231218', 'nginx-access-ui.log'):
+            open(os.path.join(log_dir, file_name), 'w').close()
+        open(os.path.join(report_dir, get_report_file_name(20231215)), 'w').close()
+
+        dir_index = DirectoryIndex(index_path)
+        self.assertEqual(dir_index.find_latest_log(log_dir, 'nginx-access-ui.log*'),
+                         ('nginx-access-ui.log-20231216', 20231216))
+        self.assertEqual(get_recent_log_file(find_log_file('nginx-access-ui.log*', log_dir))[1], 20231216)
+        self.assertEqual(find_pending_log_files(log_dir, report_dir, dir_index),
+                         find_pending_log_files(log_dir, report_dir))
+        dir_index.save()
+
+        # Директории не менялись (mtime старше момента чтения) - кэш используется без повторного чтения
+        for dir_name in (log_dir, report_dir):
+            os.utime(dir_name, ns=(0, 0))
+        dir_index = DirectoryIndex(index_path)
+        dir_index.refresh(log_dir)
+        dir_index.refresh(report_dir)
+        dir_index.save()
+
+        dir_index = DirectoryIndex(index_path)
+        with unittest.mock.patch('os.scandir', side_effect=AssertionError('директория прочитана повторно')):
+            self.assertEqual(dir_index.find_latest_log(log_dir, 'nginx-access-ui.log*'),
+                             ('nginx-access-ui.log-20231216', 20231216))
+            self.assertTrue(check_report_exist(20231215, report_dir, dir_index.get_names(report_dir)))
+            self.assertIs(dir_index.get_names(report_dir), dir_index.get_names(report_dir))  # без копирования
+
+        open(os.path.join(log_dir, 'nginx-access-ui.log-20231217.gz'), 'w').close()
+        self.assertEqual(dir_index.find_latest_log(log_dir, 'nginx-access-ui.log*'),
+                         ('nginx-access-ui.log-20231217.gz', 20231217))
+
+        # Дописанный файл: размер и mtime обновляются по запросу, повторное чтение директории их не запрашивает
+        log_path = os.path.join(log_dir, 'nginx-access-ui.log-20231216')
+        with open(log_path, 'w') as log:
+            log.write('0123456789')
+        os.utime(log_path, ns=(10 ** 9, 10 ** 9))
+        self.assertEqual(dir_index.get_file_info(log_dir, 'nginx-access-ui.log-20231216'), [20231216, 10, 10 ** 9])
+        self.assertIsNone(dir_index.get_file_info(log_dir, 'nginx-access-ui.log-20231219'))
+
+        with open(log_path, 'a') as log:
+            log.write('0123456789')
+        open(os.path.join(log_dir, 'nginx-access-ui.log-20231218'), 'w').close()
+        files = dir_index.refresh(log_dir)
+        self.assertEqual(files['nginx-access-ui.log-20231216'], [20231216, 10, 10 ** 9])
+        self.assertIn('nginx-access-ui.log-20231218', files)
+        self.assertEqual(dir_index.get_file_info(log_dir, 'nginx-access-ui.log-20231216')[:2], [20231216, 20])
+
+    def test_log_format(self):
+        """
+        Тестируем разбор по строке nginx log_format: формат ui_short разбирается так же, как parse_ui_short
+        (в т.ч. при параллельной обработке), другой формат - по своим полям, с проверкой кода ответа
+        """
+        log_format = LogFormat(UI_SHORT_FORMAT)
+
+        for line in process_logs(invalid_log_25_perc_file_name, test_dir_name):
+            self.assertEqual(log_format.parse(line), parse_ui_short(line))
+            self.assertEqual(log_format.parse_bytes(line.encode()), parse_ui_short(line))
+
+        expected = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                 test_dir_name, test_report_size)
+        for workers in (1, 2):
+            self.assertEqual(process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                           test_dir_name, test_report_size,
+                                           options=make_aggregate_options(log_format=UI_SHORT_FORMAT),
+                                           workers=workers), expected)
+
+        other_format = LogFormat(
+            '$remote_addr [$time_local] $request_method $request_uri $status $request_time "$http_user_agent"'
+        )
+        line = '1.2.3.4 [29/Jun/2017:03:50:22 +0300] GET /api/v2/banner/1?x=1 200 0.390 "curl/7.0"'
+        self.assertEqual(other_format.parse(line), ('/api/v2/banner/1?x=1', 0.39))
+        self.assertEqual(other_format.parse_record(line, TimeLocalParser()), ('/api/v2/banner/1?x=1', 0.39, 1498697422))
+        self.assertIsNone(other_format.parse(line.replace(' 200 ', ' OK ')))
+
+        with self.assertRaises(ValueError):
+            LogFormat('$remote_addr [$time_local] $status')
+
+        log_formats = {'nginx-access-other.log*': UI_SHORT_FORMAT}
+        self.assertEqual(find_log_format(log_formats, 'nginx-access-other.log-20231218'), UI_SHORT_FORMAT)
+        self.assertIsNone(find_log_format(log_formats, 'nginx-access-ui.log-20231218'))
+
+    def test_heavy_hitters(self):
+        """
+        Тестируем приближенный отбор топ-url (Space-Saving): url с суммой больше threshold всегда отслеживается,
+        счетчик завышает сумму не больше чем на ошибку; при достаточной емкости отчет совпадает с точным
+        """
+        rnd = random.Random(1)
+        heavy_hitters = SpaceSaving(20)
+        time_sums = {}
+
+        for _ in range(20000):
+            url = f'/api/{int(rnd.paretovariate(1.2))}'
+            log_time = rnd.random()
+            time_sums[url] = time_sums.get(url, 0) + log_time
+            heavy_hitters.add(url, log_time)
+
+        self.assertEqual(len(heavy_hitters), 20)
+        self.assertLessEqual(heavy_hitters.threshold, sum(time_sums.values()) / 20)
+
+        for url, time_sum in time_sums.items():
+            if time_sum > heavy_hitters.threshold:
+                self.assertIn(url, heavy_hitters.counters)
+
+        for url, counter in heavy_hitters.counters.items():
+            self.assertLessEqual(counter - heavy_hitters.errors[url], time_sums[url] + 1e-6)
+            self.assertLessEqual(time_sums[url], counter + 1e-6)
+
+        expected = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                 test_dir_name, test_report_size)
+        for workers in (1, 2):
+            urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                 test_dir_name, test_report_size, options=make_aggregate_options(heavy_hitters=100),
+                                 workers=workers)
+            self.assertEqual([url.pop('time_sum_err') for url in urls], [0] * len(urls))
+            self.assertEqual(urls, expected)
+
+    def test_memory_budget_spill(self):
+        """
+        Тестируем сброс таблицы url на диск при превышении бюджета памяти: частичные результаты объединяются
+        слиянием по url, отчет (в т.ч. порядок url с равным time_sum) совпадает с обработкой в памяти,
+        временные файлы удаляются - и когда отчет не строится из-за невалидных логов
+        """
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+
+        options = make_aggregate_options(memory_budget_mb=0.001, spill_dir=spill_dir)
+        aggregated = aggregate_lines(process_logs(invalid_log_25_perc_file_name, test_dir_name), options)
+        expected = aggregate_lines(process_logs(invalid_log_25_perc_file_name, test_dir_name))
+
+        self.assertGreater(len(aggregated['spill_files'].runs), 1)
+        merged = {url: list(samples) for url, _, samples in aggregated['spill_files'].merge()}
+        self.assertEqual(merged, {url: list(url_stats['samples']) for url, url_stats in expected['urls'].items()})
+
+        self.assertEqual(build_urls_data(aggregated, test_report_size), build_urls_data(expected, test_report_size))
+        self.assertEqual(os.listdir(spill_dir), [])
+
+        for read_mode in ('text', 'mmap'):
+            self.assertEqual(
+                process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                              test_dir_name, test_report_size, options=options, read_mode=read_mode),
+                process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                              test_dir_name, test_report_size)
+            )
+
+        # при превышении порога невалидных логов отчета нет, а сброшенные на диск файлы все равно удаляются
+        self.assertIsNone(
+            process_lines(process_logs(invalid_log_25_perc_file_name, test_dir_name), invalid_log_25_perc_file_name,
+                          test_dir_name, test_report_size, fail_coefficient=10, options=options)
+        )
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_aggregate_files_merge(self):
+        """
+        Тестируем файл показателей сервера: после записи и чтения показатели url те же (время - в гистограмме),
+        объединение файлов двух серверов дает сводный отчет с суммой показателей; файл новой версии не читается
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        aggregates = {}
+        process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name, test_dir_name,
+                      test_report_size, aggregates=aggregates)
+
+        file_paths = []
+        for host in ('front1', 'front2'):
+            file_paths.append(os.path.join(tmp_dir, f'aggregate-{host}.jsonl.gz'))
+            write_aggregate_file(file_paths[-1], aggregates, {'host': host, 'log_date': 20231217})
+
+        header, loaded = read_aggregate_file(file_paths[0])
+        self.assertEqual(header['host'], 'front1')
+        self.assertEqual(loaded['total_count'], aggregates['total_count'])
+        self.assertEqual(list(loaded['urls']), list(aggregates['urls']))
+
+        for url, url_stats in aggregates['urls'].items():
+            self.assertEqual(loaded['urls'][url]['time_sum'], url_stats['time_sum'])
+            self.assertEqual(len(loaded['urls'][url]['samples']), url_stats['count'])
+
+        configuration = dict(config, REPORT_DIR=tmp_dir, MERGE_FILES=file_paths)
+        self.assertIn('ok', merge_aggregate_files(configuration))
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'report-fleet-2023.12.17.html')))
+
+        merged = merge_aggregates(read_aggregate_file(file_paths[0])[1], read_aggregate_file(file_paths[1])[1])
+        single = build_urls_data(loaded, test_report_size)
+        for merged_url, url in zip(build_urls_data(merged, test_report_size), single):
+            self.assertEqual(merged_url['count'], url['count'] * 2)
+            self.assertEqual(merged_url['time_med'], url['time_med'])
+            self.assertEqual(merged_url['time_perc'], url['time_perc'])
+
+        with gzip.open(file_paths[1], 'wt', encoding='utf-8') as aggregate_file:
+            aggregate_file.write(json.dumps({'format': 'log-analyzer-aggregate', 'version': 99}) + '\n')
+        with self.assertRaises(ValueError):
+            read_aggregate_file(file_paths[1])
+        self.assertIn('failure', merge_aggregate_files(configuration))
+
+    def test_group_by_dimensions(self):
+        """
+        Тестируем группировку по измерениям: за один проход с показателями url собираются показатели по коду ответа,
+        методу, подсети и семейству клиента; сумма по значениям измерения - все валидные логи, отчет по url не меняется
+        """
+        self.assertEqual(get_client_subnet('1.196.116.32'), '1.196.116.0/24')
+        self.assertEqual(get_client_subnet('2001:db8:85a3::8a2e:370:7334'), '2001:db8:85a3::/48')
+        self.assertEqual(get_client_subnet('2001:db8::1'), '2001:db8::/48')
+        self.assertEqual(get_client_subnet('::1'), '::/48')
+        self.assertEqual(get_client_subnet('-'), '-')
+        self.assertEqual(get_client_subnet('1.2.3'), '1.2.3')
+        self.assertEqual(get_client_subnet('2001:db8:::1'), '2001:db8:::1')
+        self.assertEqual(get_user_agent_family('Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5'), 'Lynx')
+        self.assertEqual(get_user_agent_family(
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+            'Chrome/120.0 Safari/537.36'
+        ), 'Chrome')
+        self.assertEqual(get_user_agent_family('Googlebot/2.1 (+http://www.google.com/bot.html)'), 'Bot')
+
+        group_by = ['status', 'method', 'client_subnet', 'user_agent']
+        aggregated = aggregate_lines(process_logs(correct_log_file_name, test_dir_name))
+        urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name, test_dir_name,
+                             test_report_size)
+
+        for read_mode in ('text', 'mmap'):
+            report_sections = {}
+            grouped_urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name,
+                                         test_dir_name, test_report_size,
+                                         options=make_aggregate_options(dimensions=group_by), read_mode=read_mode,
+                                         report_sections=report_sections)
+            self.assertEqual(grouped_urls, urls)
+            self.assertEqual(list(report_sections['dimensions']), group_by)
+
+            for name, rows in report_sections['dimensions'].items():
+                self.assertEqual(sum(row['count'] for row in rows),
+                                 aggregated['total_count'] - aggregated['invalid_count'])
+                self.assertIn(name, rows[0])
+                self.assertNotIn('url', rows[0])
+
+            self.assertEqual({row['method'] for row in report_sections['dimensions']['method']}, {'GET'})
+
+        with self.assertRaises(ValueError):
+            LogFormat('$request $request_time').get_fields_parser(['status'])
+
+    def test_resolve_aggregate_options(self):
+        """
+        Тестируем согласование настроек со способом обработки: несовместимые возможности и неизвестные измерения
+        отключаются, переданный словарь настроек не меняется
+        """
+        options = make_aggregate_options(max_urls=5, heavy_hitters=100, memory_budget_mb=1, dimensions=['status', 'x'],
+                                         unique_clients='remote_addr', stats_backend='numpy')
+        expected_options = dict(options)
+
+        resolved = resolve_aggregate_options(options, correct_log_file_name)
+        self.assertEqual(resolved['memory_budget'], 0)
+        self.assertEqual(resolved['dimensions'], ('status',))
+        self.assertIsNone(resolved['unique_clients'])
+        self.assertEqual(resolved['heavy_hitters'], 100)
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        resolved = resolve_aggregate_options(options, correct_log_file_name, store=AggregateStore(tmp_dir))
+        self.assertEqual(resolved['heavy_hitters'], 0)
+        self.assertEqual(resolved['dimensions'], ())
+        self.assertEqual(resolved['stats_backend'], 'python')
+
+        resolved = resolve_aggregate_options(
+            make_aggregate_options(unique_clients='remote_addr', stats_backend='numpy'), correct_log_file_name
+        )
+        self.assertEqual((resolved['unique_clients'], resolved['stats_backend']), ('remote_addr', 'python'))
+
+        self.assertEqual(options, expected_options)
+
+    def test_unique_clients(self):
+        """
+        Тестируем оценку кол-ва уникальных клиентов url (HyperLogLog): ошибка в пределах нескольких стандартных,
+        объединение частей равно оценке по всем значениям (в т.ч. при разной точности), оценка переживает файл
+        показателей; в отчете - колонка clients
+        """
+        clients = HyperLogLog(12)
+        first, second, both = HyperLogLog(12), HyperLogLog(10), HyperLogLog(10)
+
+        for i in range(20000):
+            address = f'10.{i >> 16}.{i >> 8 & 255}.{i & 255}'
+            clients.add(address)
+            (first if i < 12000 else second).add(address)
+            both.add(address)
+
+        self.assertLess(abs(clients.count() - 20000) / 20000, 0.05)
+        self.assertEqual(first.merge(second).count(), both.count())
+        self.assertEqual(first.precision, 10)
+
+        few = HyperLogLog()
+        for address in ('1.1.1.1', '1.1.1.2', '1.1.1.1'):
+            few.add(address)
+        self.assertEqual(round(few.count()), 2)
+        self.assertIsNone(few.registers)
+
+        with self.assertRaises(ValueError):
+            HyperLogLog(20)
+
+        aggregates = {}
+        urls = process_lines(process_logs(correct_log_file_name, test_dir_name), correct_log_file_name, test_dir_name,
+                             test_report_size, options=make_aggregate_options(unique_clients='remote_addr'),
+                             aggregates=aggregates)
+
+        for url in urls:
+            self.assertGreaterEqual(url['clients'], 1)
+            self.assertLessEqual(url['clients'], url['count'])
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        file_path = os.path.join(tmp_dir, 'aggregate.jsonl.gz')
+        write_aggregate_file(file_path, aggregates, {'host': 'front1', 'log_date': 20231217})
+        _, loaded = read_aggregate_file(file_path)
+
+        for url, url_stats in aggregates['urls'].items():
+            self.assertEqual(loaded['urls'][url]['clients'].count(), url_stats['clients'].count())
+
     def test_check_report_exist(self):
         """
         Тестируем функцию, которая проверяет, что файл с анализом логов за указанную дату уже существует в директории